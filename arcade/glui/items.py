@@ -8,7 +8,7 @@ from arcade.glui.constants import TOP_ITEM_ARROW, TOP_ITEM_LEFT
 from arcade.glui.constants import ROW_NAME, ROW_PLATFORM
 
 from fsbc.util import memoize
-from fsgs.Database import Database
+from fsgs.Database import Database, GAME_PAGE_SIZE
 from fsgs.util.gamenameutil import GameNameUtil
 from arcade.resources import resources, gettext
 from .font import BitmapFont
@@ -289,6 +289,9 @@ class MenuItem(object):
         return [item for item in categories if check(item)]
 
     def generate_game_items(self, menu_path):
+        return self.create_game_items(*self.game_items_query(menu_path))
+
+    def game_items_query(self, menu_path):
         args = []
         clause = []
         for item in menu_path:
@@ -300,10 +303,27 @@ class MenuItem(object):
 
         filters = list(self.generate_game_filters(menu_path))
         print("filters for", menu_path, "-", filters)
-        return self.create_game_items(clause, args, filters)
+        return clause, args, filters
+
+    @classmethod
+    def append_game_items(cls, menu, words, args=None, filters=None):
+        """Appends the first page of matching games to menu, and lets the
+        menu load the following pages as needed."""
+        offset = 0
+
+        def more_items():
+            nonlocal offset
+            items = cls.create_game_items(
+                words, args, filters, offset=offset, limit=GAME_PAGE_SIZE)
+            offset += len(items)
+            return items
+
+        menu.set_more_items(more_items)
+        menu.load_more_items()
 
     @classmethod
-    def create_game_items(cls, words, args=None, filters=None):
+    def create_game_items(cls, words, args=None, filters=None, offset=0,
+                          limit=None):
         if filters is None:
             filters = []
         search = " ".join(words)
@@ -336,7 +356,8 @@ class MenuItem(object):
         item_list = []
         local_game_database = Database.instance()
         for game in local_game_database.find_games_new(
-                search=search, database_only=True):
+                search=search, database_only=True, limit=limit,
+                offset=offset):
             item = GameItem(game)
             item_list.append(item)
         return item_list
@@ -484,8 +505,7 @@ class AutoExpandItem(MenuItem):
         menu_path = self.create_menu_path(menu)
         new_menu.update_path(menu_path)
         want_selected = len(new_menu)
-        for item in self.generate_game_items(menu_path):
-            new_menu.append(item)
+        self.append_game_items(new_menu, *self.game_items_query(menu_path))
         if len(new_menu) > want_selected:
             new_menu.set_selected_index(want_selected, immediate=True)
         new_menu.add_add_item()
@@ -1,5 +1,6 @@
 from arcade.glui.animation import AnimateValueBezier
 from arcade.glui.navigatable import Navigatable
+from arcade.glui.render import Render
 from arcade.glui.state import State
 from arcade.glui.topmenu import TopMenu
 from fsbc.application import app
@@ -23,6 +24,8 @@ class Menu(Navigatable):
         self.configuration_index = 0
         self.top_menu_transition = 1.0
         self.search_text = ""
+        # returns the next items, see set_more_items
+        self.more_items = None
 
     def use_game_center_item(self):
         return app.settings["game-center:top-logo"] != "0"
@@ -69,6 +72,23 @@ class Menu(Navigatable):
     def remove(self, item):
         self.items.remove(item)
 
+    def set_more_items(self, function):
+        """Sets a function returning the next items of the menu (an empty
+        list when there are no more). The items are loaded one call per
+        frame, and all at once when the selection moves past the end."""
+        self.more_items = function
+
+    def load_more_items(self):
+        """Appends the next items. Returns False if there are no more."""
+        if self.more_items is None:
+            return False
+        items = self.more_items()
+        if not items:
+            self.more_items = None
+            return False
+        self.items.extend(items)
+        return True
+
     def reset_position(self):
         self.position = self._selected_index
         self.configuration_index = 0
@@ -98,6 +118,10 @@ class Menu(Navigatable):
         return self.position
 
     def set_selected_index(self, index, immediate=False):
+        if index < 0 or index >= len(self.items):
+            # wrapping around, so the last item must be known
+            while self.load_more_items():
+                pass
         self._selected_index = index
         if immediate:
             self.reset_position()
@@ -134,7 +158,9 @@ class Menu(Navigatable):
         pass
 
     def update(self):
-        pass
+        if self.load_more_items():
+            # request another frame to continue loading
+            Render.get().dirty = True
 
     def render_transparent(self, data):
         pass
@@ -530,8 +530,7 @@ def create_search_results_menu(text):
     #     args.append("%{0}%".format(word))
     # clause = " ".join(clause)
     terms = GameNameUtil.extract_search_terms(text.lower())
-    for item in MenuItem.create_game_items(terms):
-        new_menu.append(item)
+    MenuItem.append_game_items(new_menu, terms)
     if len(new_menu) == 0:
         new_menu.append(NoItem("No Search Results"))
     # if hasattr(current_menu, "search_text"):
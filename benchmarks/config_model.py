@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Measures the time to update the config browser model after a single
+config key has changed: rebuilding it from scratch (expand_config and
+create_model, like before), and updating ReactiveModel incrementally.
+
+Usage: python3 benchmarks/config_model.py [iterations]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# same workaround as in launcher.apps
+import fstd.typing
+sys.modules["typing"] = fstd.typing
+
+from launcher.ui.config.expand import AbstractExpandFunctions, \
+    expand_config
+from launcher.ui.config.model import ImplicitConfig, ReactiveModel, \
+    create_model, normalize
+
+
+class ExpandFunctions(AbstractExpandFunctions):
+    """Same as in launcher.ui.config.browser (which imports the rest of
+    the launcher)."""
+
+    @staticmethod
+    def matches(a, b):
+        a = normalize(a)
+        if isinstance(b, list):
+            for b_item in b:
+                if a == normalize(b_item):
+                    return True
+            return False
+        return a == normalize(b)
+
+    @staticmethod
+    def lower(s):
+        return s.lower()
+
+
+class Values(dict):
+
+    def __getitem__(self, key):
+        return self.get(key, "")
+
+
+CONFIG = {
+    "amiga_model": "A1200",
+    "accelerator": "blizzard-1260",
+    "fast_memory": "8192",
+    "zorro_iii_memory": "65536",
+    "graphics_card": "picasso-iv-z3",
+    "sound_card": "toccata",
+    "bsdsocket_library": "1",
+    "joystick_port_2_mode": "joystick",
+    "floppy_drive_0": "Disk 1.adf",
+    "floppy_drive_1": "Disk 2.adf",
+}
+
+CHANGES = [
+    ("window_width", ["800", "1024"]),
+    ("floppy_drive_0", ["Disk 1.adf", "Disk 3.adf"]),
+    ("chip_memory", ["2048", "1024"]),
+    ("amiga_model", ["A1200", "A4000/040"]),
+]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    config = Values(CONFIG)
+    settings = Values()
+    functions = ExpandFunctions()
+    reactive_model = ReactiveModel(config, settings, functions)
+    for key, values in CHANGES:
+        t = time.perf_counter()
+        for i in range(iterations):
+            config[key] = values[i % 2]
+            implicit = ImplicitConfig(config, settings)
+            expand_config(implicit, functions)
+            create_model(implicit)
+        full = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in range(iterations):
+            config[key] = values[(i + 1) % 2]
+            reactive_model.update([key])
+        incremental = time.perf_counter() - t
+        print("{0:>15}: full {1:6.3f} ms  incremental {2:6.3f} ms".format(
+            key, full * 1000 / iterations, incremental * 1000 / iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Measures query throughput and latency of reader threads while another
+thread is writing to the same database, for each journal mode.
+
+Usage: python3 benchmarks/database_concurrency.py [seconds] [readers]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fsbc.settings
+from fsgs.BaseDatabase import BaseDatabase
+
+
+class BenchmarkDatabase(BaseDatabase):
+
+    path = ""
+
+    @classmethod
+    def get_path(cls):
+        return cls.path
+
+    @classmethod
+    def get_version(cls):
+        return 1
+
+    def __del__(self):
+        pass
+
+    def update_database_to_version_1(self):
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT)")
+        cursor.execute("CREATE INDEX item_name ON item(name)")
+
+
+def writer(duration, stats):
+    database = BenchmarkDatabase(BaseDatabase.SENTINEL)
+    cursor = database.cursor()
+    end = time.monotonic() + duration
+    count = 0
+    while time.monotonic() < end:
+        # Long write transactions, similar to a file scan.
+        for i in range(1000):
+            cursor.execute("INSERT INTO item (name) VALUES (?)",
+                           ("item {0}".format(count),))
+            count += 1
+        database.commit()
+    stats["writes"] = count
+
+
+def reader(duration, stats):
+    database = BenchmarkDatabase(BaseDatabase.SENTINEL)
+    cursor = database.cursor()
+    end = time.monotonic() + duration
+    count = 0
+    latencies = []
+    errors = 0
+    while time.monotonic() < end:
+        t = time.monotonic()
+        try:
+            cursor.execute(
+                "SELECT count(*) FROM item WHERE name >= ? AND name < ?",
+                ("item 1", "item 2"))
+            cursor.fetchone()
+        except Exception:
+            errors += 1
+        latencies.append(time.monotonic() - t)
+        count += 1
+    stats.setdefault("reads", []).append(count)
+    stats.setdefault("latencies", []).extend(latencies)
+    stats["errors"] = stats.get("errors", 0) + errors
+
+
+def run(journal_mode, duration, readers):
+    fsbc.settings.set("database_journal_mode", journal_mode)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        BenchmarkDatabase.path = os.path.join(temp_dir, "Benchmark.sqlite")
+        BenchmarkDatabase(BaseDatabase.SENTINEL).init()
+        stats = {}
+        threads = [threading.Thread(target=writer, args=(duration, stats))]
+        for _ in range(readers):
+            threads.append(threading.Thread(
+                target=reader, args=(duration, stats)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(temp_dir)
+    latencies = sorted(stats["latencies"])
+    print("{0:8} writes/s {1:8.0f}  reads/s {2:8.0f}  "
+          "p50 {3:6.2f} ms  p99 {4:7.2f} ms  max {5:7.2f} ms  "
+          "errors {6}".format(
+              journal_mode, stats["writes"] / duration,
+              sum(stats["reads"]) / duration,
+              latencies[len(latencies) // 2] * 1000,
+              latencies[len(latencies) * 99 // 100] * 1000,
+              latencies[-1] * 1000, stats["errors"]))
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    settings_dir = tempfile.mkdtemp()
+    try:
+        fsbc.settings.set_path(os.path.join(settings_dir, "Settings.ini"))
+        for journal_mode in ["delete", "wal"]:
+            run(journal_mode, duration, readers)
+    finally:
+        shutil.rmtree(settings_dir)
+
+
+if __name__ == "__main__":
+    main()
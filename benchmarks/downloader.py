@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Measures Downloader throughput against a local HTTP server which stands
+in for the file server. The server adds a fixed latency to each request
+(like a remote server would) and can drop connections in the middle of
+responses, to exercise resuming. Files are fetched one by one with a new
+connection each (like urlopen), and then with Downloader's connection
+pool, sequentially and in parallel.
+
+Usage: python3 benchmarks/downloader.py [files] [KiB per file]
+                                        [latency ms] [drop probability]
+"""
+import hashlib
+import http.server
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+BASE_DIR = tempfile.mkdtemp(prefix="fs-uae-benchmark-")
+os.environ["FS_UAE_BASE_DIR"] = BASE_DIR
+
+# same workaround as in launcher.apps
+import fstd.typing
+sys.modules["typing"] = fstd.typing
+
+import fsgs.Downloader
+from fsgs.Downloader import Downloader
+
+
+class FileServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, files, latency, drop_probability):
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+        self.files = files
+        self.latency = latency
+        self.drop_probability = drop_probability
+        self.connections = 0
+        self.requests = 0
+        self.resumed = 0
+        self.drops = 0
+
+
+class FileRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        sha1 = self.path.split("/")[-2]
+        data = self.server.files.get(sha1)
+        if data is None:
+            self.send_error(404)
+            return
+        # the served data can differ from the SHA-1 in the URL
+        etag = '"{0}"'.format(hashlib.sha1(data).hexdigest())
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if self.headers.get("If-Range", etag) != etag:
+            # changed since the partial data was received
+            range_header = ""
+        if range_header.startswith("bytes="):
+            start = int(range_header[6:].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.server.resumed += 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if random.random() < self.server.drop_probability:
+            # send part of the data and drop the connection
+            self.server.drops += 1
+            self.wfile.write(data[start:start + (len(data) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+def fetch_with_urlopen(files, url_format, dest_dir):
+    for sha1 in files:
+        with urlopen(url_format.format(sha1, "file")) as f:
+            data = f.read()
+        assert hashlib.sha1(data).hexdigest() == sha1
+        with open(os.path.join(dest_dir, sha1), "wb") as f:
+            f.write(data)
+
+
+def fetch_with_downloader(files, dest_dir, max_workers):
+    Downloader.install_files_by_sha1(
+        [(sha1, "file", os.path.join(dest_dir, sha1)) for sha1 in files],
+        max_workers)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 64 * 1024
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+    drop_probability = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    files = {}
+    for _ in range(count):
+        data = os.urandom(size)
+        files[hashlib.sha1(data).hexdigest()] = data
+    server = FileServer(files, latency, 0.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_format = "http://127.0.0.1:{0}/s/sha1/{{0}}/{{1}}".format(
+        server.server_address[1])
+    Downloader.sha1_url_format = url_format
+    print("files: {0}  size: {1} KiB  latency: {2:.0f} ms  drops: {3}".format(
+        count, size // 1024, latency * 1000, drop_probability))
+
+    cache_dir = os.path.join(BASE_DIR, "Cache", "Downloads")
+    runs = [("urlopen, sequential", None), ("pool, sequential", 1),
+            ("pool, 4 workers", 4), ("pool, 8 workers", 8)]
+    for name, max_workers in runs:
+        dest_dir = tempfile.mkdtemp(dir=BASE_DIR)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        fsgs.Downloader.connection_pool.close()
+        server.connections = server.requests = server.drops = 0
+        server.drop_probability = drop_probability if max_workers else 0.0
+        t = time.perf_counter()
+        if max_workers is None:
+            fetch_with_urlopen(files, url_format, dest_dir)
+        else:
+            fetch_with_downloader(files, dest_dir, max_workers)
+        elapsed = time.perf_counter() - t
+        for sha1 in files:
+            with open(os.path.join(dest_dir, sha1), "rb") as f:
+                assert hashlib.sha1(f.read()).hexdigest() == sha1
+        print("{0:>20}: {1:6.2f} s  {2:6.1f} MiB/s  {3:3d} connections "
+              "{4:3d} requests {5:3d} dropped".format(
+                  name, elapsed, count * size / elapsed / (1024 * 1024),
+                  server.connections, server.requests, server.drops))
+    server.shutdown()
+    shutil.rmtree(BASE_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Measures the frame jitter of the netplay server's frame clock. Runs many
+frame clocks in one event loop (like the server does for concurrent games)
+and reports how late the ticks were, and the CPU time used, with timerfd
+and with event loop timers.
+
+Usage: python3 benchmarks/frame_clock.py [clocks] [seconds] [pal|ntsc]
+"""
+import asyncio
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from launcher.server.frame_clock import FrameClock, JitterHistogram, \
+    parse_frame_rate
+
+
+async def run_clock(clock, seconds):
+    clock.start()
+    uses_timerfd = clock.uses_timerfd
+    try:
+        for _ in range(int(seconds * clock.frame_rate)):
+            await clock.tick()
+    finally:
+        clock.close()
+    return uses_timerfd
+
+
+async def run_clocks(count, seconds, frame_rate, use_timerfd):
+    clocks = [FrameClock(frame_rate, use_timerfd) for _ in range(count)]
+    results = await asyncio.gather(
+        *[run_clock(clock, seconds) for clock in clocks])
+    return clocks, all(results)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    frame_rate = parse_frame_rate(sys.argv[3] if len(sys.argv) > 3 else "pal")
+    print("clocks: {0}  seconds: {1}  frame rate: {2}".format(
+        count, seconds, frame_rate))
+    for use_timerfd in [True, False]:
+        cpu_1 = cpu_time()
+        clocks, used_timerfd = asyncio.run(run_clocks(
+            count, seconds, frame_rate, use_timerfd))
+        cpu_2 = cpu_time()
+        jitter = JitterHistogram()
+        for clock in clocks:
+            jitter.merge(clock.jitter)
+        if use_timerfd and not used_timerfd:
+            print("\ntimerfd is not available")
+            continue
+        print("\n{0}: {1}".format(
+            "timerfd" if use_timerfd else "loop timers", jitter.summary()))
+        print("cpu: {0:.2f} s ({1:.1f}% of one core)".format(
+            cpu_2 - cpu_1, 100 * (cpu_2 - cpu_1) / seconds))
+        print(jitter.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Measures Database.find_games_new on a synthetic catalogue, for the
+first result page and for the full result.
+
+Usage: python3 benchmarks/game_search.py [games]
+"""
+import contextlib
+import gc
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fsbc.settings
+from fsbc.application import Application
+from fsgs.Database import Database
+
+SEARCHES = [
+    "",
+    "lo",
+    "platform:amiga",
+    "platform:c64",
+    "year:1990 platform:cd32",
+    "letter:q",
+    "ka platform:amiga",
+    "a b c",
+]
+
+
+class BenchmarkDatabase(Database):
+
+    path = ""
+
+    @classmethod
+    def get_path(cls):
+        return cls.path
+
+    def __del__(self):
+        pass
+
+
+def populate(database, count):
+    random.seed(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(random.choice(letters)
+                     for _ in range(random.randint(3, 9)))
+             for _ in range(count // 5)]
+    platforms = ["amiga"] * 8 + ["cd32", "c64", "nes"]
+    cursor = database.cursor()
+    for game_id in range(1, count + 1):
+        name = " ".join(random.choice(words) for _ in range(3))
+        platform = random.choice(platforms)
+        year = random.randint(1985, 1999)
+        cursor.execute(
+            "INSERT INTO game (id, uuid, name, platform, year, sort_key, "
+            "have) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (game_id, "uuid-{0}".format(game_id), name, platform, year,
+             name, 3))
+        terms = set(name.split())
+        terms.add("s:" + platform)
+        terms.add("y:" + str(year))
+        terms.add("l:" + name[0])
+        database.update_game_search_terms(game_id, terms)
+    database.commit()
+
+
+def measure(database, search, limit):
+    gc.collect()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Warm up (imports, page cache), then measure.
+        database.find_games_new(search, limit=limit)
+        t = time.perf_counter()
+        result = database.find_games_new(search, limit=limit)
+        elapsed = time.perf_counter() - t
+    return len(result), elapsed * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        fsbc.settings.set_path(os.path.join(temp_dir, "Settings.ini"))
+        Application("fs-uae-launcher")
+        BenchmarkDatabase.path = os.path.join(temp_dir, "Launcher.sqlite")
+        database = BenchmarkDatabase(BenchmarkDatabase.SENTINEL)
+        with contextlib.redirect_stdout(io.StringIO()):
+            populate(database, count)
+        print("search index:", database.has_search_index())
+        for search in SEARCHES:
+            first_count, first_time = measure(database, search, 50)
+            all_count, all_time = measure(database, search, None)
+            print("{0:28} first page {1:7.2f} ms   all {2:6} rows "
+                  "{3:8.2f} ms".format(repr(search), first_time, all_count,
+                                       all_time))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
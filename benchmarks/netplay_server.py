@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Load generator for the netplay game server. Starts the server in a
+subprocess and simulates clients for many concurrent games over loopback.
+Each simulated client joins a game, acknowledges every frame with memory
+and random checks, answers pings and sends input events.
+
+Usage: python3 benchmarks/netplay_server.py [games] [players] [seconds]
+                                            [rooms|ports] [input events]
+
+With rooms (the default), all games share one port and are selected by
+password. With ports, each game gets its own port. Input events is the
+average number of input events each client sends per frame (default 0.2),
+for example 6 players with heavy input traffic:
+
+    python3 benchmarks/netplay_server.py 20 6 10 rooms 2
+"""
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from launcher.server import game as server
+
+PORT = 25300
+EMULATOR_VERSION = b"BENCH000"
+MESSAGE = struct.Struct(">I")
+
+
+class SimulatedClient(asyncio.Protocol):
+
+    def __init__(self, password, input_events=0.2):
+        self.password = password
+        self.input_rate = input_events
+        self.transport = None
+        self.buffer = bytearray()
+        self.player = -1
+        self.frame_count = 0
+        self.last_frame_time = 0.0
+        self.intervals = []
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.input_events = 0
+        self.errors = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(
+            b"FSNP" + server.server_protocol_version +
+            MESSAGE.pack(self.password) + EMULATOR_VERSION +
+            b"\0\0\0" + b"\xff" + b"BOT" + MESSAGE.pack(0))
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        size = len(buffer)
+        replies = []
+        while size - offset >= 4:
+            message = MESSAGE.unpack_from(buffer, offset)[0]
+            command = (message & 0x7f000000) >> 24
+            if message & 0x80000000 and command == server.MESSAGE_TEXT:
+                length = message & 0x00ffffff
+                if size - offset < 4 + length:
+                    break
+                offset += 4 + length
+                continue
+            offset += 4
+            self.messages_received += 1
+            if message & 0x80000000:
+                if command == server.MESSAGE_PING:
+                    replies.append(message)
+                elif command == server.MESSAGE_PLAYERS:
+                    self.player = (message >> 8) & 0xff
+                elif command == server.MESSAGE_ERROR:
+                    self.errors.append(message & 0xffffff)
+            elif message & (1 << 30):
+                frame = message & 0x3fffffff
+                t = time.monotonic()
+                if self.last_frame_time:
+                    self.intervals.append(t - self.last_frame_time)
+                self.last_frame_time = t
+                self.frame_count += 1
+                check = (frame * 2654435761) & 0xffffff
+                replies.append(message)
+                replies.append(server.MESSAGE_MEMCHECK_MASK | check)
+                replies.append(server.MESSAGE_RNDCHECK_MASK | check)
+                count = int(self.input_rate)
+                if random.random() < self.input_rate - count:
+                    count += 1
+                for _ in range(count):
+                    replies.append((1 << 29) | (self.player & 0xff) << 16 |
+                                   random.randint(0, 0xffff))
+            elif message & (1 << 29):
+                self.input_events += 1
+        del buffer[:offset]
+        if replies:
+            self.messages_sent += len(replies)
+            self.transport.write(
+                struct.pack(">{0}I".format(len(replies)), *replies))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def wait_for_server(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), 1.0) as s:
+                s.sendall(b"PING")
+                if s.recv(4) == b"PONG":
+                    return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("server did not start")
+
+
+async def query_status(port):
+    """Returns the server status from the instrumentation request."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"STAT")
+    data = await reader.read()
+    writer.close()
+    return json.loads(data.decode("UTF-8"))
+
+
+def process_cpu_time(pid):
+    """Returns user + system CPU time for a process, where /proc is
+    available."""
+    try:
+        with open("/proc/{0}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_clients(games, players, seconds, use_rooms, input_events,
+                      server_pid):
+    loop = asyncio.get_running_loop()
+    clients = []
+    for i in range(games):
+        if use_rooms:
+            port = PORT
+            password = server.create_game_password("room{0}".format(i))
+        else:
+            port = PORT + i
+            password = 0
+        for _ in range(players):
+            client = SimulatedClient(password, input_events)
+            await loop.create_connection(lambda: client, "127.0.0.1", port)
+            clients.append(client)
+    # only measure the steady state, after all clients have connected
+    for client in clients:
+        client.intervals = []
+        client.frame_count = 0
+        client.messages_received = 0
+        client.messages_sent = 0
+    status_1 = await query_status(PORT)
+    cpu_1 = process_cpu_time(server_pid)
+    await asyncio.sleep(seconds)
+    cpu_2 = process_cpu_time(server_pid)
+    status = await query_status(PORT)
+    for client in clients:
+        client.transport.close()
+    for key in ["client_frames", "messages_sent", "writes"]:
+        status[key] -= status_1[key]
+    if cpu_1 is None or cpu_2 is None:
+        return clients, None, status
+    return clients, cpu_2 - cpu_1, status
+
+
+def main():
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+    use_rooms = (sys.argv[4] if len(sys.argv) > 4 else "rooms") == "rooms"
+    input_events = float(sys.argv[5]) if len(sys.argv) > 5 else 0.2
+
+    args = [sys.executable, "-c",
+            "import sys; sys.path.insert(0, sys.argv[1]); "
+            "from launcher.server.game import main; main()",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+            "--port={0}".format(PORT), "--players={0}".format(players)]
+    if use_rooms:
+        args.append("--rooms=1")
+    else:
+        args.append("--games={0}".format(games))
+    process = subprocess.Popen(
+        args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(PORT)
+        if not use_rooms:
+            wait_for_server(PORT + games - 1)
+        usage_1 = resource.getrusage(resource.RUSAGE_SELF)
+        clients, server_cpu, status = asyncio.run(run_clients(
+            games, players, seconds, use_rooms, input_events, process.pid))
+        usage_2 = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        process.terminate()
+        process.wait()
+    if server_cpu is None:
+        # includes server startup
+        server_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server_cpu = server_usage.ru_utime + server_usage.ru_stime
+    client_cpu = (usage_2.ru_utime + usage_2.ru_stime -
+                  usage_1.ru_utime - usage_1.ru_stime)
+
+    intervals = []
+    for client in clients:
+        intervals.extend(client.intervals)
+    frame_rates = sorted(client.frame_count / seconds for client in clients)
+    errors = sum(len(client.errors) for client in clients)
+    received = sum(client.messages_received for client in clients)
+    sent = sum(client.messages_sent for client in clients)
+    print("games: {0}  players: {1}  seconds: {2}  mode: {3}  "
+          "input events/frame: {4}".format(
+              games, players, seconds, "rooms" if use_rooms else "ports",
+              input_events))
+    print("frames/s per client: min {0:.1f}  median {1:.1f}".format(
+        frame_rates[0], percentile(frame_rates, 0.5)))
+    print("frame interval ms: p50 {0:.2f}  p99 {1:.2f}  max {2:.2f}".format(
+        percentile(intervals, 0.5) * 1000, percentile(intervals, 0.99) * 1000,
+        max(intervals or [0.0]) * 1000))
+    print("messages: {0} received, {1} sent  errors: {2}".format(
+        received, sent, errors))
+    sessions = status["sessions"]
+    print("verification lag frames: max {0}  desyncs: {1}".format(
+        max([session["verification_lag"] for session in sessions] or [0]),
+        len(status["desyncs"])))
+    print("server: {0:.0f} messages/s  {1:.2f} writes per client frame".format(
+        status["messages_sent"] / seconds,
+        status["writes"] / max(1, status["client_frames"])))
+    print("server cpu: {0:.2f} s ({1:.0f}% of one core)  "
+          "client cpu: {2:.2f} s".format(
+              server_cpu, 100 * server_cpu / seconds, client_cpu))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Measures main-thread time spent dispatching signals when a worker thread
+changes many config keys at once (like loading a configuration from a
+task). Listener objects stand in for UI widgets listening to the config
+signal. The main thread runs a minimal event loop in place of fsui.
+
+Usage: python3 benchmarks/signal_dispatch.py [keys] [rounds] [listeners]
+
+Each round notifies all keys, so with more than one round, the same keys
+change several times before the main thread gets to run.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# same workaround as in launcher.apps
+import fstd.typing
+sys.modules["typing"] = fstd.typing
+
+from fsbc.signal import Signal
+
+
+class ConfigListener(object):
+
+    def __init__(self):
+        self.values = {}
+        self.calls = 0
+
+    def on_config(self, key, value):
+        self.calls += 1
+        self.values[key] = value
+
+
+def run(keys, rounds, listener_count, merge):
+    Signal.merge_notifications = merge
+    callbacks = queue.Queue()
+    scheduled = [0]
+
+    def call_after(function):
+        scheduled[0] += 1
+        callbacks.put(function)
+
+    Signal.call_after = call_after
+    listeners = [ConfigListener() for _ in range(listener_count)]
+    for listener in listeners:
+        Signal("config").connect(listener)
+
+    def worker():
+        for i in range(rounds):
+            for j in range(keys):
+                Signal("config").notify("key_{0}".format(j), str(i))
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    t = time.perf_counter()
+    while True:
+        try:
+            function = callbacks.get_nowait()
+        except queue.Empty:
+            break
+        function()
+    elapsed = time.perf_counter() - t
+    for listener in listeners:
+        assert listener.values["key_0"] == str(rounds - 1)
+        Signal("config").disconnect(listener)
+    Signal.call_after = None
+    Signal.merge_notifications = True
+    return elapsed, scheduled[0], listeners[0].calls
+
+
+def main():
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    listener_count = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    print("keys: {0}  rounds: {1}  listeners: {2}".format(
+        keys, rounds, listener_count))
+    for name, merge in [("unmerged", False), ("merged", True)]:
+        elapsed, scheduled, calls = run(keys, rounds, listener_count, merge)
+        print("{0:>9}: {1:7.2f} ms main thread  {2:5d} flushes scheduled  "
+              "{3:5d} calls per listener".format(
+                  name, elapsed * 1000, scheduled, calls))
+
+
+if __name__ == "__main__":
+    main()
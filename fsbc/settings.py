@@ -1,17 +1,31 @@
+import io
 import os
-import shutil
 import sys
 import atexit
+import threading
 from configparser import ConfigParser, NoSectionError
+from contextlib import contextmanager
+from uuid import uuid4
 
 import fsboot
 from .signal import Signal
 # noinspection PyUnresolvedReferences
-from typing import Dict, Tuple
+from typing import Any, Dict, Tuple
 
 
 class Settings(object):
+    """Application settings.
+
+    Changes are saved automatically (in addition to when the application
+    exits), debounced so that many changes in a short time result in one
+    write, save_delay seconds after the last change. The settings file is
+    only rewritten when the content changes.
+    """
+
     _instance = None
+    # seconds to wait after a change before saving, None to only save
+    # explicitly and at exit
+    save_delay = 2.0
 
     @classmethod
     def instance(cls):
@@ -24,10 +38,19 @@ class Settings(object):
         self.app = app
         self.path = path
         self.values = {}  # type: Dict[str, str]
+        # values for other sections than settings, as "section/key"; written
+        # back when saving without extra values
+        self.extra = {}  # type: Dict[str, str]
         self._provider = SettingsProvider()
         self._loaded = False
         self._loading = False
         self._atexit_registered = False
+        # values before the first change in the current batch, by key
+        self._batch_old_values = {}  # type: Dict[str, Any]
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+        self._save_timer = None  # type: Any
+        self._saved_data = None  # type: str
 
     def set_path(self, path):
         self.path = path
@@ -46,13 +69,19 @@ class Settings(object):
         if self[key] == value:
             self.log_key_value(key, value, extra="(unchanged)")
             return
-        if not self._loading and not self._atexit_registered:
-            print("[SETTINGS] Register atexit save path =", self.path)
-            atexit.register(self.save)
-            self._atexit_registered = True
+        if not self._loading:
+            if not self._atexit_registered:
+                print("[SETTINGS] Register atexit save path =", self.path)
+                atexit.register(self.save)
+                self._atexit_registered = True
+            self.schedule_save()
         self.log_key_value(key, value)
-        self.values[key] = value
-        Signal("setting").notify(key, value)
+        with self.batch():
+            # the values can be saved from the save timer thread
+            with self._lock:
+                self._batch_old_values.setdefault(
+                    key, self.values.get(key, ""))
+                self.values[key] = value
 
     def __getitem__(self, key: str):
         return self.get(key)
@@ -60,20 +89,72 @@ class Settings(object):
     def __setitem__(self, key: str, value: str) -> None:
         self.set(key, value)
 
+    @contextmanager
+    def batch(self):
+        """Groups changes into one transaction. Listeners are notified when
+        the outermost batch ends, in one dispatch, and only for keys whose
+        values differ from the values before the batch."""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            changes = []
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    for key, old_value in self._batch_old_values.items():
+                        value = self.values.get(key, "")
+                        if value != old_value:
+                            changes.append((key, value))
+                    self._batch_old_values = {}
+            Signal("setting").notify_all(sorted(changes))
+
     def load(self, force=False):
         # print("[SETTINGS] Load", self)
         if (not self._loaded) or force:
             try:
                 self._loading = True
-                self._provider.load(self)
+                with self.batch():
+                    self._provider.load(self)
             finally:
                 self._loading = False
         self._loaded = True
         # print("[SETTINGS] Loaded, path is", self.path)
 
+    def schedule_save(self) -> None:
+        """Saves the settings save_delay seconds from now, unless changed
+        again before then (then the save is postponed)."""
+        if self.save_delay is None:
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(
+                self.save_delay, self._save_scheduled)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _save_scheduled(self):
+        with self._lock:
+            if self._save_timer is not threading.current_thread():
+                # rescheduled or saved explicitly meanwhile
+                return
+            self._save_timer = None
+        try:
+            self.save()
+        except Exception as e:
+            print("[SETTINGS] Error saving", repr(e))
+
     def save(self, extra: Dict[str, str]=None) -> None:
-        print("[SETTINGS] Save", self)
-        self._provider.save(self, extra)
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if extra is not None:
+                self.extra = dict(extra)
+            print("[SETTINGS] Save", self)
+            self._provider.save(self, self.extra)
 
     def log_key_value(self, key, value, extra=""):
         if "username" in key or "password" in key or "auth" in key \
@@ -110,6 +191,13 @@ class SettingsProvider:
         except Exception as e:
             print("[SETTINGS] Error loading", repr(e))
             return
+        extra = {}
+        for section in cp.sections():
+            if section == "settings":
+                continue
+            for key in cp.options(section):
+                extra[section + "/" + key] = cp.get(section, key)
+        settings.extra = extra
         try:
             keys = cp.options("settings")
         except NoSectionError:
@@ -134,8 +222,7 @@ class SettingsProvider:
             settings.set(key, values[key])
 
     def save(self, settings, extra=None):
-        partial_path = settings.path + ".partial"
-        print("[SETTINGS] Writing to", partial_path)
+        partial_path = "{0}.{1}.partial".format(settings.path, uuid4())
 
         save_values = {}  # type: Dict[Tuple[str, str], str]
         for key, value in settings.values.items():
@@ -166,12 +253,22 @@ class SettingsProvider:
                 cp.add_section(section)
             cp.set(section, key, value)
 
+        f = io.StringIO()
+        cp.write(f)
+        data = f.getvalue()
+        if data == settings._saved_data and os.path.exists(settings.path):
+            print("[SETTINGS] Unchanged, not writing", settings.path)
+            return
+        print("[SETTINGS] Writing to", partial_path)
         if not os.path.exists(os.path.dirname(partial_path)):
             os.makedirs(os.path.dirname(partial_path))
         with open(partial_path, "w", encoding="UTF-8", newline="\n") as f:
-            cp.write(f)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
         print("[SETTINGS] Moving to", settings.path)
-        shutil.move(partial_path, settings.path)
+        os.replace(partial_path, settings.path)
+        settings._saved_data = data
 
 
 def get(key: str) -> str:
@@ -1,68 +1,274 @@
-import sys
+"""
+Read-only access to 7z archives.
+
+Archives are read in-process with libarchive (the libarchive-c module) when
+it is available. Otherwise the 7z executable is used. With both backends,
+members are streamed in chunks instead of being read into memory, and
+iter_members reads all members in one pass over the archive (one process
+for the 7z backend), which is much faster than opening members one by one
+for solid archives.
+"""
+import io
+import shutil
 import subprocess
-from distutils.spawn import find_executable
+import time
+import traceback
+
+try:
+    import libarchive
+except ImportError:
+    libarchive = None
 
 try:
-    seven_zip_exe = find_executable(str("7z"))
+    seven_zip_exe = shutil.which("7z")
 except Exception:
     seven_zip_exe = None
 
+CHUNK_SIZE = 65536
+
+
+class SevenZipInfo:
+
+    def __init__(self, filename, file_size=0, mtime=None, is_dir=False):
+        # Directory names end with a slash, like in zip files.
+        self.filename = filename
+        self.file_size = file_size
+        self.mtime = mtime
+        self.is_dir = is_dir
+
+    def __repr__(self):
+        return "<SevenZipInfo {0!r} size={1}>".format(
+            self.filename, self.file_size)
+
+
+class ChunkReader(io.RawIOBase):
+    """Raw stream which reads data from next_chunk (a function returning
+    bytes, and b"" at the end of the stream). on_close is called when the
+    stream is closed."""
+
+    def __init__(self, next_chunk, on_close=None):
+        io.RawIOBase.__init__(self)
+        self._next_chunk = next_chunk
+        self._on_close = on_close
+        self._pending = b""
+        self._offset = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset == len(self._pending):
+            if self._eof:
+                return 0
+            self._pending = self._next_chunk()
+            self._offset = 0
+            if not self._pending:
+                self._eof = True
+        count = min(len(buffer), len(self._pending) - self._offset)
+        buffer[:count] = self._pending[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._on_close is not None:
+                self._on_close()
+        finally:
+            io.RawIOBase.close(self)
+
+
+def parse_listing(output):
+    """Parses the output of 7z l -slt and returns a list of SevenZipInfo
+    objects, in archive order.
+
+    >>> infos = parse_listing(
+    ...     "Path = test.7z\\nType = 7z\\n\\n----------\\n"
+    ...     "Path = Dir\\nSize = 0\\nAttributes = D_ drwxr-xr-x\\n\\n"
+    ...     "Path = Dir/File.adf\\nSize = 901120\\n"
+    ...     "Modified = 2014-01-01 12:00:00.1234567\\n"
+    ...     "Attributes = A_ -rw-r--r--\\n\\n")
+    >>> [(i.filename, i.file_size, i.is_dir) for i in infos]
+    [('Dir/', 0, True), ('Dir/File.adf', 901120, False)]
+    """
+    infos = []
+    # the archive itself is described before the separator line
+    output = output.replace("\r\n", "\n").split("\n----------\n", 1)[-1]
+    for block in output.split("\n\n"):
+        values = {}
+        for line in block.split("\n"):
+            key, sep, value = line.partition(" = ")
+            if sep:
+                values[key.strip()] = value.strip()
+        if "Path" not in values:
+            continue
+        name = values["Path"].replace("\\", "/")
+        is_dir = values.get("Attributes", "").startswith("D") or \
+            values.get("Folder", "") == "+"
+        if is_dir:
+            name += "/"
+        try:
+            size = int(values.get("Size", "") or 0)
+        except ValueError:
+            size = 0
+        mtime = None
+        modified = values.get("Modified", "")
+        if modified:
+            try:
+                mtime = int(time.mktime(
+                    time.strptime(modified[:19], "%Y-%m-%d %H:%M:%S")))
+            except ValueError:
+                pass
+        infos.append(SevenZipInfo(name, size, mtime, is_dir))
+    return infos
+
 
 class SevenZipFile:
 
     def __init__(self, path, mode="r"):
-        if seven_zip_exe is None:
-            raise Exception("no 7z executable found")
-
         assert mode == "r"
         self.path = path
-
-        args = [seven_zip_exe, "l", "-slt", self.path]
-        for i, arg in enumerate(args):
-            args[i] = arg.encode(sys.getfilesystemencoding())
-        print(args)
-        p = subprocess.Popen(args, stdout=subprocess.PIPE)
-        output = p.stdout.read()
-        names = []
-        last_name = None
-        for line in output.split("\n"):
-            name = line.strip().decode("UTF-8")
-            print(name)
-            if name.startswith("Path = "):
-                last_name = name[7:]
-                # names.append(name)
-            elif name.startswith("Attributes = "):
-                assert last_name
-                if name.startswith("Attributes = D"):
-                    names.append(last_name + "/")
-                else:
-                    names.append(last_name)
-        # the first path is the name of the archive
-        self.names = names[1:]
+        self.infos = None
+        if libarchive is not None:
+            try:
+                self.infos = self._libarchive_infolist()
+            except Exception:
+                if seven_zip_exe is None:
+                    raise
+                traceback.print_exc()
+                print("SevenZipFile: libarchive failed, using 7z executable")
+            else:
+                self._backend = "libarchive"
+        if self.infos is None:
+            if seven_zip_exe is None:
+                raise Exception("no 7z executable found")
+            self.infos = self._process_infolist()
+            self._backend = "7z"
+        self.info_map = {}
+        for info in self.infos:
+            self.info_map[info.filename] = info
         # sort the name list so directory names are listed before contained
         # files
-        self.names.sort()
-        print(self.names)
-        status = p.wait()
-        if status != 0:
-            raise Exception("7z status code not 0")
+        self.names = sorted(self.info_map)
 
     def namelist(self):
         return self.names
 
+    def infolist(self):
+        """Returns SevenZipInfo objects for all members, in archive
+        order."""
+        return list(self.infos)
+
+    def getinfo(self, name):
+        try:
+            return self.info_map[name]
+        except KeyError:
+            raise KeyError("{0} not found in archive".format(name))
+
     def read(self, name):
-        args = [seven_zip_exe, "x", "-so", self.path, name]
-        for i, arg in enumerate(args):
-            args[i] = arg.encode(sys.getfilesystemencoding())
-        print(args)
-        p = subprocess.Popen(args, stdout=subprocess.PIPE)
+        with self.open(name) as f:
+            return f.read()
+
+    def open(self, name):
+        """Returns a buffered, chunked file object for the member name."""
+        self.getinfo(name)
+        if self._backend == "libarchive":
+            blocks = self._libarchive_blocks(name)
+            raw = ChunkReader(lambda: next(blocks, b""), blocks.close)
+        else:
+            process = self._process_extract([name])
+            raw = ChunkReader(
+                lambda: process.stdout.read(CHUNK_SIZE),
+                lambda: self._process_close(process))
+        return io.BufferedReader(raw, CHUNK_SIZE)
+
+    def iter_members(self):
+        """Yields (info, stream) for each file in the archive, in archive
+        order, reading the archive only once. Each stream is only valid
+        until the next member is yielded."""
+        if self._backend == "libarchive":
+            yield from self._libarchive_iter_members()
+        else:
+            yield from self._process_iter_members()
+
+    def _libarchive_infolist(self):
+        infos = []
+        with libarchive.file_reader(self.path) as archive:
+            for entry in archive:
+                name = entry.pathname.replace("\\", "/").rstrip("/")
+                if entry.isdir:
+                    name += "/"
+                mtime = int(entry.mtime) if entry.mtime else None
+                infos.append(SevenZipInfo(
+                    name, entry.size or 0, mtime, entry.isdir))
+        return infos
+
+    def _libarchive_blocks(self, name):
+        with libarchive.file_reader(self.path) as archive:
+            for entry in archive:
+                if entry.pathname.replace("\\", "/") == name:
+                    yield from entry.get_blocks(CHUNK_SIZE)
+                    return
+
+    def _libarchive_iter_members(self):
+        with libarchive.file_reader(self.path) as archive:
+            for entry, info in zip(archive, self.infos):
+                if info.is_dir:
+                    continue
+                blocks = entry.get_blocks(CHUNK_SIZE)
+                with ChunkReader(lambda: next(blocks, b"")) as stream:
+                    yield info, stream
+
+    def _process_infolist(self):
+        p = subprocess.Popen(
+            [seven_zip_exe, "l", "-slt", self.path], stdout=subprocess.PIPE)
         output = p.stdout.read()
         status = p.wait()
         if status != 0:
             raise Exception("7z status code not 0")
-        return output
+        return parse_listing(output.decode("UTF-8", errors="replace"))
 
-    def getinfo(self, name):
-        if name in self.names:
-            return {"name:": name}
-        raise KeyError("{0} not found in archive".format(name))
+    def _process_extract(self, names):
+        return subprocess.Popen(
+            [seven_zip_exe, "x", "-so", self.path] + names,
+            stdout=subprocess.PIPE)
+
+    @staticmethod
+    def _process_close(process, check=False):
+        process.stdout.close()
+        status = process.wait()
+        if check and status != 0:
+            raise Exception("7z status code not 0")
+
+    def _process_iter_members(self):
+        # Without member names, 7z extracts all files to stdout in archive
+        # order, so the listed sizes are used to split the output.
+        process = self._process_extract([])
+        completed = False
+        try:
+            for info in self.infos:
+                if info.is_dir:
+                    continue
+                remaining = [info.file_size]
+
+                def next_chunk():
+                    if remaining[0] == 0:
+                        return b""
+                    data = process.stdout.read(min(remaining[0], CHUNK_SIZE))
+                    if not data:
+                        raise Exception("unexpected end of 7z output")
+                    remaining[0] -= len(data)
+                    return data
+
+                with ChunkReader(next_chunk) as stream:
+                    yield info, stream
+                    # skip data not read by the consumer
+                    while next_chunk():
+                        pass
+            completed = True
+        finally:
+            if not completed:
+                process.kill()
+            self._process_close(process, check=completed)
@@ -1,5 +1,6 @@
 import threading
 import traceback
+from collections import OrderedDict
 from weakref import ref
 # noinspection PyUnresolvedReferences
 from typing import Dict, Function, List, Any, Tuple
@@ -39,6 +40,19 @@ class Listener(object):
             self.instance = None
             self.function = ref(listener)
 
+    def resolve(self):
+        """Returns the listener as a callable (a bound method for methods),
+        or None if the listener no longer exists."""
+        function = self.function()
+        if function is None:
+            return None
+        if self.instance is None:
+            return function
+        instance = self.instance()
+        if instance is None:
+            return None
+        return function.__get__(instance)
+
     def __call__(self, *args, **kwargs):
         if self.instance is not None:
             # noinspection PyCallingNonCallable
@@ -60,14 +74,53 @@ class Listener(object):
 
 
 class Signal:
+    """Named signal. Notifications from the main thread are dispatched to
+    the listeners right away. Notifications from other threads are queued
+    and dispatched on the main thread by one flush, scheduled with
+    call_after when the first notification is queued. Queued notifications
+    for the same signal and key (see keyed_signals) are merged, so only the
+    latest value for each key is dispatched.
+
+    >>> values = []
+    >>> def on_config(key, value):
+    ...     values.append((key, value))
+    >>> Signal("fsgs:config").connect(on_config)
+    >>> scheduled = []
+    >>> Signal.call_after = scheduled.append
+    >>> for i in range(3):
+    ...     Signal.queue_notification("fsgs:config", ("a", i))
+    >>> Signal.queue_notification("fsgs:config", ("b", 0))
+    >>> len(scheduled)
+    1
+    >>> scheduled[0]()
+    >>> values
+    [('a', 2), ('b', 0)]
+    >>> Signal.call_after = None
+    >>> Signal("fsgs:config").disconnect(on_config)
+    """
 
     # FIXME: should have type Dict[str, Callable]
     # or # type_xxx: Dict[str, Function]
     signal_listeners = {}  # type: Dict[str, Any]
     # listeners = {}
-    notifications = []  # type: List[Tuple[str, Any]]
+    # queued notifications, merged by (signal, key)
+    notifications = OrderedDict()  # type: Dict[Any, Tuple[str, Any]]
+    notification_count = 0
+    flush_scheduled = False
     lock = threading.Lock()
 
+    # notifications for these signals have (key, value) arguments, queued
+    # notifications are merged by key
+    keyed_signals = {"config", "setting", "fsgs:config"}
+    # notifications for signals with these prefixes have only a value
+    # argument, queued notifications are merged by signal
+    value_signal_prefixes = ("fsgs:config:",)
+    # can be set to False to dispatch every queued notification
+    merge_notifications = True
+    # function used to schedule a call on the main thread, fsui.call_after
+    # is used if not set
+    call_after = None  # type: Function
+
     quit = None  # type: Signal
 
     def __init__(self, signal=None):
@@ -78,22 +131,13 @@ class Signal:
     def connect(self, function):
         listener = Listener(self.signal, function)
         with self.lock:
-            # if hasattr(listener, "__self__") and hasattr(listener,
-            # "__func__"):
-            #     listener = (listener.__self__, listener.__func__)
-
-            # Signal.signal_listeners.setdefault(
-            #     self.signal, []).append(ref(listener))
             Signal.signal_listeners.setdefault(
                 self.signal, []).append(listener)
 
-            # Signal.listeners.setdefault(listener, []).append(self.signal)
-
     def disconnect(self, function):
         listener = Listener(self.signal, function)
         with self.lock:
             listeners = Signal.signal_listeners[self.signal]
-            # print("removing listener", listener)
             for i, v in enumerate(listeners):
                 if v.function == listener.function and \
                         v.instance == listener.instance:
@@ -103,98 +147,134 @@ class Signal:
             if len(Signal.signal_listeners[self.signal]) == 0:
                 del Signal.signal_listeners[self.signal]
 
-            # Signal.listeners[listener].remove(self.signal)
-            # if len(Signal.listeners[listener]) == 0:
-            #     del Signal.listeners[listener]
-
-    # @classmethod
-    # def disconnect_all(cls, listener):
-    #     with Signal.lock:
-    #         for signal in Signal.listeners[listener]:
-    #             Signal.signal_listeners[signal].remove(listener)
-    #         del Signal.listeners[listener]
-
     def __call__(self, *args):
         self.notify(*args)
 
     def notify(self, *args):
         if threading.current_thread().ident == main_thread_id:
             Signal.process_signal(self.signal, *args)
-
         else:
-            with Signal.lock:
-                Signal.notifications.append((self.signal, args))
+            Signal.queue_notification(self.signal, args)
+
+    def notify_all(self, args_list):
+        """Notifies once for each argument tuple in args_list, dispatched
+        as one batch (from other threads, queued with one lock and one
+        scheduled flush)."""
+        if not args_list:
+            return
+        if threading.current_thread().ident == main_thread_id:
+            Signal.process_notifications(
+                [(self.signal, args) for args in args_list])
+        else:
+            Signal.queue_notifications(
+                [(self.signal, args) for args in args_list])
+
+    @classmethod
+    def merge_key(cls, signal, args):
+        if cls.merge_notifications:
+            if signal in cls.keyed_signals and args:
+                return signal, args[0]
+            if signal.startswith(cls.value_signal_prefixes):
+                return signal,
+        # not merged
+        cls.notification_count += 1
+        return cls.notification_count
+
+    @classmethod
+    def queue_notification(cls, signal, args):
+        """Queues a notification to be dispatched on the main thread, and
+        schedules a flush unless one is already pending."""
+        cls.queue_notifications([(signal, args)])
+
+    @classmethod
+    def queue_notifications(cls, notifications):
+        with cls.lock:
+            for signal, args in notifications:
+                key = cls.merge_key(signal, args)
+                if key in cls.notifications:
+                    # the latest value is dispatched, in the latest position
+                    del cls.notifications[key]
+                cls.notifications[key] = (signal, args)
+            if cls.flush_scheduled:
+                return
+            cls.flush_scheduled = True
+        cls.schedule_flush()
+
+    @classmethod
+    def schedule_flush(cls):
+        call_after = cls.call_after
+        if call_after is None:
             # FIXME: this is just a hack, fsui.call_after should be
             # replaced with an Application-specified callback function
             try:
                 fsui = __import__("fsui")
-                fsui.call_after(Signal.process_all_signals)
-            except AttributeError:
-                pass
+                call_after = fsui.call_after
+            except (ImportError, AttributeError):
+                # nothing will flush the queue, so the next notification
+                # must try to schedule a flush again
+                with cls.lock:
+                    cls.flush_scheduled = False
+                return
+        call_after(cls.process_all_signals)
 
     @classmethod
     def process_all_signals(cls):
         with Signal.lock:
+            Signal.flush_scheduled = False
             if len(Signal.notifications) == 0:
                 return
-            notifications = Signal.notifications[:]
-            Signal.notifications = []
-        # print(notifications)
+            notifications = list(Signal.notifications.values())
+            Signal.notifications = OrderedDict()
+        cls.process_notifications(notifications)
+
+    @classmethod
+    def process_notifications(cls, notifications):
+        # listeners are resolved once per signal for the whole batch
+        resolved = {}
         for signal, args in notifications:
-            remove_listeners = cls.process_signal(signal, *args)
-            if len(remove_listeners) > 0:
-                with Signal.lock:
-                    for listener in remove_listeners:
-                        print("FIXME: remove dead listener", listener)
-                        Signal.signal_listeners[signal].remove(listener)
-                    if len(Signal.signal_listeners[signal]) == 0:
-                        del Signal.signal_listeners[signal]
+            try:
+                listeners = resolved[signal]
+            except KeyError:
+                listeners = cls.resolve_listeners(signal)
+                resolved[signal] = listeners
+            for listener in listeners:
+                try:
+                    listener(*args)
+                except Exception:
+                    traceback.print_exc()
 
     @classmethod
-    def process_signal(cls, signal, *args):
-        # print(self.listeners.setdefault(signal, []))
-        remove_listeners = []
-        for listener_ref in Signal.signal_listeners.setdefault(signal, []):
-            # print(listener, signal, args)
-            # listener = listener_ref()
-            # if not listener:
-            #     # FIXME: remove reference
-            #     continue
-            listener = listener_ref
-            # print(signal, listener, listener.instance, listener.function)
+    def resolve_listeners(cls, signal):
+        """Returns callables for the listeners of signal, and removes
+        listeners which no longer exist."""
+        with Signal.lock:
+            listeners = list(Signal.signal_listeners.get(signal, []))
+        result = []
+        dead = []
+        for listener in listeners:
+            function = listener.resolve()
+            if function is None:
+                dead.append(listener)
+            else:
+                result.append(function)
+        if dead:
+            with Signal.lock:
+                current = Signal.signal_listeners.get(signal, [])
+                for listener in dead:
+                    print("FIXME: remove dead listener", listener)
+                    if listener in current:
+                        current.remove(listener)
+                if not current and signal in Signal.signal_listeners:
+                    del Signal.signal_listeners[signal]
+        return result
 
+    @classmethod
+    def process_signal(cls, signal, *args):
+        for listener in cls.resolve_listeners(signal):
             try:
-                # instance = listener.instance() if listener.instance else None
-                # function = listener.function()
-                # print(signal, instance, function)
-                # if function is None:
-                #     # FIXME: remove listener / dead listener
-                #     continue
-                #
-                # if instance is not None:
-                #     if signal == "config":
-                #         # FIXME: temporary hack for legacy code
-                #         instance.on_config(*args)
-                #         continue
-                #     elif signal == "setting":
-                #         # FIXME: temporary hack for legacy code
-                #         instance.on_setting(*args)
-                #         continue
-                #     try:
-                #         # FIXME: temporary hack for legacy code
-                #         func = getattr(instance, "on_" + signal + "_signal")
-                #     except AttributeError:
-                #         pass
-                #     else:
-                #         func(*args)
-                #         continue
-
-                result = listener(*args)
-                if not result:
-                    remove_listeners.append(listener)
+                listener(*args)
             except Exception:
                 traceback.print_exc()
-        return remove_listeners
 
 
 Signal.quit = Signal("quit")
@@ -1,5 +1,7 @@
 import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from .signal import Signal
 
 
@@ -113,3 +115,130 @@ class CurrentTaskProxy(object):
 
 null_task = Task("Null Task")
 current_task = CurrentTaskProxy()
+
+
+def run_in_task(task, function, *args):
+    """Calls function in the context of task, so current_task refers to it
+    in worker threads too."""
+    previous = getattr(local_tasks, "task", None)
+    local_tasks.task = task
+    try:
+        return function(*args)
+    finally:
+        if previous is None:
+            del local_tasks.task
+        else:
+            local_tasks.task = previous
+
+
+def parallel_map(function, items, max_workers=4):
+    """Calls function for each item on up to max_workers threads, in the
+    context of the current task, and returns the results in order. No new
+    items are started when the current task is stopped, or when a call
+    has raised an exception, which is then raised here.
+
+    >>> parallel_map(lambda x: x * x, [1, 2, 3])
+    [1, 4, 9]
+    """
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [function(item) for item in items]
+    task = current_task.task
+    failed = []
+
+    def call(item):
+        if failed or task.stop_flag:
+            return None
+        try:
+            return run_in_task(task, function, item)
+        except BaseException:
+            failed.append(True)
+            raise
+
+    with ThreadPoolExecutor(min(max_workers, len(items))) as executor:
+        futures = [executor.submit(call, item) for item in items]
+    return [future.result() for future in futures]
+
+
+class TaskGraph(object):
+    """Runs functions on a bounded thread pool as soon as the functions
+    they depend on have completed, in the context of the current task.
+    The time spent in each function is recorded in timings.
+
+    >>> graph = TaskGraph()
+    >>> order = []
+    >>> graph.add("b", lambda: order.append("b"), ["a"])
+    >>> graph.add("a", lambda: order.append("a"))
+    >>> graph.run()
+    >>> order
+    ['a', 'b']
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.nodes = []
+        self.timings = []
+
+    def add(self, name, function, depends=()):
+        self.nodes.append((name, function, list(depends)))
+
+    def run(self):
+        """Runs all functions. Functions are not started when the current
+        task is stopped. If a function raises an exception, the running
+        functions are completed and the exception is raised here."""
+        task = current_task.task
+        names = set(name for name, _, _ in self.nodes)
+        for name, _, depends in self.nodes:
+            for dependency in depends:
+                if dependency not in names:
+                    raise ValueError("{0} depends on unknown {1}".format(
+                        name, dependency))
+        pending = list(self.nodes)
+        done = set()
+        running = {}
+        start_time = time.perf_counter()
+
+        def call(name, function):
+            t = time.perf_counter()
+            try:
+                run_in_task(task, function)
+            finally:
+                self.timings.append(
+                    (name, t - start_time, time.perf_counter() - t))
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            error = None
+            while pending or running:
+                if error is None and not task.stop_flag:
+                    for node in list(pending):
+                        name, function, depends = node
+                        if all(d in done for d in depends):
+                            pending.remove(node)
+                            running[executor.submit(
+                                call, name, function)] = name
+                if not running:
+                    # stopped, failed, or a dependency cycle
+                    if pending and error is None and not task.stop_flag:
+                        raise ValueError("dependency cycle in task graph")
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(running.pop(future))
+                    if future.exception() is not None and error is None:
+                        error = future.exception()
+        if error is not None:
+            raise error
+
+    def report(self):
+        """Returns a text report with the start time and duration of each
+        function, and the total time."""
+        lines = []
+        total = 0.0
+        for name, start, duration in sorted(
+                self.timings, key=lambda x: x[1]):
+            lines.append(
+                "{0:<20} start {1:7.3f} s  duration {2:7.3f} s".format(
+                    name, start, duration))
+            total = max(total, start + duration)
+        lines.append("{0:<20} {1:7.3f} s".format("total", total))
+        return "\n".join(lines)
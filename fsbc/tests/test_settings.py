@@ -1,6 +1,8 @@
 import os
 import tempfile
 import fsbc.settings
+from fsbc.settings import Settings
+from fsbc.signal import Signal
 import nose.tools
 
 
@@ -37,6 +39,33 @@ def test_load_save():
     fsbc.settings.unload()
 
 
+def test_batch_notifies_changed_keys_once():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    settings = Settings(path=path)
+    settings.save_delay = None
+    changes = []
+
+    class Listener(object):
+        def on_setting(self, key, value):
+            changes.append((key, value))
+
+    listener = Listener()
+    settings.load()
+    Signal("setting").connect(listener)
+    try:
+        with settings.batch():
+            settings.set("a", "1")
+            settings.set("a", "2")
+            settings.set("b", "1")
+            settings.set("b", "")
+            nose.tools.assert_equals(changes, [])
+    finally:
+        Signal("setting").disconnect(listener)
+    nose.tools.assert_equals(changes, [("a", "2")])
+    os.unlink(path)
+
+
 def test_mypy():
     # from nose.plugins.skip import SkipTest
     # raise SkipTest()
@@ -13,3 +13,15 @@ def test_doctest():
     import doctest
     failure_count, test_count = doctest.testmod(fsbc.seven_zip_file)
     nose.tools.assert_equals(failure_count, 0)
+
+
+def test_chunk_reader():
+    chunks = [b"abc", b"defg"]
+    closed = []
+    reader = fsbc.seven_zip_file.ChunkReader(
+        lambda: chunks.pop(0) if chunks else b"", lambda: closed.append(1))
+    nose.tools.assert_equals(reader.read(2), b"ab")
+    nose.tools.assert_equals(reader.read(), b"cdefg")
+    nose.tools.assert_equals(reader.read(), b"")
+    reader.close()
+    nose.tools.assert_equals(closed, [1])
@@ -13,3 +13,74 @@ def test_doctest():
     import doctest
     failure_count, test_count = doctest.testmod(fsbc.signal)
     nose.tools.assert_equals(failure_count, 0)
+
+
+def test_queued_notifications_from_thread():
+    import threading
+    Signal = fsbc.signal.Signal
+    scheduled = []
+    received = []
+
+    def on_value(value):
+        received.append(value)
+
+    Signal("fsgs:config:test_key").connect(on_value)
+    Signal("test_event").connect(on_value)
+    Signal.call_after = scheduled.append
+    try:
+        def notify():
+            for i in range(5):
+                Signal("fsgs:config:test_key").notify(i)
+                Signal("test_event").notify("event {0}".format(i))
+        thread = threading.Thread(target=notify)
+        thread.start()
+        thread.join()
+        nose.tools.assert_equals(len(scheduled), 1)
+        scheduled[0]()
+    finally:
+        Signal.call_after = None
+        Signal("fsgs:config:test_key").disconnect(on_value)
+        Signal("test_event").disconnect(on_value)
+    # values for the same key are merged (into the latest position),
+    # events are not
+    nose.tools.assert_equals(received, [
+        "event 0", "event 1", "event 2", "event 3", 4, "event 4"])
+
+
+def test_queued_notifications_without_call_after():
+    import sys
+    import threading
+    Signal = fsbc.signal.Signal
+    scheduled = []
+    received = []
+
+    def on_event(value):
+        received.append(value)
+
+    def notify(value):
+        thread = threading.Thread(
+            target=Signal("test_event").notify, args=(value,))
+        thread.start()
+        thread.join()
+
+    Signal("test_event").connect(on_event)
+    saved_fsui = sys.modules.get("fsui")
+    # makes the fsui.call_after fallback raise ImportError
+    sys.modules["fsui"] = None
+    try:
+        notify("event 0")
+        nose.tools.assert_false(Signal.flush_scheduled)
+        Signal.call_after = scheduled.append
+        notify("event 1")
+        nose.tools.assert_equals(len(scheduled), 1)
+        scheduled[0]()
+    finally:
+        Signal.call_after = None
+        if saved_fsui is None:
+            del sys.modules["fsui"]
+        else:
+            sys.modules["fsui"] = saved_fsui
+        Signal("test_event").disconnect(on_event)
+    # the notification queued while no flush could be scheduled is
+    # dispatched by the next flush
+    nose.tools.assert_equals(received, ["event 0", "event 1"])
@@ -13,3 +13,36 @@ def test_doctest():
     import doctest
     failure_count, test_count = doctest.testmod(fsbc.task)
     nose.tools.assert_equals(failure_count, 0)
+
+
+def test_task_graph_dependencies():
+    graph = fsbc.task.TaskGraph(max_workers=4)
+    order = []
+    graph.add("c", lambda: order.append("c"), ["a", "b"])
+    graph.add("a", lambda: order.append("a"))
+    graph.add("b", lambda: order.append("b"), ["a"])
+    graph.run()
+    nose.tools.assert_equals(order, ["a", "b", "c"])
+    nose.tools.assert_equals(
+        sorted(name for name, _, _ in graph.timings), ["a", "b", "c"])
+
+
+def test_task_graph_error():
+    graph = fsbc.task.TaskGraph()
+    order = []
+
+    def fail():
+        raise ValueError("failed")
+
+    graph.add("a", fail)
+    graph.add("b", lambda: order.append("b"), ["a"])
+    nose.tools.assert_raises(ValueError, graph.run)
+    nose.tools.assert_equals(order, [])
+
+
+def test_parallel_map_current_task():
+    task = fsbc.task.Task("Test")
+    result = fsbc.task.run_in_task(
+        task, fsbc.task.parallel_map,
+        lambda x: (x, fsbc.task.current_task.task), range(8))
+    nose.tools.assert_equals(result, [(x, task) for x in range(8)])
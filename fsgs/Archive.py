@@ -1,5 +1,6 @@
 import os
 import io
+import time
 import traceback
 from fsbc.zipfile import ZipFile
 
@@ -52,6 +53,16 @@ class ZipHandler(object):
         else:
             return True
 
+    def iter_members(self):
+        # namelist and infolist are in the same order, namelist has the
+        # decoded names
+        for name, info in zip(self.zip.namelist(), self.zip.infolist()):
+            if info.is_dir():
+                continue
+            mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+            with self.zip.open(info) as stream:
+                yield name, info.file_size, mtime, stream
+
     # def encode_name(self, name):
     #     name = name.replace("\\", "/")
     #     name = name.replace("%5f", "\\")
@@ -84,8 +95,7 @@ class SevenZipHandler(object):
         return self.zip.read(name)
 
     def open(self, name):
-        data = self.zip.read(name)
-        return io.BytesIO(data)
+        return self.zip.open(name)
 
     def exists(self, name):
         try:
@@ -95,12 +105,17 @@ class SevenZipHandler(object):
         else:
             return True
 
+    def iter_members(self):
+        for info, stream in self.zip.iter_members():
+            yield info.filename, info.file_size, info.mtime, stream
+
 
 class LhaHandler(object):
 
     def __init__(self, path):
         self.path = path
         self.zip = LhaFile(self.path, "r")
+        self._names = None
 
     def list_files(self, sub_path):
         if sub_path:
@@ -118,18 +133,23 @@ class LhaHandler(object):
 
     def exists(self, name):
         name = self.encode_name(name)
-        items = self.zip.infolist()
-        for item in items:
-            if item.filename == name:
-                return True
-        return False
-
-        # try:
-        #     self.zip.getinfo(name)
-        # except KeyError:
-        #     return False
-        # else:
-        #     return True
+        if self._names is None:
+            self._names = set(item.filename for item in self.zip.infolist())
+        return name in self._names
+
+    def iter_members(self):
+        # LhaFile can only decompress whole members, so each member is
+        # read into memory, one at a time
+        for item in self.zip.infolist():
+            name = self.decode_name(item.filename)
+            if name.endswith("/") or name.endswith(os.sep):
+                continue
+            try:
+                mtime = int(time.mktime(item.date_time.timetuple()))
+            except Exception:
+                mtime = None
+            with io.BytesIO(self.zip.read(item.filename)) as stream:
+                yield name, item.file_size, mtime, stream
 
     def encode_name(self, name):
         name = name.replace("\\", "/")
@@ -168,12 +188,16 @@ class NullHandler(object):
     def open(self, path):
         return open(path, "rb")
 
+    def iter_members(self):
+        return iter(())
+
 
 class Archive(object):
 
     extensions = archive_extensions
 
     def __init__(self, path):
+        self.path = None
         self.path, self.sub_path = self.split_path(path)
         self._handler = None
 
@@ -184,7 +208,11 @@ class Archive(object):
         return os.path.dirname(path)
 
     def split_path(self, path):
-        print("split_path", path)
+        if self.path and path.startswith(self.path + "#/"):
+            # a member of this archive, the archive path is already known
+            # to be a file
+            parts = path[len(self.path) + 2:].replace("\\", "/").split("/")
+            return self.path, str(os.sep).join(parts)
         if "#/" in path:
             parts = path.rsplit("#/", 1)
             archive = parts[0]
@@ -235,6 +263,16 @@ class Archive(object):
             result.append(self.path + "#/" + item)
         return result
 
+    def iter_members(self):
+        """Yields (path, size, mtime, stream) for each file in the archive,
+        in archive order, using one archive handle. Paths are in the same
+        form as returned by list_files. Directory entries are skipped, and
+        each stream is only valid until the next member is yielded."""
+        if self.sub_path:
+            return
+        for name, size, mtime, stream in self.get_handler().iter_members():
+            yield self.path + "#/" + name, size, mtime, stream
+
     def exists(self, path):
         path, sub_path = self.split_path(path)
         # print(path, self.path)
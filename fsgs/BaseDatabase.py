@@ -15,6 +15,70 @@ def use_debug_cursor():
     return log_query_plans()
 
 
+# The memory and off journal modes are not accepted, since a crash during a
+# write transaction can then corrupt the database.
+JOURNAL_MODES = ["delete", "truncate", "persist", "wal"]
+SYNCHRONOUS_MODES = ["off", "normal", "full", "extra"]
+
+
+def journal_mode():
+    value = fsbc.settings.get("database_journal_mode").lower()
+    if value in JOURNAL_MODES:
+        return value
+    # WAL lets reader threads (UI, arcade, HTTP server) query the database
+    # while the scanner is writing to it.
+    return "wal"
+
+
+def synchronous_mode():
+    value = fsbc.settings.get("database_synchronous").lower()
+    if value in SYNCHRONOUS_MODES:
+        return value
+    # With WAL, normal is still safe against corruption and only risks
+    # losing the last transactions on power loss.
+    return "normal"
+
+
+def integer_setting(key, default):
+    try:
+        return int(fsbc.settings.get(key))
+    except ValueError:
+        return default
+
+
+def cache_size():
+    """Page cache size per connection, in KiB."""
+    return max(0, integer_setting("database_cache_size", 16384))
+
+
+def mmap_size():
+    """Size of memory-mapped I/O per connection, in MiB."""
+    return max(0, integer_setting("database_mmap_size", 256))
+
+
+def connect(path):
+    """Opens and configures a connection to the SQLite database at path.
+    The journal mode is persistent, the other pragmas are set per
+    connection."""
+    connection = sqlite3.connect(path, timeout=30.0)
+    # noinspection PyPropertyAccess
+    connection.row_factory = sqlite3.Row
+    cursor = connection.cursor()
+    mode = journal_mode()
+    cursor.execute("PRAGMA journal_mode = {0}".format(mode))
+    result = cursor.fetchone()[0]
+    if result.lower() != mode:
+        # For example, WAL does not work on network file systems.
+        print("could not set journal mode", mode, "for", path,
+              "(using {0})".format(result))
+    cursor.execute("PRAGMA synchronous = {0}".format(synchronous_mode()))
+    cursor.execute("PRAGMA cache_size = {0}".format(-cache_size()))
+    cursor.execute("PRAGMA mmap_size = {0}".format(mmap_size() * 1024 * 1024))
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+    return connection
+
+
 class ResetException(Exception):
     pass
 
@@ -60,18 +124,16 @@ class BaseDatabase(object):
         if self.connection:
             return
         path = self.get_path()
+        # The lock only serializes opening the database and upgrading the
+        # schema, the connections are used concurrently afterwards.
         with global_database_lock:
             try:
                 print("opening database", path)
-                self.connection = sqlite3.connect(path)
-                # noinspection PyPropertyAccess
-                self.connection.row_factory = sqlite3.Row
+                self.connection = connect(path)
                 self.updated_database_if_needed()
             except ResetException:
                 print("re-opening database", path)
-                self.connection = sqlite3.connect(path)
-                # noinspection PyPropertyAccess
-                self.connection.row_factory = sqlite3.Row
+                self.connection = connect(path)
                 self.updated_database_if_needed()
 
     def internal_cursor(self):
@@ -125,6 +187,9 @@ class BaseDatabase(object):
             self.connection.close()
             self.connection = None
             os.unlink(self.get_path())
+            for suffix in ["-wal", "-shm"]:
+                if os.path.exists(self.get_path() + suffix):
+                    os.unlink(self.get_path() + suffix)
             raise ResetException()
 
         if self.get_version() > version:
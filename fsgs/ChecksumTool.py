@@ -1,6 +1,10 @@
 import os
 import hashlib
+import sqlite3
+import traceback
+from fsbc.task import Task
 from fsgs.Archive import Archive
+from fsgs.FileDatabase import FileDatabase
 from fsgs.amiga.ROMManager import ROMManager
 
 
@@ -18,7 +22,7 @@ class ChecksumTool(object):
         # self.layout.add_spacer(6)
         # #self.center_on_parent()
 
-    def checksum(self, path):
+    def checksum(self, path, stop_check=None):
         print("checksum", repr(path))
         archive = Archive(path)
         if os.path.exists(path):
@@ -30,9 +34,62 @@ class ChecksumTool(object):
                 # file anyway
                 return ZERO_SHA1
 
+        return self.checksum_stream(archive.open(path), stop_check)
+
+    @staticmethod
+    def cached_checksum(path):
+        """Returns the SHA-1 for path from the checksum cache in the file
+        database, or None if not cached or the file has changed since.
+        Archive members are validated by the archive file."""
+        try:
+            st = os.stat(Archive(path).path)
+        except OSError:
+            return None
+        return FileDatabase.get_instance().get_checksum(
+            path, st.st_size, st.st_mtime_ns)
+
+    def checksum_cached(self, path, stop_check=None):
+        """Like checksum, but uses and updates the checksum cache in the
+        file database."""
+        sha1 = self.cached_checksum(path)
+        if sha1 is not None:
+            return sha1
+        st = os.stat(Archive(path).path)
+        sha1 = self.checksum(path, stop_check)
+        database = FileDatabase.get_instance()
+        try:
+            database.set_checksum(path, st.st_size, st.st_mtime_ns, sha1)
+            database.commit()
+        except sqlite3.Error:
+            # the checksum is still valid, it just is not cached
+            traceback.print_exc()
+            database.rollback()
+        return sha1
+
+    def checksum_many(self, paths):
+        """Returns a list of checksums for paths, like checksum. Files in
+        the same archive are checksummed in one pass over the archive."""
+        archive_members = {}
+        for path in paths:
+            archive = Archive(path)
+            if archive.sub_path:
+                archive_members.setdefault(archive.path, set()).add(path)
+        result = {}
+        for archive_path, members in archive_members.items():
+            if len(members) < 2:
+                continue
+            for name, _, _, stream in Archive(archive_path).iter_members():
+                if name in members:
+                    result[name] = self.checksum_stream(stream)
+        return [result[path] if path in result else self.checksum(path)
+                for path in paths]
+
+    @staticmethod
+    def checksum_stream(f, stop_check=None):
         s = hashlib.sha1()
-        f = archive.open(path)
         while True:
+            if stop_check is not None:
+                stop_check()
             data = f.read(65536)
             if not data:
                 break
@@ -42,4 +99,37 @@ class ChecksumTool(object):
     def checksum_rom(self, path):
         print("checksum_rom", repr(path))
         archive = Archive(path)
-        return ROMManager.decrypt_archive_rom(archive, path)["sha1"]
+        return ROMManager.decrypted_sha1(archive, path)
+
+
+class ChecksumTask(Task):
+    """Checksums files in the background, using the checksum cache. files
+    is a list of (key, path, is_rom) tuples. Unless the task is stopped,
+    on_result is called (on the task thread) with the task and a dict
+    mapping keys to checksums."""
+
+    def __init__(self, files, on_result):
+        Task.__init__(self, "Checksum Files")
+        self.files = files
+        self.on_result = on_result
+
+    def run(self):
+        checksum_tool = ChecksumTool()
+        results = {}
+        for key, path, is_rom in self.files:
+            self.stop_check()
+            self.set_progress(os.path.basename(path))
+            try:
+                if is_rom:
+                    sha1 = checksum_tool.checksum_rom(path)
+                else:
+                    sha1 = checksum_tool.checksum_cached(
+                        path, self.stop_check)
+            except Task.Stopped:
+                raise
+            except Exception:
+                traceback.print_exc()
+                continue
+            results[key] = sha1
+        self.stop_check()
+        self.on_result(self, results)
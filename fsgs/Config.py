@@ -1,5 +1,7 @@
 import sys
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from .ContextAware import ContextAware
 
 
@@ -8,6 +10,11 @@ class Config(ContextAware):
     def __init__(self, context):
         ContextAware.__init__(self, context)
         self.values = {}
+        # values before the first change in the current batch, by key
+        # (None for keys which were not set)
+        self._batch_old_values = {}
+        self._batch_depth = 0
+        self._batch_lock = threading.Lock()
 
     def copy(self):
         # return a defaultdict so lookups for unset keys return an empty string
@@ -20,10 +27,11 @@ class Config(ContextAware):
         return self.values.items()
 
     def clear(self):
-        for key in list(self.values.keys()):
-            value = self.values[key]
-            if value:
-                self.set(key, "")
+        with self.batch():
+            for key in list(self.values.keys()):
+                value = self.values[key]
+                if value:
+                    self.set(key, "")
         # for key in self.values.keys():
         #     del self.values[key]
 
@@ -36,9 +44,34 @@ class Config(ContextAware):
                 self.set(key, value)
 
     def load(self, values):
-        self.clear()
-        for key, value in list(values.items()):
-            self.set(key, value)
+        with self.batch():
+            self.clear()
+            self.set(list(values.items()))
+
+    @contextmanager
+    def batch(self):
+        """Groups changes into one transaction. Values are updated in place
+        right away, but listeners are notified when the outermost batch
+        ends, and only for keys whose values differ from the values before
+        the batch. Changed keys are notified in one dispatch.
+
+        Changes made by other threads while a batch is active are included
+        in the batch.
+        """
+        with self._batch_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    changes = self._commit_batch()
+                else:
+                    changes = []
+            if changes:
+                # and now broadcast all changed keys at once
+                self.context.signal.notify_all("config", changes)
 
     def set(self, *values):
         if len(values) == 1:
@@ -49,58 +82,44 @@ class Config(ContextAware):
         else:
             raise Exception("Invalid number of parameters to set_config")
 
-        item_keys = [x[0] for x in items]
-        changed_keys = set()
-
-        def add_changed_key(added_key):
-            # try:
-            #     added_priority = cls.key_order.index(added_key)
-            # except ValueError:
-            #     added_priority = 1000
-            added_priority = 0
-            # FIXME: re-introduce support for key priority if necessary
-            changed_keys.add((added_priority, added_key))
-
-        def change(changed_key, changed_value):
-            # print("change", changed_key, changed_value)
-            # if key == "joystick_port_1_mode":
-            #     pass
-            if old_config.get(changed_key, None) == changed_value:
-                if changed_value:
+        item_keys = set(x[0] for x in items)
+        with self.batch():
+            for key, value in items:
+                self._change(key, value)
+                # we now reset x_key_sha1 keys, so if a file option was set
+                # without simultaneously specifying the _sha1 key, that key
+                # will be reset.
+                reset_key = "x_" + key + "_sha1"
+                if reset_key not in item_keys:
+                    if reset_key in self.values:
+                        self._change(reset_key, "")
+
+    def _change(self, key, value):
+        with self._batch_lock:
+            old_value = self.values.get(key, None)
+            # unchanged keys are recorded too, as explicitly set
+            self._batch_old_values.setdefault(key, old_value)
+            if old_value == value:
+                if value:
                     print("config set {0} to {1} (no change)".format(
-                        changed_key, changed_value))
+                        key, value))
                 return
-            print("config set {0} to {1}".format(changed_key, changed_value))
-            add_changed_key(changed_key)
-            self.values[changed_key] = changed_value
-
-        old_config = self.values.copy()
-        for key, value in items:
-            change(key, value)
-            # we now reset x_key_sha1 keys, so if a file option was set without
-            # simultaneously specifying the _sha1 key, that key will be reset.
-            reset_key = "x_" + key + "_sha1"
-            if reset_key not in item_keys:
-                if reset_key in self.values:
-                    change(reset_key, "")
-
-        # and now broadcast all changed keys at once
-        changed_key_list = [x[1] for x in changed_keys]
-
-        if len(changed_keys) > 0:
-            if "__ready" not in changed_key_list:
-                change("__ready", "0")
-            change("__changed", "1")
-            for priority, key in sorted(changed_keys):
-                # for listener in cls.config_listeners:
-                #     listener.on_config(key, cls.get(key))
-
-                value = self.get(key)
-                # Signal.broadcast("config", key, value)
-                self.context.signal.notify("config", (key, value))
-
-            # FIXME: reset __netplay_ready...
-            # if "__netplay_ready" not in changed_keys:
-            #     cls.set("__netplay_ready", "0")
-            #
-            # Settings.set("config_changed", "1")
+            print("config set {0} to {1}".format(key, value))
+            self.values[key] = value
+
+    def _commit_batch(self):
+        old_values = self._batch_old_values
+        self._batch_old_values = {}
+        changed_keys = [key for key, old_value in old_values.items()
+                        if self.values.get(key, None) != old_value]
+        if len(changed_keys) == 0:
+            return []
+        # keys which were explicitly set in the batch are left alone
+        if "__ready" not in old_values and self.values.get("__ready") != "0":
+            self.values["__ready"] = "0"
+            changed_keys.append("__ready")
+        if "__changed" not in old_values and \
+                self.values.get("__changed") != "1":
+            self.values["__changed"] = "1"
+            changed_keys.append("__changed")
+        return [(key, self.values[key]) for key in sorted(changed_keys)]
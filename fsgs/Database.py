@@ -1,15 +1,29 @@
 import os
 import re
+import sqlite3
 from fsbc.application import app
 from fsgs.BaseDatabase import BaseDatabase
 from fsgs.FSGSDirectories import FSGSDirectories
 import threading
 
 thread_local = threading.local()
-VERSION = 30
+VERSION = 32
 RESET_VERSION = 30
 QUOTED_TERMS_RE = re.compile("[\"].*?[\"]")
 
+# Terms which are tokenized as a single token by the search_index
+# full-text table (see update_database_to_version_32).
+SEARCH_INDEX_TERM_RE = re.compile("^[a-z0-9:+-]+$")
+
+# A search term matching at least this many games is considered broad
+# enough that scanning games in sort order finds the first page of results
+# faster than collecting and sorting all matches.
+BROAD_TERM_COUNT = 5000
+
+# Number of games fetched at a time by the game lists in the launcher and
+# the arcade (see the limit and offset arguments of find_games_new).
+GAME_PAGE_SIZE = 200
+
 
 class Database(BaseDatabase):
 
@@ -24,6 +38,7 @@ class Database(BaseDatabase):
 
     def __init__(self, sentinel):
         BaseDatabase.__init__(self, sentinel)
+        self._has_search_index = None
 
     def get_version(self):
         return VERSION
@@ -405,6 +420,8 @@ class Database(BaseDatabase):
     def delete_game(self, id):
         cursor = self.internal_cursor()
         cursor.execute("DELETE FROM search_term WHERE game = ?", (id,))
+        if self.has_search_index():
+            cursor.execute("DELETE FROM search_index WHERE rowid = ?", (id,))
         cursor.execute("DELETE FROM game WHERE id = ?", (id,))
 
     def update_game_search_terms(self, game_id, search_terms):
@@ -416,9 +433,92 @@ class Database(BaseDatabase):
         if search_terms != existing_terms:
             cursor.execute("DELETE FROM search_term WHERE game = ?",
                            (game_id,))
-            for term in search_terms:
-                cursor.execute("INSERT INTO search_term (game, "
-                               "term) VALUES (?, ?)", (game_id, term))
+            cursor.executemany("INSERT INTO search_term (game, "
+                               "term) VALUES (?, ?)",
+                               ((game_id, term) for term in search_terms))
+            if self.has_search_index():
+                cursor.execute("DELETE FROM search_index WHERE rowid = ?",
+                               (game_id,))
+                cursor.execute("INSERT INTO search_index (rowid, terms) "
+                               "VALUES (?, ?)",
+                               (game_id, " ".join(search_terms)))
+
+    def has_search_index(self):
+        """Returns True if the full-text search_index table exists and can
+        be used (SQLite may have been built without FTS5)."""
+        if self._has_search_index is None:
+            cursor = self.internal_cursor()
+            try:
+                cursor.execute("SELECT 1 FROM search_index LIMIT 0")
+            except sqlite3.OperationalError:
+                self._has_search_index = False
+            else:
+                self._has_search_index = True
+        return self._has_search_index
+
+    def estimate_term_count(self, term, exact_term, limit):
+        """Counts games matching term, stopping at limit."""
+        cursor = self.internal_cursor()
+        if exact_term:
+            cursor.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM search_term "
+                "WHERE term = ? LIMIT ?)", (term, limit))
+        else:
+            cursor.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM search_term "
+                "WHERE term >= ? AND term < ? LIMIT ?)",
+                (term, prefix_upper_bound(term), limit))
+        return cursor.fetchone()[0]
+
+    def search_term_clauses(self, terms, ordered_scan=False):
+        """Creates the WHERE clauses restricting a game query to games
+        matching all (term, exact_term) pairs in terms.
+
+        Returns the clauses, their arguments and whether the query should
+        scan games in sort order (only considered when ordered_scan is
+        True, i.e. for limited queries)."""
+        if not terms:
+            return [], [], False
+
+        if ordered_scan and len(terms) == 1:
+            term, exact_term = terms[0]
+            # Letter terms correlate with the sort order, so matches would
+            # not be found early in an ordered scan.
+            if not term.startswith("l:") and self.estimate_term_count(
+                    term, exact_term, BROAD_TERM_COUNT) >= BROAD_TERM_COUNT:
+                return [" AND EXISTS (SELECT 1 FROM search_term WHERE "
+                        "game = game.id AND term {0})".format(
+                            "= ?" if exact_term else ">= ? AND term < ?")], \
+                    term_args(term, exact_term), True
+
+        if self.has_search_index() and all(
+                SEARCH_INDEX_TERM_RE.match(term) for term, _ in terms):
+            # FTS5 intersects the matches for all terms in one go.
+            match = " AND ".join(
+                "\"{0}\"".format(term) if exact_term else
+                "\"{0}\"*".format(term) for term, exact_term in terms)
+            return [" AND game.id IN (SELECT rowid FROM search_index "
+                    "WHERE search_index MATCH ?)"], [match], False
+
+        # Without the full-text index, the most selective term selects the
+        # candidate games and the other terms are checked per game.
+        if len(terms) > 1:
+            terms = sorted(terms, key=lambda x: self.estimate_term_count(
+                x[0], x[1], BROAD_TERM_COUNT))
+        clauses = []
+        args = []
+        for i, (term, exact_term) in enumerate(terms):
+            condition = "= ?" if exact_term else ">= ? AND term < ?"
+            if i == 0:
+                clauses.append(
+                    " AND game.id IN (SELECT game FROM search_term "
+                    "WHERE term {0})".format(condition))
+            else:
+                clauses.append(
+                    " AND EXISTS (SELECT 1 FROM search_term WHERE "
+                    "game = game.id AND term {0})".format(condition))
+            args.extend(term_args(term, exact_term))
+        return clauses, args, False
 
     # def remove_unscanned_configurations(self, scan):
     #     cursor = self.internal_cursor()
@@ -440,7 +540,7 @@ class Database(BaseDatabase):
         return row[0]
 
     def find_games_new(self, search="", have=3, list_uuid="",
-                       database_only=False):
+                       database_only=False, limit=None, offset=0):
         print("Database.find_games_new search = {0}".format(repr(search)))
         non_database_only = False
         if list_uuid == self.GAME_LIST_GAMES:
@@ -453,17 +553,9 @@ class Database(BaseDatabase):
             have = 0
 
         cursor = self.internal_cursor()
-        query = "SELECT DISTINCT uuid, name, platform, year, publisher, " \
-                "front_image, title_image, screen1_image, screen2_image, " \
-                "screen3_image, screen4_image, screen5_image, have, path, " \
-                "sort_key, subtitle, thumb_image, backdrop_image FROM game"
-
         args = []
-        if list_uuid:
-            query += (" INNER JOIN game_list_game "
-                      "ON game.uuid = game_list_game.game_uuid ")
-
         have_false = False
+        search_terms = []
         additional_clauses = []
         additional_args = []
         include_adult = False
@@ -519,16 +611,25 @@ class Database(BaseDatabase):
                 # if " " in term:
                 #     #additional_clauses.append(" AND search like ?")
                 #     #additional_args.append("%" + term + "%")
-                if exact_term:
-                    query += (" INNER JOIN search_term as st{0} ON "
-                              "game.id = st{0}.game AND "
-                              "st{0}.term = ?".format(i))
-                    args.append(term)
-                else:
-                    query += (" INNER JOIN search_term as st{0} ON "
-                              "game.id = st{0}.game AND "
-                              "st{0}.term like ?".format(i))
-                    args.append(term + "%")
+                search_terms.append((term, exact_term))
+
+        term_clauses, term_clause_args, ordered_scan = \
+            self.search_term_clauses(
+                search_terms, ordered_scan=limit is not None and not list_uuid)
+
+        query = "SELECT DISTINCT uuid, name, platform, year, publisher, " \
+                "front_image, title_image, screen1_image, screen2_image, " \
+                "screen3_image, screen4_image, screen5_image, have, path, " \
+                "sort_key, subtitle, thumb_image, backdrop_image FROM game"
+        if ordered_scan:
+            query += " INDEXED BY game_sort_key_platform"
+        elif term_clauses:
+            # Make sure matching games are looked up by id instead of
+            # checking each game in sort order.
+            query += " NOT INDEXED"
+        if list_uuid:
+            query += (" INNER JOIN game_list_game "
+                      "ON game.uuid = game_list_game.game_uuid ")
 
         if have_false:
             query += " WHERE have = 0"
@@ -536,6 +637,9 @@ class Database(BaseDatabase):
             query += " WHERE have >= {0}".format(int(have))
         if not include_adult:
             query += " AND adult IS NULL"
+        for clause in term_clauses:
+            query += clause
+        args.extend(term_clause_args)
         for clause in additional_clauses:
             query += clause
         if list_uuid:
@@ -550,6 +654,9 @@ class Database(BaseDatabase):
             query += " game_list_game.position,"
         args.extend(additional_args)
         query += " sort_key, platform"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            args.extend([limit, offset])
 
         print(query.replace("?", "{}").format(*args))
         cursor.execute(query, args)
@@ -708,3 +815,51 @@ class Database(BaseDatabase):
             )""")
         cursor.execute("""CREATE INDEX game_list_game_list_uuid
             ON  game_list_game(list_uuid)""")
+
+    def update_database_to_version_31(self):
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "CREATE INDEX search_term_term ON search_term(term, game)")
+        cursor.execute(
+            "CREATE INDEX search_term_game ON search_term(game, term)")
+        cursor.execute(
+            "CREATE INDEX game_sort_key_platform ON game(sort_key, platform)")
+        # Remove terms left behind by games deleted without delete_game.
+        cursor.execute(
+            "DELETE FROM search_term WHERE game NOT IN (SELECT id FROM game)")
+
+    def update_database_to_version_32(self):
+        cursor = self.internal_cursor()
+        # Replaces the search index created by earlier builds of version 31,
+        # which folded diacritics and split terms on "-", so it could match
+        # games which the search_term table does not match. The prefix
+        # indexes make one and two letter prefix terms fast.
+        cursor.execute("DROP TABLE IF EXISTS search_index")
+        try:
+            cursor.execute("""CREATE VIRTUAL TABLE search_index USING fts5(
+                terms, detail=none, prefix='1 2',
+                tokenize="unicode61 remove_diacritics 0 tokenchars ':+-'"
+                )""")
+        except sqlite3.OperationalError as e:
+            print("could not create search index:", repr(e))
+            return
+        cursor.execute(
+            "INSERT INTO search_index (rowid, terms) "
+            "SELECT game, group_concat(term, ' ') FROM search_term "
+            "GROUP BY game")
+
+
+def term_args(term, exact_term):
+    if exact_term:
+        return [term]
+    return [term, prefix_upper_bound(term)]
+
+
+def prefix_upper_bound(prefix):
+    """Returns the smallest string which is greater than all strings
+    starting with prefix.
+
+    >>> prefix_upper_bound("lotus")
+    'lotut'
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
@@ -1,14 +1,234 @@
 import os
+import time
+import threading
 from uuid import uuid4, uuid5, NAMESPACE_URL
 import shutil
-from urllib.request import urlopen
 import hashlib
+import http.client
+import urllib.request
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+from fsbc.task import parallel_map
 # FIXME: temporary package dependency cycle, must be fixed
 from fsgs.FSGSDirectories import FSGSDirectories
+from fsgs.amiga.PreparedDriveCache import clone_file
+
+DOWNLOAD_WORKERS = 4
+RETRIES = 3
+CHUNK_SIZE = 65536
+MAX_REDIRECTS = 5
+USER_AGENT = "Python-urllib/" + urllib.request.__version__
+
+
+class DownloadError(Exception):
+
+    def __init__(self, message, status=None, retry=False):
+        Exception.__init__(self, message)
+        self.status = status
+        self.retry = retry
+
+
+class PooledResponse(object):
+    """HTTP response which returns its connection to the pool when closed
+    after having been read completely."""
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, size=-1):
+        return self.response.read(size)
+
+    def close(self):
+        if self.connection is None:
+            return
+        # length is the number of bytes not yet received, which is not zero
+        # if the server closed the connection early
+        if self.response.isclosed() and not self.response.will_close \
+                and not self.response.length:
+            self.pool.put(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+
+
+class OpenerResponse(object):
+    """Adapts a response from an urllib opener to the PooledResponse
+    interface."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status = response.getcode()
+
+    def getheader(self, name, default=None):
+        return self.response.headers.get(name, default)
+
+    def read(self, size=-1):
+        return self.response.read(size)
+
+    def close(self):
+        self.response.close()
+
+
+class ConnectionPool(object):
+    """Keeps HTTP(S) connections alive between requests, so downloads from
+    the same server (from any thread) reuse connections."""
+
+    def __init__(self, max_idle=DOWNLOAD_WORKERS, timeout=30.0):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.connections_created = 0
+
+    def get(self, key, reuse=True):
+        """Returns (connection, reused)."""
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections and reuse:
+                return connections.pop(), True
+            self.connections_created += 1
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, url, headers):
+        """Sends a GET request for url and returns a PooledResponse.
+        Redirects are followed."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ["http", "https"]:
+                raise DownloadError("Unsupported URL {0}".format(url))
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            connection, reused = self.get(key)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, try a new one
+                connection, reused = self.get(key, reuse=False)
+                try:
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                except Exception:
+                    connection.close()
+                    raise
+            except Exception:
+                connection.close()
+                raise
+            pooled = PooledResponse(self, key, connection, response)
+            if response.status in [301, 302, 303, 307, 308]:
+                location = response.getheader("Location")
+                response.read()
+                pooled.close()
+                if not location:
+                    raise DownloadError(
+                        "Redirect without location from {0}".format(url))
+                url = urljoin(url, location)
+                continue
+            return pooled
+        raise DownloadError("Too many redirects for {0}".format(url))
+
+
+connection_pool = ConnectionPool()
+# downloads to the same file are serialized
+path_locks = {}
+path_locks_lock = threading.Lock()
+
+
+def path_lock(path):
+    with path_locks_lock:
+        try:
+            return path_locks[path]
+        except KeyError:
+            lock = threading.Lock()
+            path_locks[path] = lock
+            return lock
+
+
+def partial_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def read_validator(partial_path):
+    """Returns the ETag or Last-Modified value stored for a partial file,
+    or an empty string."""
+    try:
+        with open(partial_path + ".validator", "r", encoding="UTF-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def write_validator(partial_path, response):
+    """Stores the validator of the response next to the partial file, so
+    a resumed request can send it in If-Range. Weak ETags cannot be used
+    with If-Range."""
+    validator = response.getheader("ETag", "")
+    if not validator or validator.startswith("W/"):
+        validator = response.getheader("Last-Modified", "")
+    if validator:
+        with open(partial_path + ".validator", "w", encoding="UTF-8") as f:
+            f.write(validator)
+    elif os.path.exists(partial_path + ".validator"):
+        os.remove(partial_path + ".validator")
+
+
+def remove_partial(partial_path):
+    for p in [partial_path, partial_path + ".validator"]:
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h
 
 
 class Downloader(object):
 
+    sha1_url_format = "http://fs-uae.net/s/sha1/{0}/{1}"
+
     @classmethod
     def check_terms_accepted(cls, download_file, download_terms):
         print("check_terms_accepted", download_file, download_terms)
@@ -55,20 +275,15 @@ class Downloader(object):
             return cache_path
         if not download:
             return None
-        if opener:
-            ifs = opener.open(url)
-        else:
-            ifs = urlopen(url)
-        cache_path_temp = cache_path + ".partial." + str(uuid4())
-        with open(cache_path_temp, "wb") as ofs:
-            while True:
-                data = ifs.read(65536)
-                if not data:
-                    break
-                ofs.write(data)
-        os.rename(cache_path_temp, cache_path)
+        cls.download_file(url, cache_path, opener=opener)
         return cache_path
 
+    @classmethod
+    def cache_files_from_urls(cls, urls, max_workers=DOWNLOAD_WORKERS):
+        """Downloads urls to the cache in parallel, and returns the cache
+        paths."""
+        return parallel_map(cls.cache_file_from_url, urls, max_workers)
+
     @classmethod
     def install_file_from_url(cls, url, path):
         print("DownloadService.install_file_from_url", url)
@@ -76,45 +291,188 @@ class Downloader(object):
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
         cache_path = cls.cache_file_from_url(url)
+        # copied, not linked, since this can be a hard drive image which
+        # the emulator modifies in place
         temp_path = path + ".partial"
-        shutil.copy(cache_path, temp_path)
+        shutil.copyfile(cache_path, temp_path)
         os.rename(temp_path, path)
 
     @classmethod
     def install_file_by_sha1(cls, sha1, name, path):
         print("DownloadService.install_file_by_sha1", sha1)
         print(repr(path))
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+        # files can be installed from several threads
+        os.makedirs(os.path.dirname(path), exist_ok=True)
         cache_path = cls.get_cache_path(sha1)
-        if os.path.exists(cache_path):
+        if cls.check_cached_file(cache_path, sha1):
             print("[CACHE]", cache_path)
-            shutil.copy(cache_path, path)
             # so we later can delete least accessed files in cache...
             os.utime(cache_path, None)
-            return
-        url = cls.sha1_to_url(sha1, name)
-        ifile = urlopen(url)
+        else:
+            cls.download_file(
+                cls.sha1_to_url(sha1, name), cache_path, sha1=sha1)
+        cls.install_cached_file(cache_path, path)
+
+    @classmethod
+    def install_files_by_sha1(cls, files, max_workers=DOWNLOAD_WORKERS):
+        """Installs a list of (sha1, name, path) in parallel."""
+        parallel_map(lambda x: cls.install_file_by_sha1(*x), files,
+                     max_workers)
+
+    @staticmethod
+    def check_cached_file(cache_path, sha1):
+        """Returns True if cache_path exists. Files which are also linked
+        elsewhere (hard linked by older versions of install_cached_file)
+        could have been modified through the other link, so they are
+        verified first."""
+        try:
+            st = os.stat(cache_path)
+        except OSError:
+            return False
+        if st.st_nlink == 1:
+            return True
+        if sha1_file(cache_path).hexdigest() == sha1:
+            return True
+        print("[CACHE] Removing modified file", cache_path)
+        os.remove(cache_path)
+        return False
+
+    @staticmethod
+    def install_cached_file(cache_path, path):
+        """Installs a file from the content cache as a reflink (copy on
+        write) if the file system supports it, and as a copy otherwise.
+        Installed files can be modified by the emulator, so they must not
+        share data with the cache (no hard links)."""
+        if os.path.exists(path):
+            os.remove(path)
         temp_path = path + ".partial." + str(uuid4())
-        h = hashlib.sha1()
-        with open(temp_path, "wb") as ofile:
+        clone_file(cache_path, temp_path)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def download_file(cls, url, path, sha1=None, opener=None):
+        """Downloads url to path. Data is written to path + ".partial",
+        which is resumed with an HTTP range request if it exists (from an
+        interrupted download). The range request is conditional (If-Range)
+        on the ETag or Last-Modified value of the first response, and a
+        partial file is only resumed without one if sha1 is given. The
+        SHA-1 is computed while writing and checked against sha1, if
+        given, before the file is renamed to path.
+        Network errors are retried (resuming), until RETRIES attempts in a
+        row have failed without receiving data."""
+        partial_path = path + ".partial"
+        with path_lock(path):
+            if os.path.exists(path):
+                # downloaded by another thread in the meantime
+                return
+            failures = 0
             while True:
-                data = ifile.read(65536)
-                if not data:
+                size = partial_size(partial_path)
+                try:
+                    digest = cls._download_partial(
+                        url, partial_path, opener, sha1)
                     break
-                h.update(data)
-                ofile.write(data)
-        if h.hexdigest() != sha1:
-            print("error: downloaded sha1 is", h.hexdigest(), "- wanted", sha1)
-            raise Exception("sha1 of downloaded file does not match")
-        temp_cache_path = cache_path + ".partial." + str(uuid4())
-        shutil.copy(temp_path, temp_cache_path)
-        os.rename(temp_cache_path, cache_path)
-        os.rename(temp_path, path)
+                except (OSError, http.client.HTTPException,
+                        DownloadError) as e:
+                    if isinstance(e, DownloadError) and not e.retry:
+                        raise
+                    print("Download of", url, "failed:", repr(e))
+                    if partial_size(partial_path) > size:
+                        # data was received, resume right away
+                        failures = 0
+                        continue
+                    failures += 1
+                    if failures == RETRIES:
+                        raise
+                    time.sleep(0.5 * 2 ** (failures - 1))
+            if sha1 and digest != sha1:
+                print("error: downloaded sha1 is", digest, "- wanted", sha1)
+                remove_partial(partial_path)
+                raise Exception("sha1 of downloaded file does not match")
+            os.rename(partial_path, path)
+            remove_partial(partial_path)
+
+    @classmethod
+    def _download_partial(cls, url, partial_path, opener, sha1=None):
+        offset = partial_size(partial_path)
+        validator = read_validator(partial_path)
+        if offset and not validator and not sha1:
+            # nothing tells if the partial data is from the same file
+            print("Not resuming unverifiable download of", url)
+            remove_partial(partial_path)
+            offset = 0
+        headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "identity"}
+        if offset:
+            print("Resuming download of", url, "at", offset)
+            headers["Range"] = "bytes={0}-".format(offset)
+            if validator:
+                # the server sends the whole file if it has changed
+                headers["If-Range"] = validator
+        response = cls._open(url, headers, opener)
+        try:
+            if response.status == 416 and offset:
+                # the partial file can be complete, but that is only known
+                # when the checksum is known
+                if sha1:
+                    digest = sha1_file(partial_path).hexdigest()
+                    if digest == sha1:
+                        return digest
+                remove_partial(partial_path)
+                raise DownloadError("Unexpected status 416 for {0}".format(
+                    url), response.status, retry=True)
+            content_range = response.getheader("Content-Range", "")
+            if response.status == 206 and offset and \
+                    content_range.startswith("bytes {0}-".format(offset)):
+                h = sha1_file(partial_path)
+                mode = "ab"
+            elif response.status == 200:
+                h = hashlib.sha1()
+                mode = "wb"
+                write_validator(partial_path, response)
+            elif response.status == 206:
+                # not the requested range, start over
+                remove_partial(partial_path)
+                raise DownloadError("Unexpected range {0} for {1}".format(
+                    repr(content_range), url), response.status, retry=True)
+            else:
+                raise DownloadError("HTTP status {0} for {1}".format(
+                    response.status, url), response.status,
+                    retry=response.status >= 500)
+            length = response.getheader("Content-Length")
+            received = 0
+            with open(partial_path, mode) as f:
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    received += len(data)
+                    h.update(data)
+                    f.write(data)
+            # http.client does not raise an error when the connection is
+            # closed before all data is received
+            if length is not None and received < int(length):
+                raise http.client.IncompleteRead(b"", int(length) - received)
+            return h.hexdigest()
+        finally:
+            response.close()
+
+    @classmethod
+    def _open(cls, url, headers, opener):
+        if opener is None and urllib.request.getproxies().get(
+                urlsplit(url).scheme):
+            # the connection pool does not support proxies
+            opener = urllib.request.build_opener()
+        if opener is None:
+            return connection_pool.request(url, headers)
+        try:
+            return OpenerResponse(opener.open(
+                urllib.request.Request(url, headers=headers)))
+        except HTTPError as e:
+            return OpenerResponse(e)
 
     @classmethod
     def sha1_to_url(cls, sha1, name):
-        url = "http://fs-uae.net/s/sha1/{0}/{1}".format(sha1, name)
+        url = cls.sha1_url_format.format(sha1, name)
         print(url)
         return url
 
@@ -122,8 +480,7 @@ class Downloader(object):
     def get_cache_path(cls, sha1_or_uuid):
         path = os.path.join(
             FSGSDirectories.get_cache_dir(), "Downloads", sha1_or_uuid[:3])
-        if not os.path.exists(path):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
         return os.path.join(path, sha1_or_uuid)
 
     @classmethod
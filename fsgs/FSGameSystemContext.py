@@ -20,6 +20,10 @@ from fsgs.ogd.locker import is_locker_enabled
 from fsgs.plugins.plugin_manager import PluginManager
 
 
+# serializes downloads of game file archives
+download_lock = threading.Lock()
+
+
 class NotFoundError(RuntimeError):
     pass
 
@@ -180,10 +184,17 @@ class FileContext(BaseContext):
             return self._copy_game_file(src, dst)
         except NotFoundError as e:
             if self.context.config.get("download_file"):
-                # we should be able to find all missing files after we have
-                # downloaded and extracted this archive
-                self.download_game_file_archive(
-                    self.context.config.get("download_file"))
+                with download_lock:
+                    # files are copied from several threads, and another
+                    # thread may have downloaded the archive already
+                    try:
+                        return self._copy_game_file(src, dst)
+                    except NotFoundError:
+                        pass
+                    # we should be able to find all missing files after we
+                    # have downloaded and extracted this archive
+                    self.download_game_file_archive(
+                        self.context.config.get("download_file"))
                 # now try to re-open the file (should be found in the cache
                 return self._copy_game_file(src, dst)
             raise e
@@ -225,14 +236,12 @@ class FileContext(BaseContext):
         print("\ndownload_game_file_archive", url)
         archive_path = Downloader.cache_file_from_url(url)
         archive = Archive(archive_path)
-        archive_files = archive.list_files()
-        print(archive_files)
-        for name in archive_files:
+        count = 0
+        for name, _, _, ifs in archive.iter_members():
             print(name)
-            ifs = archive.open(name)
-            data = ifs.read()
-            Downloader.cache_data(data)
-        if len(archive_files) == 0:
+            Downloader.cache_data(ifs.read())
+            count += 1
+        if count == 0:
             # might not be an archive then
             with open(archive_path, "rb") as f:
                 data = f.read()
@@ -1,6 +1,6 @@
 import os
 import time
-from binascii import unhexlify
+from binascii import hexlify, unhexlify
 import sqlite3
 # FIXME: remove dependency on launcher, have the Launcher tell this class
 # the path instead
@@ -9,7 +9,7 @@ from .BaseDatabase import BaseDatabase
 
 
 SENTINEL = "fae7671d-e232-4b71-b179-b3cd45995f92"
-VERSION = 2
+VERSION = 4
 
 
 class File(dict):
@@ -67,6 +67,84 @@ class FileDatabase(BaseDatabase):
             (a_path, b_path))
         return set([row[0] for row in cursor.fetchall()])
 
+    def get_file_hierarchy(self, path):
+        """Returns a dictionary mapping encoded paths to (id, size, mtime)
+        for all files below path."""
+        path = self.encode_path(path)
+        if path.endswith("/"):
+            path = path[:-1]
+        a_path = path + "\u002f"  # forward slash
+        b_path = path + "\u0030"  # one more than forward slash
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "SELECT id, path, size, mtime FROM file "
+            "WHERE path >= ? AND path < ?", (a_path, b_path))
+        return {row[1]: (row[0], row[2], row[3]) for row in cursor}
+
+    def get_directories(self, path):
+        """Returns a dictionary mapping encoded directory paths to
+        (mtime, count, all_files) for path and all directories below it."""
+        path = self.encode_path(path)
+        if path.endswith("/"):
+            path = path[:-1]
+        a_path = path + "\u002f"  # forward slash
+        b_path = path + "\u0030"  # one more than forward slash
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "SELECT path, mtime, count, all_files FROM directory "
+            "WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, a_path, b_path))
+        return {row[0]: (row[1], row[2], bool(row[3])) for row in cursor}
+
+    def set_directories(self, path, directories):
+        """Replaces the directory index for path and all directories below
+        it. directories is an iterable of (encoded path, mtime, count,
+        all_files) tuples."""
+        path = self.encode_path(path)
+        if path.endswith("/"):
+            path = path[:-1]
+        a_path = path + "\u002f"  # forward slash
+        b_path = path + "\u0030"  # one more than forward slash
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "DELETE FROM directory WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, a_path, b_path))
+        cursor.executemany(
+            "INSERT INTO directory (path, mtime, count, all_files) "
+            "VALUES (?, ?, ?, ?)", directories)
+
+    def get_checksum(self, path, size, mtime_ns):
+        """Returns the cached SHA-1 for the file at path if it still has
+        the given size and modification time, or None. Files added by the
+        file scanner are used too (with mtime in whole seconds)."""
+        path = self.encode_path(path)
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "SELECT size, mtime_ns, sha1 FROM checksum WHERE path = ?",
+            (path,))
+        row = cursor.fetchone()
+        if row is not None:
+            if row[0] == size and row[1] == mtime_ns:
+                return hexlify(row[2]).decode("ASCII")
+            return None
+        cursor.execute(
+            "SELECT size, mtime, sha1 FROM file "
+            "WHERE path = ? AND parent IS NULL LIMIT 1", (path,))
+        row = cursor.fetchone()
+        if row is not None and row[2]:
+            if row[0] == size and row[1] == mtime_ns // 1000000000:
+                return hexlify(row[2]).decode("ASCII")
+        return None
+
+    def set_checksum(self, path, size, mtime_ns, sha1):
+        self.init()
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO checksum (path, size, mtime_ns, sha1) "
+            "VALUES (?, ?, ?, ?)",
+            (self.encode_path(path), size, mtime_ns,
+             sqlite3.Binary(unhexlify(sha1))))
+
     # def get_child_ids(self, id=id):
     #     cursor = self.internal_cursor()
     #     cursor.execute("SELECT id FROM file WHERE parent = ?", (id,))
@@ -141,9 +219,27 @@ class FileDatabase(BaseDatabase):
             cursor.execute("SELECT id FROM file WHERE path = ?", (path,))
             for row in cursor:
                 delete_ids.append(row[0])            
-        for id in delete_ids:
-            cursor.execute(
-                "DELETE FROM file WHERE id = ? OR parent = ?", (id, id))
+        self.delete_files(delete_ids)
+
+    def delete_files(self, ids):
+        """Deletes files (and archive members of those files) by id. The
+        ids are collected in a temporary table so all rows are deleted
+        with a single statement."""
+        cursor = self.internal_cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS delete_file_id "
+            "(id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.delete_file_id")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO temp.delete_file_id (id) VALUES (?)",
+            ((id,) for id in ids))
+        if cursor.rowcount == 0:
+            return
+        cursor.execute(
+            "DELETE FROM file WHERE "
+            "id IN (SELECT id FROM temp.delete_file_id) OR "
+            "parent IN (SELECT id FROM temp.delete_file_id)")
+        cursor.execute("DELETE FROM temp.delete_file_id")
         self.last_file_delete = int(time.time())
 
     def check_sha1(self, sha1):
@@ -233,8 +329,6 @@ class FileDatabase(BaseDatabase):
 
         cursor = self.internal_cursor()
         # parent = self.ensure_dir(dir)
-        print("add_file", repr(path), repr(sha1), repr(mtime), repr(size),
-              repr(parent))
         if sha1:
             sha1 = unhexlify(sha1)
         cursor.execute(
@@ -244,6 +338,22 @@ class FileDatabase(BaseDatabase):
         self.last_file_insert = int(time.time())
         return cursor.lastrowid
 
+    def add_files(self, files):
+        """Adds many files with a single prepared statement. files is an
+        iterable of (path, sha1, mtime, size, parent) tuples, with the same
+        meaning as the add_file arguments."""
+        self.init()
+        cursor = self.internal_cursor()
+        cursor.executemany(
+            "INSERT INTO file (path, sha1, mtime, size, parent) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((self.encode_path(path),
+              sqlite3.Binary(unhexlify(sha1)) if sha1 else None,
+              mtime, size, parent)
+             for path, sha1, mtime, size, parent in files))
+        if cursor.rowcount > 0:
+            self.last_file_insert = int(time.time())
+
     # def ensure_dir(self, path):
     #     #if not path.endswith("/"):
     #     #    path += "/"
@@ -286,6 +396,7 @@ class FileDatabase(BaseDatabase):
             self.init()
         cursor = self.internal_cursor()
         cursor.execute("DELETE FROM file")
+        cursor.execute("DELETE FROM directory")
 
     def update_database_to_version_1(self):
         cursor = self.internal_cursor()
@@ -312,6 +423,27 @@ class FileDatabase(BaseDatabase):
         cursor = self.internal_cursor()
         cursor.execute("CREATE INDEX file_parent ON file(parent)")
 
+    def update_database_to_version_3(self):
+        cursor = self.internal_cursor()
+        cursor.execute("""CREATE TABLE directory (
+                id INTEGER PRIMARY KEY,
+                path TEXT,
+                mtime INTEGER,
+                count INTEGER,
+                all_files INTEGER
+                )""")
+        cursor.execute(
+            "CREATE UNIQUE INDEX directory_path ON directory(path)")
+
+    def update_database_to_version_4(self):
+        cursor = self.internal_cursor()
+        cursor.execute("""CREATE TABLE checksum (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha1 BLOB
+                )""")
+
     # def update_database_to_version_1(self):
     #     cursor = self.create_cursor()
     #     try:
@@ -1,68 +1,283 @@
 import os
 import shutil
-import hashlib
+import struct
+import threading
+import traceback
+
+from fsgs.GameStateStore import GameStateStore, PACK_NAME, \
+    StateStoreError, file_sha1
+
+try:
+    import ctypes
+    import ctypes.util
+    import select
+except ImportError:
+    ctypes = None
 
 # TODO: review the algorithm and add support for saving information about
 # (empty) directories.
 
+DELETED_MARKER = b"FILE_IS_DELETED"
 
-class GameChangeHandler(object):
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                 IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                 IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def scan_tree(path, rel_path=""):
+    """Returns a dictionary mapping relative file paths to (size, mtime_ns,
+    inode) for all files in the directory tree at path (or the subtree
+    rel_path). Symbolic links to directories are not followed."""
+    files = {}
+    stack = [rel_path]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(path, rel_dir))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for entry in it:
+                rel = os.path.join(rel_dir, entry.name) if rel_dir \
+                    else entry.name
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(rel)
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    return files
+
+
+class ChangeWatcher(object):
+    """Records paths changed in a directory tree with inotify (Linux), in a
+    background thread. If the kernel event queue overflows, the changes
+    are unknown and overflow is set."""
+
+    _libc = None
+
+    @classmethod
+    def available(cls):
+        if ctypes is None or not hasattr(os, "O_NONBLOCK"):
+            return False
+        try:
+            cls._load_libc()
+        except (OSError, AttributeError, TypeError):
+            return False
+        return True
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.restype = ctypes.c_int
+            libc.inotify_add_watch.restype = ctypes.c_int
+            libc.inotify_add_watch.argtypes = [
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
 
     def __init__(self, path):
+        self.path = path
+        self.changed = set()
+        self.overflow = False
+        self.lock = threading.Lock()
+        self._watches = {}
+        self._stop = False
+        libc = self._load_libc()
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._add_watches("")
+        self._thread = threading.Thread(
+            target=self._run, name="ChangeWatcher", daemon=True)
+        self._thread.start()
+
+    def _add_watches(self, rel_dir):
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            dir_path = os.path.join(self.path, rel_dir)
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(dir_path), IN_WATCH_MASK)
+            if wd < 0:
+                # directory was removed, or too many watches
+                if os.path.isdir(dir_path):
+                    self.overflow = True
+                continue
+            self._watches[wd] = rel_dir
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(rel_dir, entry.name))
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._stop:
+            try:
+                readable, _, _ = select.select([self._fd], [], [], 0.5)
+                if readable:
+                    self._read_events()
+            except Exception:
+                traceback.print_exc()
+                with self.lock:
+                    self.overflow = True
+                return
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                with self.lock:
+                    self.overflow = True
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            rel = os.path.join(rel_dir, name) if name else rel_dir
+            with self.lock:
+                self.changed.add(rel)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watches(rel)
+
+    def stop(self):
+        """Stops watching and returns (changed paths, overflow)."""
+        if not self._stop:
+            self._stop = True
+            self._thread.join()
+            # pick up events which were queued before stopping
+            try:
+                self._read_events()
+            except Exception:
+                traceback.print_exc()
+                self.overflow = True
+            os.close(self._fd)
+        with self.lock:
+            return set(self.changed), self.overflow
+
+
+class GameChangeHandler(object):
+    """Saves files changed in a directory (the temporary launch directory)
+    to a state store in the state directory, and restores saved changes
+    into the directory on the next launch.
+
+    Files are compared by (size, mtime_ns, inode), recorded before and
+    after running the game, so only changed files are read. Changed files
+    with the same content as in the last save point are not saved again
+    (the emulator can rewrite files without changing them). With watch
+    enabled (and inotify available), changed paths are also recorded while
+    the game runs, and the directory tree is not scanned again after."""
+
+    def __init__(self, path, watch=False):
         self._preserve_changes_dir = path
+        self._preserve_changes_files = {}
+        self._watch = watch
+        self._watcher = None
+        self._legacy_files = []
 
     def init(self, state_dir, ignore=[]):
         print("\n" + "-" * 79 + "\n" + "CHANGEHANDLER INIT")
         print(self._preserve_changes_dir)
         path = self._preserve_changes_dir
+        self._legacy_files = []
         if os.path.exists(state_dir):
             print("Merging preserved changes in", state_dir, "to", path)
-            if state_dir[-1] == "/" or state_dir[-1] == "\\":
-                state_dir = state_dir[:-1]
-            lstate_dir = len(state_dir)
-            first_iteration = True
-            for dirpath, dir_names, file_names in os.walk(state_dir):
-                for file_name in file_names:
-                    ignore_file = False
-                    if first_iteration:
-                        for ig in ignore:
-                            assert ig[0] == "*"
-                            dummy, ext = os.path.splitext(file_name)
-                            if ext.lower() == ig[1:]:
-                                print("ignoring", file_name)
-                                ignore_file = True
-                                break
-                    if ignore_file:
-                        continue
-                    sourcepath = os.path.join(dirpath, file_name)
-                    destpath = os.path.join(path, sourcepath[lstate_dir+1:])
-                    if os.path.getsize(sourcepath) == 17:
-                        with open(sourcepath, "rb") as f:
-                            if f.read() == "FILE_IS_DELETED":
-                                print("- removing file",
-                                        sourcepath[lstate_dir+1:])
-                                if os.path.exists(destpath):
-                                    os.remove(destpath)
-                                else:
-                                    print("  (already gone)")
-                                continue
-                    print("- updating file", sourcepath[lstate_dir+1:])
-                    if not os.path.isdir(os.path.dirname(destpath)):
-                        os.makedirs(os.path.dirname(destpath))
-                    shutil.copyfile(sourcepath, destpath)
-                first_iteration = False
+            self._merge_legacy_files(state_dir, ignore)
+            store = GameStateStore(state_dir)
+            if store.exists():
+                print("Restoring changes from", store.path)
+                store.restore(path)
         else:
             print("no game state")
+        if self._watch and ChangeWatcher.available():
+            # started before the tree is scanned, so no change is missed
+            try:
+                self._watcher = ChangeWatcher(path)
+            except OSError:
+                traceback.print_exc()
+                self._watcher = None
         self._preserve_changes_files = self.create_file_version_list(path)
         print("done")
 
+    def _merge_legacy_files(self, state_dir, ignore):
+        """Merges changes saved as loose files (and deletion markers) by
+        older versions. Files in subdirectories are moved into the state
+        store by the next update, top-level files are left alone since the
+        emulator also stores files there."""
+        path = self._preserve_changes_dir
+        if state_dir[-1] == "/" or state_dir[-1] == "\\":
+            state_dir = state_dir[:-1]
+        lstate_dir = len(state_dir)
+        first_iteration = True
+        for dirpath, dir_names, file_names in os.walk(state_dir):
+            for file_name in file_names:
+                if first_iteration:
+                    if file_name.startswith(PACK_NAME):
+                        continue
+                    dummy, ext = os.path.splitext(file_name)
+                    if any(ext.lower() == ig[1:] for ig in ignore):
+                        print("ignoring", file_name)
+                        continue
+                sourcepath = os.path.join(dirpath, file_name)
+                rel_path = sourcepath[lstate_dir+1:]
+                destpath = os.path.join(path, rel_path)
+                if not first_iteration:
+                    self._legacy_files.append(rel_path)
+                if os.path.getsize(sourcepath) == len(DELETED_MARKER):
+                    with open(sourcepath, "rb") as f:
+                        if f.read() == DELETED_MARKER:
+                            print("- removing file", rel_path)
+                            if os.path.exists(destpath):
+                                os.remove(destpath)
+                            else:
+                                print("  (already gone)")
+                            continue
+                print("- updating file", rel_path)
+                if not os.path.isdir(os.path.dirname(destpath)):
+                    os.makedirs(os.path.dirname(destpath))
+                if os.path.exists(destpath):
+                    # the file can be a clone of a file in the prepared
+                    # drive cache, so it is replaced instead of overwritten
+                    os.remove(destpath)
+                shutil.copyfile(sourcepath, destpath)
+            first_iteration = False
+
     def update(self, state_dir):
         print("\n" + "-" * 79 + "\n" + "CHANGEHANDLER UPDATE")
         print("SRC", self._preserve_changes_dir)
         print("DST", state_dir)
         oldfiles = self._preserve_changes_files
-        newfiles = self.create_file_version_list(self._preserve_changes_dir)
+        newfiles = self.updated_file_version_list()
         print("checking files")
+        changed = []
+        deleted = []
+        stored_files = None
         for filename, newcs in newfiles.items():
             try:
                 oldcs = oldfiles[filename]
@@ -70,46 +285,115 @@ class GameChangeHandler(object):
                 print("New file:", filename)
                 oldcs = None
             if newcs != oldcs:
+                if stored_files is None:
+                    stored_files = self._stored_files(state_dir)
+                if self._is_stored(filename, newcs[0], stored_files):
+                    print("File touched, but not changed:", filename)
+                    continue
                 print("File changed:", filename)
                 print("-", newcs, "vs", oldcs)
-                sourcepath = os.path.join(self._preserve_changes_dir, filename)
-                destpath = os.path.join(state_dir,
-                        filename)
-                print("Writing file", destpath)
-                if not os.path.exists(os.path.dirname(destpath)):
-                    os.makedirs(os.path.dirname(destpath))
-                shutil.copyfile(sourcepath, destpath)
-
+                changed.append(filename)
         for filename in oldfiles:
             if not filename in newfiles:
                 print("File removed", filename)
-                destpath = os.path.join(state_dir, filename)
-                if not os.path.exists(os.path.dirname(destpath)):
-                    os.makedirs(os.path.dirname(destpath))
-                with open(destpath, "wb") as f:
-                    f.write("FILE_IS_DELETED")
+                deleted.append(filename)
+        # move changes saved as loose files into the state store
+        changed_set = set(changed)
+        for filename in self._legacy_files:
+            if filename in newfiles:
+                if filename not in changed_set:
+                    changed.append(filename)
+            elif filename not in deleted:
+                deleted.append(filename)
+        if changed or deleted:
+            store = GameStateStore(state_dir)
+            print("Writing {0} changed and {1} deleted files to {2}".format(
+                len(changed), len(deleted), store.path))
+            store.save(self._preserve_changes_dir, changed, deleted)
+        self._remove_legacy_files(state_dir)
         print("done")
 
+    @staticmethod
+    def _stored_files(state_dir):
+        try:
+            return GameStateStore(state_dir).stored_files()
+        except (OSError, StateStoreError):
+            traceback.print_exc()
+            return {}
+
+    def _is_stored(self, filename, size, stored_files):
+        """Returns True if the file has the same content as the file
+        stored in the last save point."""
+        try:
+            digest, stored_size = stored_files[filename]
+        except KeyError:
+            return False
+        if size != stored_size:
+            return False
+        try:
+            return file_sha1(os.path.join(
+                self._preserve_changes_dir, filename)) == digest
+        except OSError:
+            return False
+
+    def _remove_legacy_files(self, state_dir):
+        for filename in self._legacy_files:
+            path = os.path.join(state_dir, filename)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            # remove directories which are now empty
+            dir_path = os.path.dirname(path)
+            while os.path.normpath(dir_path) != os.path.normpath(state_dir):
+                try:
+                    os.rmdir(dir_path)
+                except OSError:
+                    break
+                dir_path = os.path.dirname(dir_path)
+        self._legacy_files = []
+
+    def close(self):
+        """Stops watching for changes (if enabled)."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
     def create_file_version_list(self, path):
         print("create_file_version_list")
         if path[-1] == "/" or path[-1] == "\\":
             path = path[:-1]
-        lpath = len(path)
-        files = {}
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                checksum = self.md5file(filepath)
-                files[filepath[lpath+1:]] = checksum
-        print(" - found %d files (checksummed)" % len(files,))
+        files = scan_tree(path)
+        print(" - found %d files" % len(files,))
         return files
 
-    def md5file(self, file):
-        with open(file, "rb") as f:
-            m = hashlib.md5()
-            while True:
-                buffer = f.read(4096)
-                if buffer == b"":
-                    break
-                m.update(buffer)
-            return m.hexdigest()
+    def updated_file_version_list(self):
+        """Returns the current file version list. When watching, only the
+        paths reported as changed are checked again."""
+        path = self._preserve_changes_dir
+        if self._watcher is None:
+            return self.create_file_version_list(path)
+        changed, overflow = self._watcher.stop()
+        self._watcher = None
+        if overflow:
+            print("change watcher overflowed, checking all files")
+            return self.create_file_version_list(path)
+        print("change watcher reported %d changed paths" % len(changed))
+        files = dict(self._preserve_changes_files)
+        for rel in changed:
+            prefix = rel + os.sep
+            for name in [name for name in files
+                         if name == rel or name.startswith(prefix)]:
+                del files[name]
+        for rel in changed:
+            full_path = os.path.join(path, rel)
+            if os.path.isdir(full_path):
+                if not os.path.islink(full_path):
+                    files.update(scan_tree(path, rel))
+            else:
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                files[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return files
@@ -1,6 +1,8 @@
 import json
 import sqlite3
+import threading
 from binascii import hexlify, unhexlify
+from collections import OrderedDict
 import zlib
 from .BaseDatabase import BaseDatabase
 
@@ -8,6 +10,72 @@ from .BaseDatabase import BaseDatabase
 VERSION = 18
 RESET_VERSION = 18
 DUMMY_UUID = b"'\\x8b\\xbb\\x00Y\\x8bqM\\x15\\x972\\xa8-t_\\xb2\\xfd'"
+GAME_VALUES_CACHE_SIZE = 8192
+
+
+class GameValuesCache(object):
+    """Size-bounded LRU cache of merged game documents, shared by all
+    GameDatabase instances (there is one instance per thread).
+
+    Entries are keyed by (database path, game uuid). Each database has a
+    sync id (the highest game id, which increases with every synchronized
+    change, including deletions), and all entries for a database are
+    dropped when it changes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.sync_ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, sync_id, game_uuid):
+        with self.lock:
+            if self.sync_ids.get(path) != sync_id:
+                self._invalidate(path)
+                self.sync_ids[path] = sync_id
+            try:
+                doc = self.entries[(path, game_uuid)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((path, game_uuid))
+            self.hits += 1
+            return doc
+
+    def put(self, path, sync_id, game_uuid, doc):
+        with self.lock:
+            if self.sync_ids.get(path) != sync_id:
+                return
+            self.entries[(path, game_uuid)] = doc
+            self.entries.move_to_end((path, game_uuid))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        with self.lock:
+            self._invalidate(path)
+            self.sync_ids.pop(path, None)
+
+    def _invalidate(self, path):
+        if path not in self.sync_ids:
+            return
+        for key in [key for key in self.entries if key[0] == path]:
+            del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+            }
+
+
+game_values_cache = GameValuesCache(GAME_VALUES_CACHE_SIZE)
 
 
 class GameDatabase(BaseDatabase):
@@ -59,6 +127,11 @@ class GameDatabase(BaseDatabase):
         # return row[0]
         return None
 
+    @staticmethod
+    def cache_stats():
+        """Returns hit and miss counters for the game values cache."""
+        return game_values_cache.stats()
+
     def add_game(self, game_id, game_uuid, game_data):
         # print("add game", repr(game_id), repr(game_uuid), repr(game_data))
         cursor = self.internal_cursor()
@@ -81,6 +154,37 @@ class GameDatabase(BaseDatabase):
             "INSERT INTO game (id, uuid, data) VALUES (?, ?, ?)",
             (game_id, sqlite3.Binary(DUMMY_UUID), ""))
 
+    def apply_game_changes(self, changes):
+        """Applies a batch of (game_id, game_uuid, game_data) changes from
+        the synchronizer, where empty game_data means that the game was
+        deleted. The result is the same as calling add_game / delete_game
+        for each change in order, but with one statement per kind of
+        change."""
+        # only the last change for each game matters
+        latest = {}
+        for change in changes:
+            latest.pop(change[1], None)
+            latest[change[1]] = change
+        cursor = self.internal_cursor()
+        cursor.executemany(
+            "DELETE FROM game WHERE uuid = ?",
+            [(sqlite3.Binary(game_uuid),) for game_uuid in latest])
+        cursor.executemany(
+            "INSERT INTO game (id, uuid, data) VALUES (?, ?, ?)",
+            [(game_id, sqlite3.Binary(game_uuid), sqlite3.Binary(game_data))
+             for game_id, game_uuid, game_data in latest.values()
+             if len(game_data) > 0])
+        deleted_ids = [game_id for game_id, _, game_data in latest.values()
+                       if len(game_data) == 0]
+        if deleted_ids:
+            # keep track of the last sync id, like delete_game does
+            cursor.execute(
+                "DELETE FROM game WHERE uuid = ?",
+                (sqlite3.Binary(DUMMY_UUID),))
+            cursor.execute(
+                "INSERT INTO game (id, uuid, data) VALUES (?, ?, ?)",
+                (max(deleted_ids), sqlite3.Binary(DUMMY_UUID), ""))
+
     def binary_uuid_to_str(self, data):
         s = hexlify(data).decode("ASCII")
         return "{}-{}-{}-{}-{}".format(
@@ -130,32 +234,76 @@ class GameDatabase(BaseDatabase):
             game_uuid = self.binary_uuid_to_str(row[0])
         else:
             assert self.binary_uuid_to_str(row[0]) == game_uuid
-        data = zlib.decompress(row[1])
-        data = data.decode("UTF-8")
-        doc = json.loads(data)
-        next_parent_uuid = doc.get("parent_uuid", "")
-        while next_parent_uuid and recursive:
-            # treat game_uuid special, it will be the first parent_uuid
-            # in the chain
-            doc["game_uuid"] = next_parent_uuid
+        if not recursive:
+            return self.decode_game_data(row[1])
+        return dict(self.merged_game_values(
+            self.get_last_game_id(), game_uuid, row[1]))
+
+    def get_game_values_many(self, game_ids):
+        """Returns a dictionary mapping game ids to merged game values for
+        all game_ids, like get_game_values. Parents shared by several
+        games are only decoded once."""
+        cursor = self.internal_cursor()
+        sync_id = self.get_last_game_id()
+        game_ids = list(game_ids)
+        result = {}
+        # Stay well below SQLite's limit on the number of query parameters.
+        for i in range(0, len(game_ids), 500):
+            batch = game_ids[i:i + 500]
+            cursor.execute(
+                "SELECT id, uuid, data FROM game WHERE id IN ({})".format(
+                    ",".join("?" * len(batch))), batch)
+            for game_id, uuid, data in cursor.fetchall():
+                result[game_id] = dict(self.merged_game_values(
+                    sync_id, self.binary_uuid_to_str(uuid), data))
+        for game_id in game_ids:
+            if game_id not in result:
+                raise LookupError("Cannot find game id {}".format(game_id))
+        return result
+
+    def merged_game_values(self, sync_id, game_uuid, data=None):
+        """Returns the game values for game_uuid merged with the values of
+        its parents, using the game values cache. The returned dictionary
+        is shared with the cache and must not be modified."""
+        doc = game_values_cache.get(self._path, sync_id, game_uuid)
+        if doc is not None:
+            return doc
+        if data is None:
+            cursor = self.internal_cursor()
             cursor.execute(
                 "SELECT data FROM game WHERE uuid = ?",
-                (sqlite3.Binary(
-                    unhexlify(next_parent_uuid.replace("-", ""))),))
+                (sqlite3.Binary(unhexlify(game_uuid.replace("-", ""))),))
             row = cursor.fetchone()
             if not row:
+                raise LookupError("Cannot find game uuid {}".format(game_uuid))
+            data = row[0]
+        doc = self.decode_game_data(data)
+        parent_uuid = doc.get("parent_uuid", "")
+        if parent_uuid:
+            try:
+                parent_doc = self.merged_game_values(sync_id, parent_uuid)
+            except LookupError:
                 raise Exception(
                     "could not find parent {0} of game {1}".format(
-                        next_parent_uuid, game_uuid))
-            data = zlib.decompress(row[0])
-            data = data.decode("UTF-8")
-            next_doc = json.loads(data)
-            next_parent_uuid = next_doc.get("parent_uuid", "")
-            # let child doc overwrite and append values to parent doc
-            next_doc.update(doc)
-            doc = next_doc
+                        parent_uuid, game_uuid))
+            # let child doc overwrite and append values to parent doc,
+            # except game_uuid which is the uuid of the topmost parent
+            merged_doc = dict(parent_doc)
+            merged_doc.update(doc)
+            if parent_doc.get("parent_uuid", ""):
+                merged_doc["game_uuid"] = parent_doc["game_uuid"]
+            else:
+                merged_doc["game_uuid"] = parent_uuid
+            doc = merged_doc
+        game_values_cache.put(self._path, sync_id, game_uuid, doc)
         return doc
 
+    @staticmethod
+    def decode_game_data(data):
+        data = zlib.decompress(data)
+        data = data.decode("UTF-8")
+        return json.loads(data)
+
     def get_game_database_version(self):
         cursor = self.internal_cursor()
         cursor.execute("SELECT database_version FROM metadata")
@@ -166,6 +314,7 @@ class GameDatabase(BaseDatabase):
         cursor.execute("UPDATE metadata SET database_version = ?", (version,))
 
     def clear(self):
+        game_values_cache.invalidate(self._path)
         cursor = self.internal_cursor()
         cursor.execute("DELETE FROM rating")
         cursor.execute("DELETE FROM game")
@@ -1,15 +1,88 @@
 import json
+import struct
+import threading
 import time
 from gzip import GzipFile
-from io import StringIO
 from fsgs.ogd.client import OGDClient
 from urllib.request import HTTPBasicAuthHandler, build_opener, Request
 from urllib.parse import quote_plus
 from fsgs.res import gettext
 
 
-def bytes_to_int(m):
-    return m[0] << 24 | m[1] << 16 | m[2] << 8 | m[3]
+# Each game sync record is a header (sync id, binary game uuid, data size)
+# followed by the compressed game data. Empty game data means that the game
+# was deleted.
+GAME_SYNC_RECORD_HEADER = struct.Struct(">I16sI")
+
+READ_CHUNK_SIZE = 65536
+
+
+def iter_game_sync_records(data):
+    """Yields (game_sync_id, game_uuid, game_data) tuples for the records in
+    a game sync chunk. game_data is a memoryview into data, so records are
+    decoded without copying the game data."""
+    view = memoryview(data)
+    size = len(view)
+    header_size = GAME_SYNC_RECORD_HEADER.size
+    unpack_from = GAME_SYNC_RECORD_HEADER.unpack_from
+    k = 0
+    while k < size:
+        if k + header_size > size:
+            raise ValueError("Truncated game sync record header")
+        game_sync_id, game_uuid, game_data_size = unpack_from(view, k)
+        k += header_size
+        if k + game_data_size > size:
+            raise ValueError("Truncated game sync record data")
+        yield game_sync_id, game_uuid, view[k:k + game_data_size]
+        k += game_data_size
+
+
+def read_response(response):
+    """Reads the response body, decompressing gzip encoded data while it is
+    received. The data is collected in one bytearray, so neither the
+    compressed nor the decompressed data is copied as a whole."""
+    try:
+        getheader = response.headers.getheader
+    except AttributeError:
+        getheader = response.getheader
+    content_encoding = getheader("content-encoding", "").lower()
+    if content_encoding == "gzip":
+        stream = GzipFile(fileobj=response)
+    else:
+        stream = response
+    data = bytearray()
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class Prefetch(threading.Thread):
+    """Calls function(*args) in a background thread. The result (or the
+    exception raised) is returned (or raised) by result()."""
+
+    def __init__(self, function, *args):
+        threading.Thread.__init__(
+            self, name="GameDatabaseSyncPrefetchThread", daemon=True)
+        self._function = function
+        self._args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._function(*self._args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
 
 
 class GameDatabaseSynchronizer(object):
@@ -70,32 +143,30 @@ class GameDatabaseSynchronizer(object):
 
         self.set_status(gettext("Synchronizing game database..."))
 
+        # The next chunk only depends on the highest sync id in the current
+        # chunk, so it is fetched in the background while the current chunk
+        # is written to the database.
+        last_id = self.database.get_last_game_id()
+        prefetch = None
         while True:
             if self.stop_check():
                 return
-            data = self.fetch_game_sync_data()
+            if prefetch is None:
+                data = self.fetch_game_sync_data(last_id)
+            else:
+                data = prefetch.result()
             if not data:
                 print("no more changes")
                 break
 
             t1 = time.time()
-            k = 0
-            while k < len(data):
-                game_sync_id = bytes_to_int(data[k:k + 4])
-                k += 4
-                game_uuid = data[k:k + 16]
-                k += 16
-                game_data_size = bytes_to_int(data[k:k + 4])
-                k += 4
-                game_data = data[k:k + game_data_size]
-                k += game_data_size
-                # print("game data len:", len(game_data))
-                if len(game_data) > 0:
-                    self.database.add_game(game_sync_id, game_uuid, game_data)
-                else:
-                    self.database.delete_game(game_sync_id, game_uuid)
+            records = list(iter_game_sync_records(data))
+            last_id = max(last_id, max(record[0] for record in records))
+            prefetch = Prefetch(self.fetch_game_sync_data, last_id)
+            self.database.apply_game_changes(records)
             t2 = time.time()
-            print("  {0:0.2f} seconds".format(t2 - t1))
+            print("  {0} entries in {1:0.2f} seconds".format(
+                len(records), t2 - t1))
 
         last_json_data = ""
         while True:
@@ -145,8 +216,9 @@ class GameDatabaseSynchronizer(object):
         opener = build_opener(auth_handler)
         return server, opener
 
-    def fetch_game_sync_data(self):
-        last_id = self.database.get_last_game_id()
+    def fetch_game_sync_data(self, last_id=None):
+        if last_id is None:
+            last_id = self.database.get_last_game_id()
         self.set_status(
             gettext("Fetching database entries ({0})").format(last_id + 1))
         server = self.get_server()[0]
@@ -182,17 +254,7 @@ class GameDatabaseSynchronizer(object):
         request.add_header("Accept-Encoding", "gzip")
         response = opener.open(request)
         # print(response.headers)
-        data = response.read()
-
-        try:
-            getheader = response.headers.getheader
-        except AttributeError:
-            getheader = response.getheader
-        content_encoding = getheader("content-encoding", "").lower()
-        if content_encoding == "gzip":
-            # data = zlib.decompress(data)
-            fake_stream = StringIO(data)
-            data = GzipFile(fileobj=fake_stream).read()
+        data = read_response(response)
 
         # else:
         #     data = response.read()
@@ -224,18 +286,7 @@ class GameDatabaseSynchronizer(object):
         # request.add_header("Accept-Encoding", "gzip")
         response = opener.open(request)
         # print(response.headers)
-        data = response.read()
-
-        try:
-            getheader = response.headers.getheader
-        except AttributeError:
-            getheader = response.getheader
-
-        content_encoding = getheader("content-encoding", "").lower()
-        if content_encoding == "gzip":
-            # data = zlib.decompress(data)
-            fake_stream = StringIO(data)
-            data = GzipFile(fileobj=fake_stream).read()
+        data = read_response(response)
 
         # else:
         #     data = response.read()
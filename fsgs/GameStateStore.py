@@ -0,0 +1,387 @@
+"""
+Compact storage of preserved game changes.
+
+Files changed by a game are stored in a single pack file in the game's state
+directory, instead of as loose files. The pack is an append-only sequence of
+records:
+
+    MAGIC
+    BLOB: sha1 digest, uncompressed size, zlib compressed data
+    ...
+    MANI: zlib compressed JSON manifest (changed files and deleted files)
+    BLOB ...
+    MANI ...
+
+Each save point appends the blobs which are not already in the pack (blobs
+are content-addressed by SHA-1, so identical files are stored once across
+files and save points) and a new manifest. The last manifest describes the
+current state. An incomplete record at the end (the launcher was killed
+while saving) is ignored and overwritten by the next save. A new pack is
+written to a temporary file first, and a file which is not a pack is moved
+aside (and then replaced by a new pack). When more than
+half of the pack is unreferenced data, it is rewritten with only the blobs
+referenced by the last manifest, in manifest order.
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+PACK_NAME = "Changes.pack"
+MAGIC = b"FSGSCHG\x01"
+RECORD = struct.Struct("<4sQ")
+BLOB_HEADER = struct.Struct("<20sQ")
+BLOB = b"BLOB"
+MANIFEST = b"MANI"
+CHUNK_SIZE = 1024 * 1024
+COMPRESSION_LEVEL = 6
+# packs smaller than this are not compacted
+COMPACT_MIN_SIZE = 1024 * 1024
+
+
+class StateStoreError(Exception):
+    pass
+
+
+def to_store_path(rel_path):
+    return rel_path.replace(os.sep, "/")
+
+
+def from_store_path(store_path):
+    return store_path.replace("/", os.sep)
+
+
+def file_sha1(path):
+    """Returns the SHA-1 hex digest of the file at path."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class PackIndex(object):
+
+    def __init__(self):
+        # sha1 digest -> (data offset, compressed size, size)
+        self.blobs = {}
+        self.manifest = None
+        self.manifest_size = 0
+        # offset after the last complete record
+        self.end = 0
+
+    def live_size(self):
+        """Returns the number of bytes referenced by the last manifest."""
+        size = len(MAGIC) + self.manifest_size
+        if self.manifest is None:
+            return size
+        for digest in set(entry[0] for entry in
+                          self.manifest["files"].values()):
+            blob = self.blobs.get(bytes.fromhex(digest))
+            if blob is not None:
+                size += RECORD.size + BLOB_HEADER.size + blob[1]
+        return size
+
+
+class GameStateStore(object):
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, PACK_NAME)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read_index(self):
+        index = PackIndex()
+        if not os.path.exists(self.path):
+            return index
+        with open(self.path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if len(magic) < len(MAGIC):
+                # interrupted while creating the pack, treated as empty
+                return index
+            if magic != MAGIC:
+                f.close()
+                self._move_aside()
+                return index
+            file_size = os.fstat(f.fileno()).st_size
+            offset = len(MAGIC)
+            index.end = offset
+            while True:
+                data = f.read(RECORD.size)
+                if len(data) < RECORD.size:
+                    break
+                kind, length = RECORD.unpack(data)
+                data_offset = offset + RECORD.size
+                if data_offset + length > file_size:
+                    break
+                if kind == BLOB:
+                    if length < BLOB_HEADER.size:
+                        # placeholder of a blob which was being written
+                        break
+                    digest, size = BLOB_HEADER.unpack(
+                        f.read(BLOB_HEADER.size))
+                    index.blobs[digest] = (
+                        data_offset + BLOB_HEADER.size,
+                        length - BLOB_HEADER.size, size)
+                    f.seek(data_offset + length)
+                elif kind == MANIFEST:
+                    try:
+                        index.manifest = json.loads(
+                            zlib.decompress(f.read(length)).decode("UTF-8"))
+                    except (zlib.error, ValueError):
+                        break
+                    index.manifest_size = RECORD.size + length
+                else:
+                    break
+                offset = data_offset + length
+                index.end = offset
+        return index
+
+    def _move_aside(self):
+        bad_path = "{0}.bad-{1}".format(self.path, int(time.time()))
+        print("[STATE] {0} is not a game state pack, moving it to {1}".format(
+            self.path, bad_path))
+        os.replace(self.path, bad_path)
+
+    def stored_files(self):
+        """Returns a dictionary mapping relative paths to (SHA-1 hex digest,
+        size) for the files stored in the last save point."""
+        index = self.read_index()
+        if index.manifest is None:
+            return {}
+        return {from_store_path(store_path): tuple(entry)
+                for store_path, entry in index.manifest["files"].items()}
+
+    def restore(self, dest_dir):
+        """Applies the stored changes to dest_dir. Returns the number of
+        files written."""
+        index = self.read_index()
+        if index.manifest is None:
+            return 0
+        for store_path in index.manifest["deleted"]:
+            rel_path = from_store_path(store_path)
+            print("- removing file", rel_path)
+            dest_path = os.path.join(dest_dir, rel_path)
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            else:
+                print("  (already gone)")
+        files = []
+        for store_path, (digest, size) in index.manifest["files"].items():
+            try:
+                blob = index.blobs[bytes.fromhex(digest)]
+            except KeyError:
+                raise StateStoreError(
+                    "Missing data for {0} in {1}".format(
+                        store_path, self.path))
+            files.append((blob[0], blob[1], from_store_path(store_path)))
+        # read blobs in pack order
+        files.sort()
+        with open(self.path, "rb") as f:
+            for offset, length, rel_path in files:
+                print("- updating file", rel_path)
+                dest_path = os.path.join(dest_dir, rel_path)
+                if not os.path.isdir(os.path.dirname(dest_path)):
+                    os.makedirs(os.path.dirname(dest_path))
+                if os.path.exists(dest_path):
+                    # the file can be a clone of a file in the prepared
+                    # drive cache, so it is replaced instead of overwritten
+                    os.remove(dest_path)
+                f.seek(offset)
+                self._copy_blob(f, length, dest_path)
+        return len(files)
+
+    @staticmethod
+    def _copy_blob(f, length, dest_path):
+        decompressor = zlib.decompressobj()
+        with open(dest_path, "wb") as out:
+            while length > 0:
+                data = f.read(min(CHUNK_SIZE, length))
+                if not data:
+                    raise StateStoreError("Unexpected end of pack")
+                length -= len(data)
+                out.write(decompressor.decompress(data))
+            out.write(decompressor.flush())
+
+    def save(self, source_dir, changed, deleted):
+        """Stores the files changed (paths relative to source_dir) and
+        deleted since the last save point, as a new save point."""
+        index = self.read_index()
+        if index.manifest is None:
+            manifest = {"files": {}, "deleted": []}
+        else:
+            manifest = index.manifest
+        files = manifest["files"]
+        deleted_set = set(manifest["deleted"])
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        if index.end == 0:
+            # a new pack is written to a temporary file, so an interrupted
+            # save does not leave a broken pack behind
+            pack_path = self.path + ".partial"
+            mode = "w+b"
+        else:
+            pack_path = self.path
+            mode = "r+b"
+        with open(pack_path, mode) as f:
+            if index.end == 0:
+                f.write(MAGIC)
+                index.end = len(MAGIC)
+            # discard an incomplete record from an interrupted save
+            f.seek(index.end)
+            f.truncate()
+            for rel_path in sorted(changed):
+                digest, size = self._append_blob(
+                    f, os.path.join(source_dir, rel_path), index)
+                store_path = to_store_path(rel_path)
+                files[store_path] = [digest, size]
+                deleted_set.discard(store_path)
+            for rel_path in deleted:
+                store_path = to_store_path(rel_path)
+                files.pop(store_path, None)
+                deleted_set.add(store_path)
+            manifest["deleted"] = sorted(deleted_set)
+            manifest["time"] = int(time.time())
+            data = zlib.compress(json.dumps(
+                manifest, sort_keys=True).encode("UTF-8"))
+            f.write(RECORD.pack(MANIFEST, len(data)))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            index.manifest = manifest
+            index.manifest_size = RECORD.size + len(data)
+            index.end = f.tell()
+        if pack_path != self.path:
+            os.replace(pack_path, self.path)
+        if index.end > COMPACT_MIN_SIZE and \
+                index.live_size() * 2 < index.end:
+            self.compact()
+
+    def _append_blob(self, f, path, index):
+        start = f.tell()
+        f.write(RECORD.pack(BLOB, 0))
+        f.write(BLOB_HEADER.pack(b"\0" * 20, 0))
+        h = hashlib.sha1()
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        size = 0
+        with open(path, "rb") as src:
+            while True:
+                data = src.read(CHUNK_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                h.update(data)
+                f.write(compressor.compress(data))
+        f.write(compressor.flush())
+        digest = h.digest()
+        if digest in index.blobs:
+            # already stored, discard the data written
+            f.seek(start)
+            f.truncate()
+            return digest.hex(), size
+        end = f.tell()
+        length = end - start - RECORD.size
+        f.seek(start)
+        f.write(RECORD.pack(BLOB, length))
+        f.write(BLOB_HEADER.pack(digest, size))
+        f.seek(end)
+        index.blobs[digest] = (
+            start + RECORD.size + BLOB_HEADER.size,
+            length - BLOB_HEADER.size, size)
+        return digest.hex(), size
+
+    def compact(self):
+        """Rewrites the pack with only the data referenced by the last
+        save point."""
+        index = self.read_index()
+        if index.manifest is None:
+            return
+        print("[STATE] Compacting", self.path)
+        temp_path = self.path + ".partial"
+        written = set()
+        with open(self.path, "rb") as f, open(temp_path, "wb") as out:
+            out.write(MAGIC)
+            for store_path in sorted(index.manifest["files"]):
+                digest = bytes.fromhex(
+                    index.manifest["files"][store_path][0])
+                if digest in written:
+                    continue
+                offset, length, size = index.blobs[digest]
+                out.write(RECORD.pack(BLOB, BLOB_HEADER.size + length))
+                out.write(BLOB_HEADER.pack(digest, size))
+                f.seek(offset)
+                while length > 0:
+                    data = f.read(min(CHUNK_SIZE, length))
+                    length -= len(data)
+                    out.write(data)
+                written.add(digest)
+            data = zlib.compress(json.dumps(
+                index.manifest, sort_keys=True).encode("UTF-8"))
+            out.write(RECORD.pack(MANIFEST, len(data)))
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp_path, self.path)
+
+    def usage(self):
+        """Returns (pack size, bytes referenced by the last save point,
+        number of files changed) in bytes."""
+        if not os.path.exists(self.path):
+            return 0, 0, 0
+        index = self.read_index()
+        files = len(index.manifest["files"]) if index.manifest else 0
+        return os.path.getsize(self.path), index.live_size(), files
+
+
+def tree_size(path):
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, name))
+            except OSError:
+                pass
+    return total
+
+
+def game_state_dirs(save_states_dir):
+    """Returns the game state dirs in save_states_dir. State dirs are
+    direct subdirectories, or (legacy) in single-letter subdirectories."""
+    result = []
+    for name in sorted(os.listdir(save_states_dir)):
+        path = os.path.join(save_states_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if len(name) == 1:
+            for sub_name in sorted(os.listdir(path)):
+                sub_path = os.path.join(path, sub_name)
+                if os.path.isdir(sub_path):
+                    result.append(sub_path)
+        else:
+            result.append(path)
+    return result
+
+
+def state_dirs_usage(save_states_dir, stop_check=None):
+    """Returns a list of (state dir, total size, pack size, referenced pack
+    size) for all game state dirs in save_states_dir, largest first. Total
+    size includes save states and other files in the state dir. If given,
+    stop_check is called before each state dir."""
+    result = []
+    for path in game_state_dirs(save_states_dir):
+        if stop_check is not None:
+            stop_check()
+        try:
+            pack_size, live_size, _ = GameStateStore(path).usage()
+        except StateStoreError:
+            pack_size, live_size = 0, 0
+        result.append((path, tree_size(path), pack_size, live_size))
+    result.sort(key=lambda x: (-x[1], x[0]))
+    return result
@@ -19,5 +19,9 @@ class SignalContext(ContextAware):
         signal = "fsgs:" + signal
         Signal(signal).notify(*args)
 
+    def notify_all(self, signal, args_list):
+        signal = "fsgs:" + signal
+        Signal(signal).notify_all(args_list)
+
     def process(self):
         Signal.process_all_signals()
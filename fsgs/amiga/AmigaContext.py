@@ -43,7 +43,7 @@ class AmigaContext(BaseContext):
 
     def insert_floppy(self, drive, path, sha1=None):
         if sha1 is None:
-            sha1 = ChecksumTool().checksum(path)
+            sha1 = ChecksumTool().checksum_cached(path)
         default_dir = FSGSDirectories.get_floppies_dir()
         path = Paths.contract_path(path, default_dir)
         self.set_config([
@@ -85,7 +85,7 @@ class AmigaContext(BaseContext):
         default_dir = FSGSDirectories.get_floppies_dir()
         checksum_tool = ChecksumTool()
         for i, path in enumerate(paths):
-            sha1 = checksum_tool.checksum(path)
+            sha1 = checksum_tool.checksum_cached(path)
             path = Paths.contract_path(path, default_dir)
 
             if i < 4:
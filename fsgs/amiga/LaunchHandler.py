@@ -7,8 +7,9 @@ import tempfile
 import unittest
 import traceback
 import zlib
+import fsbc.settings
 from fsbc.paths import Paths
-from fsbc.task import current_task, TaskFailure
+from fsbc.task import current_task, TaskFailure, TaskGraph, parallel_map
 from fsbc.resources import Resources
 from fsgs.Archive import Archive
 from fsgs.Downloader import Downloader
@@ -18,6 +19,8 @@ from fsgs.amiga.ADFFileExtractor import ADFFileExtractor
 from fsgs.amiga.Amiga import Amiga
 from fsgs.amiga.ConfigWriter import ConfigWriter
 from fsgs.amiga.FSUAE import FSUAE
+from fsgs.amiga.PreparedDriveCache import PreparedDriveCache, create_key, \
+    file_signature, tree_signature
 from fsgs.amiga.ROMManager import ROMManager
 from fsgs.amiga.whdload import DEFAULT_WHDLOAD_VERSION, whdload_files, \
     whdload_support_files, default_whdload_prefs
@@ -25,6 +28,10 @@ from fsgs.amiga.workbench import WorkbenchExtractor
 from fsgs.res import gettext
 from .roms import PICASSO_IV_74_ROM, CD32_FMV_ROM
 
+# number of threads used to prepare independent parts of the launch, and
+# to copy files within each part
+PREPARE_WORKERS = 4
+
 
 class LaunchHandler(object):
 
@@ -54,6 +61,7 @@ class LaunchHandler(object):
 
         self.temp_dir = ""
         self.change_handler = None
+        self.drive_cache = None
 
     @property
     def stop_flag(self):
@@ -69,7 +77,13 @@ class LaunchHandler(object):
 
     def prepare(self):
         print("LaunchHandler.prepare")
-        self.temp_dir = tempfile.mkdtemp(prefix="fs-uae-")
+        self.drive_cache = PreparedDriveCache.default()
+        if self.drive_cache is not None:
+            # on the same file system as the cache, for reflinks
+            self.temp_dir = tempfile.mkdtemp(
+                prefix="fs-uae-", dir=self.drive_cache.temp_dir())
+        else:
+            self.temp_dir = tempfile.mkdtemp(prefix="fs-uae-")
         print("temp dir", self.temp_dir)
         self.config["floppies_dir"] = self.temp_dir
         print("state dir", self.get_state_dir())
@@ -77,24 +91,25 @@ class LaunchHandler(object):
         self.config["save_states_dir"] = ""
         self.config["floppy_overlays_dir"] = ""
         self.config["flash_memory_dir"] = ""
-        self.change_handler = GameChangeHandler(self.temp_dir)
-
-        self.prepare_roms()
-        if self.stop_flag:
-            return
-        self.prepare_floppies()
-        if self.stop_flag:
-            return
-        self.prepare_cdroms()
-        if self.stop_flag:
-            return
-        self.prepare_hard_drives()
-        if self.stop_flag:
-            return
-        self.copy_hd_files()
-        if self.stop_flag:
-            return
-        self.init_changes()
+        self.change_handler = GameChangeHandler(
+            self.temp_dir,
+            watch=fsbc.settings.get("watch_game_changes") == "1")
+
+        # ROMs, floppies, CD-ROMs and hard drives are copied to different
+        # files in the temp dir and can be prepared at the same time.
+        # Changes are restored on top of all of them.
+        graph = TaskGraph(PREPARE_WORKERS)
+        graph.add("roms", self.prepare_roms)
+        graph.add("floppies", self.prepare_floppies)
+        graph.add("cdroms", self.prepare_cdroms)
+        graph.add("drives", self.prepare_drives)
+        graph.add("changes", self.init_changes,
+                  ["roms", "floppies", "cdroms", "drives"])
+        try:
+            graph.run()
+        finally:
+            print("LaunchHandler.prepare timings:")
+            print(graph.report())
         if self.stop_flag:
             return
         self.prepare_theme()
@@ -239,17 +254,34 @@ class LaunchHandler(object):
             self.fsgs.file.copy_game_file(src, dst)
             self.config[key] = os.path.basename(dst)
 
+    def prepare_floppies_for_keys(self, keys):
+        # Keys with the same value are prepared one after another, since
+        # they are copied to the same file.
+        groups = {}
+        for key in keys:
+            value = self.config.get(key, "").strip()
+            if value:
+                groups.setdefault(value, []).append(key)
+
+        def prepare_group(group_keys):
+            for key in group_keys:
+                self.prepare_floppy(key)
+
+        parallel_map(prepare_group, groups.values(), PREPARE_WORKERS)
+
     def prepare_floppies(self):
         print("LaunchHandler.copy_floppies")
         current_task.set_progress(gettext("Preparing floppy images..."))
         # self.on_progress(gettext("Preparing floppy images..."))
 
         floppies = []
+        keys = []
         for i in range(Amiga.MAX_FLOPPY_DRIVES):
             key = "floppy_drive_{0}".format(i)
             if self.config.get(key, ""):
                 floppies.append(self.config[key])
-            self.prepare_floppy(key)
+            keys.append(key)
+        self.prepare_floppies_for_keys(keys)
 
         for i in range(Amiga.MAX_FLOPPY_IMAGES):
             key = "floppy_image_{0}".format(i)
@@ -260,10 +292,11 @@ class LaunchHandler(object):
             for j, floppy in enumerate(floppies):
                 self.config["floppy_image_{0}".format(j)] = floppy
 
+        keys = ["floppy_image_{0}".format(i)
+                for i in range(Amiga.MAX_FLOPPY_IMAGES)]
+        self.prepare_floppies_for_keys(keys)
         max_image = -1
-        for i in range(Amiga.MAX_FLOPPY_IMAGES):
-            key = "floppy_image_{0}".format(i)
-            self.prepare_floppy(key)
+        for i, key in enumerate(keys):
             if self.config.get(key, ""):
                 max_image = i
 
@@ -290,7 +323,8 @@ class LaunchHandler(object):
         if cdrom_drive_0.startswith("game:"):
             scheme, dummy, game_uuid, name = cdrom_drive_0.split("/")
             file_list = self.get_file_list_for_game_uuid(game_uuid)
-            for file_item in file_list:
+
+            def copy_cdrom_file(file_item):
                 src = self.fsgs.file.find_by_sha1(file_item["sha1"])
 
                 src, archive = self.expand_default_path(
@@ -301,6 +335,8 @@ class LaunchHandler(object):
                 dst = os.path.join(self.temp_dir, dst_name)
                 self.fsgs.file.copy_game_file(src, dst)
 
+            parallel_map(copy_cdrom_file, file_list, PREPARE_WORKERS)
+
             cue_sheets = self.get_cue_sheets_for_game_uuid(game_uuid)
             for cue_sheet in cue_sheets:
                 with open(os.path.join(self.temp_dir,
@@ -336,11 +372,123 @@ class LaunchHandler(object):
             for j, cdrom in enumerate(cdroms):
                 self.config["cdrom_image_{0}".format(j)] = cdrom
 
+    def prepare_drives(self):
+        """Prepares hard drives and hard drive files (WHDLoad etc). The
+        result is stored in the prepared drive cache, and restored from it
+        on later launches, when it only depends on the game database, the
+        config and files found by checksum."""
+        key = None
+        if self.drive_cache is not None:
+            key = self.prepared_drive_cache_key()
+        if key is not None:
+            metadata = self.drive_cache.restore(key, self.temp_dir)
+            if metadata is not None:
+                self.restore_prepared_drive_metadata(metadata)
+                return
+        config = self.config.copy()
+        self.prepare_hard_drives()
+        if self.stop_flag:
+            return
+        self.copy_hd_files()
+        if self.stop_flag or key is None:
+            return
+        # other files are prepared in the temp dir at the same time, so
+        # only the hard drive directories are stored
+        names = set()
+        for i in range(0, 10):
+            path = self.config.get("hard_drive_{0}".format(i), "")
+            if path.startswith(self.temp_dir + os.sep):
+                names.add(path[len(self.temp_dir) + 1:].split(os.sep)[0])
+        self.drive_cache.store(
+            key, self.temp_dir, sorted(names),
+            self.prepared_drive_metadata(config))
+
+    def prepared_drive_cache_key(self):
+        """Returns a key for everything prepare_hard_drives and
+        copy_hd_files depend on, or None when the result cannot be
+        cached."""
+        drives = []
+        for i in range(0, 10):
+            src = self.config.get("hard_drive_{0}".format(i), "")
+            if not src:
+                continue
+            if not src.startswith("hd://game/"):
+                return None
+            scheme, dummy, dummy, game_uuid, drive = src.split("/")
+            file_list = self.get_file_list_for_game_uuid(game_uuid)
+            drives.append([i, src, [
+                file_entry for file_entry in file_list
+                if file_entry["name"].startswith(drive + "/")]])
+            # prepare_hard_drives stops after the first game drive
+            break
+        values = [self.config.get(key, "") for key in [
+            "x_whdload_args", "x_hdinst_args", "hd_startup"]]
+        if not drives and not any(values):
+            return None
+        for key in ["amiga_model", "x_whdload_version",
+                    "whdload_splash_delay", "unsafe_save_states",
+                    "hard_drive_0", "__netplay_game"]:
+            values.append(self.config.get(key, ""))
+        # files which are used if they are found
+        checksums = list(workbench_disks_with_setpatch_39_6)
+        for name, kickstart_checksums in whdload_kickstarts:
+            checksums.extend(kickstart_checksums)
+        found = [bool(self.fsgs.file.find_by_sha1(checksum))
+                 for checksum in checksums]
+        base_dir = self.fsgs.amiga.get_base_dir()
+        user_files = [
+            file_signature(os.path.join(base_dir, "WHDLoad.key")),
+            file_signature(os.path.join(base_dir, "WHDLoad.prefs")),
+        ]
+        whdload_dir = self.fsgs.amiga.get_whdload_dir()
+        if whdload_dir and os.path.exists(whdload_dir):
+            user_files.append(tree_signature(whdload_dir))
+        return create_key(drives, values, sorted(self.hd_requirements),
+                          found, user_files)
+
+    def prepared_drive_metadata(self, old_config):
+        # Config values refer to the temp dir, which is different for each
+        # launch. Only hard drive keys (and save_states) are changed while
+        # preparing hard drives.
+        config = {}
+        for key, value in list(self.config.items()):
+            if not key.startswith("hard_drive_") and key != "save_states":
+                continue
+            if old_config.get(key) != value:
+                if isinstance(value, str):
+                    value = value.replace(self.temp_dir, "$TEMP")
+                config[key] = value
+        return {
+            "config": config,
+            "hd_requirements": sorted(self.hd_requirements),
+            "setpatch_installed": self.setpatch_installed,
+        }
+
+    def restore_prepared_drive_metadata(self, metadata):
+        for key, value in metadata["config"].items():
+            if isinstance(value, str):
+                value = value.replace("$TEMP", self.temp_dir)
+            self.config[key] = value
+        self.hd_requirements = set(metadata["hd_requirements"])
+        self.setpatch_installed = metadata["setpatch_installed"]
+
     def prepare_hard_drives(self):
         print("LaunchHandler.prepare_hard_drives")
         current_task.set_progress(gettext("Preparing hard drives..."))
         # self.on_progress(gettext("Preparing hard drives..."))
 
+        urls = []
+        for i in range(0, 10):
+            src = self.config.get("hard_drive_{0}".format(i), "")
+            if src.startswith("http://") or src.startswith("https://"):
+                urls.append(src)
+            elif src.startswith("hd://"):
+                break
+        if len(urls) > 1:
+            # download all hard drives at the same time
+            self.on_progress(gettext("Downloading hard drives..."))
+            Downloader.cache_files_from_urls(urls)
+
         for i in range(0, 10):
             key = "hard_drive_{0}".format(i)
             src = self.config.get(key, "")
@@ -469,6 +617,7 @@ class LaunchHandler(object):
         dir_name = "DH{0}".format(drive_index)
         dir_path = os.path.join(self.temp_dir, dir_name)
         file_list = self.get_file_list_for_game_uuid(game_uuid)
+        files = []
         for file_entry in file_list:
             if self.stop_flag:
                 return
@@ -497,6 +646,10 @@ class LaunchHandler(object):
                 continue
             if not os.path.exists(os.path.dirname(dst_file)):
                 os.makedirs(os.path.dirname(dst_file))
+            files.append((file_entry, amiga_rel_path, dst_file))
+
+        def copy_file(item):
+            file_entry, amiga_rel_path, dst_file = item
             sha1 = file_entry["sha1"]
 
             # current_task.set_progress(os.path.basename(dst_file))
@@ -520,7 +673,10 @@ class LaunchHandler(object):
                 metadata[4] = self.encode_file_comment(file_entry["comment"])
             with open(dst_file + ".uaem", "wb") as out_file:
                 out_file.write("".join(metadata).encode("UTF-8"))
-            
+
+        parallel_map(copy_file, files, PREPARE_WORKERS)
+        if self.stop_flag:
+            return
         self.config["hard_drive_{0}".format(drive_index)] = dir_path
 
     def encode_file_comment(self, comment):
@@ -669,25 +825,22 @@ class LaunchHandler(object):
         print("WHDLoad dir:", repr(whdload_dir))
         print("WHDLoad args:", whdload_args)
 
-        self.copy_whdload_kickstart(
-            dest_dir, "kick34005.A500",
-            ["891e9a547772fe0c6c19b610baf8bc4ea7fcb785"])
-        self.copy_whdload_kickstart(
-            dest_dir, "kick40068.A1200",
-            ["e21545723fe8374e91342617604f1b3d703094f1"])
-        self.copy_whdload_kickstart(
-            dest_dir, "kick40068.A4000",
-            ["5fe04842d04a489720f0f4bb0e46948199406f49"])
         self.create_whdload_prefs_file(os.path.join(s_dir, "WHDLoad.prefs"))
 
         whdload_version = self.config["x_whdload_version"]
         if not whdload_version:
             whdload_version = DEFAULT_WHDLOAD_VERSION
 
+        # kickstarts and WHDLoad files are independent of each other
+        jobs = []
+        for name, checksums in whdload_kickstarts:
+            jobs.append((self.copy_whdload_kickstart,
+                         (dest_dir, name, checksums)))
         for key, value in whdload_files[whdload_version].items():
-            self.install_whdload_file(key, dest_dir, value)
+            jobs.append((self.install_whdload_file, (key, dest_dir, value)))
         for key, value in whdload_support_files.items():
-            self.install_whdload_file(key, dest_dir, value)
+            jobs.append((self.install_whdload_file, (key, dest_dir, value)))
+        parallel_map(lambda job: job[0](*job[1]), jobs, PREPARE_WORKERS)
 
         if self.config.get("__netplay_game", ""):
             print("WHDLoad key is not copied in net play mode")
@@ -833,8 +986,7 @@ class LaunchHandler(object):
 
     def copy_whdload_kickstart(self, base_dir, name, checksums):
         dest = os.path.join(base_dir, "Devs", "Kickstarts")
-        if not os.path.exists(dest):
-            os.makedirs(dest)
+        os.makedirs(dest, exist_ok=True)
         dest = os.path.join(dest, name)
         for checksum in checksums:
             # print("find kickstart with sha1", checksum)
@@ -874,6 +1026,8 @@ class LaunchHandler(object):
     def cleanup(self):
         print("LaunchHandler.cleanup")
         self.on_progress(gettext("Cleaning up..."))
+        if self.change_handler is not None:
+            self.change_handler.close()
         # self.delete_tree(self.temp_dir)
         shutil.rmtree(self.temp_dir, ignore_errors=True)
         state_dir = self.get_state_dir()
@@ -1060,6 +1214,12 @@ system_configuration = (
     b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00"
     b"\x00")
 
+whdload_kickstarts = [
+    ("kick34005.A500", ["891e9a547772fe0c6c19b610baf8bc4ea7fcb785"]),
+    ("kick40068.A1200", ["e21545723fe8374e91342617604f1b3d703094f1"]),
+    ("kick40068.A4000", ["5fe04842d04a489720f0f4bb0e46948199406f49"]),
+]
+
 workbench_disks_with_setpatch_39_6 = [
     # Workbench v3.0 rev 39.29 (1992)(Commodore)(A1200-A4000)(M10)
     # (Disk 1 of 6)(Install).adf
@@ -0,0 +1,262 @@
+"""
+Cache of prepared hard drive trees.
+
+Preparing a hard drive for a game (files from the game database, Workbench
+files, WHDLoad and kickstarts) involves looking up, extracting and copying
+every file. The prepared trees are stored in the cache under a key computed
+from everything the preparation depends on, and later launches materialize
+the tree from the cache with reflinks (copy-on-write clones) where the file
+system supports them, and copies otherwise.
+
+Files are never hard linked between the cache and a launch directory, since
+the emulator can write to the files in place. The size and modification
+time of each cached file is recorded, and entries where these have changed
+(modified outside the launcher) are discarded instead of restored.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import traceback
+from uuid import uuid4
+
+import fsbc.settings
+from fsgs.FSGSDirectories import FSGSDirectories
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+TREE_NAME = "tree"
+DEFAULT_CACHE_SIZE = 1024
+# temporary launch directories are removed by eviction after this time, if
+# they were not cleaned up (the launcher crashed)
+STALE_TEMP_DIR_AGE = 7 * 24 * 60 * 60
+# ioctl to clone a file (Linux, supported by btrfs and xfs among others)
+FICLONE = 0x40049409
+
+
+def prepared_drive_cache_size():
+    """Maximum size of the prepared drive cache, in bytes."""
+    try:
+        size = int(fsbc.settings.get("prepared_drive_cache_size"))
+    except ValueError:
+        size = DEFAULT_CACHE_SIZE
+    return max(0, size) * 1024 * 1024
+
+
+# set to False when the first reflink attempt fails
+use_reflinks = fcntl is not None and hasattr(fcntl, "ioctl")
+
+
+def clone_file(src, dst):
+    """Creates dst with the same contents as src, as a reflink if
+    possible, else as a copy. Returns the method used."""
+    global use_reflinks
+    if use_reflinks:
+        try:
+            with open(src, "rb") as f_src:
+                with open(dst, "wb") as f_dst:
+                    fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            use_reflinks = False
+            if os.path.exists(dst):
+                os.remove(dst)
+        else:
+            shutil.copystat(src, dst)
+            return "reflink"
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def create_key(*parts):
+    """Returns a cache key for the (JSON serializable) values in parts."""
+    data = json.dumps([CACHE_VERSION, parts], sort_keys=True)
+    return hashlib.sha1(data.encode("UTF-8")).hexdigest()
+
+
+def file_signature(path):
+    """Returns (size, mtime_ns) for a file, or None if it does not
+    exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def tree_signature(path):
+    """Returns a sorted list of (relative path, size, mtime_ns) for all
+    files under path."""
+    result = []
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            st = os.stat(file_path)
+            result.append([os.path.relpath(file_path, path),
+                           st.st_size, st.st_mtime_ns])
+    result.sort()
+    return result
+
+
+class PreparedDriveCache(object):
+
+    @classmethod
+    def default(cls):
+        """Returns the cache in the FS-UAE cache directory, or None when
+        the cache is disabled."""
+        max_size = prepared_drive_cache_size()
+        if not max_size:
+            return None
+        return cls(os.path.join(FSGSDirectories.get_cache_dir(),
+                                "PreparedDrives"), max_size)
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def temp_dir(self):
+        """Returns a directory for temporary launch directories, on the
+        same file system as the cache so files can be reflinked."""
+        path = os.path.join(self.path, "Temp")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def restore(self, key, dest_dir):
+        """Materializes the cached tree for key in dest_dir. Returns the
+        metadata stored with the entry, or None if there is no (valid)
+        entry."""
+        entry_path = self.entry_path(key)
+        manifest_path = os.path.join(entry_path, MANIFEST_NAME)
+        try:
+            with open(manifest_path, "r", encoding="UTF-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        tree_path = os.path.join(entry_path, TREE_NAME)
+        for rel_path, signature in manifest["files"].items():
+            if file_signature(os.path.join(tree_path, rel_path)) != \
+                    signature:
+                print("[DRIVECACHE] Cached file changed:", rel_path)
+                self.remove(key)
+                return None
+        methods = {}
+        for rel_path in manifest["dirs"]:
+            os.makedirs(os.path.join(dest_dir, rel_path), exist_ok=True)
+        for rel_path in manifest["files"]:
+            method = clone_file(os.path.join(tree_path, rel_path),
+                                os.path.join(dest_dir, rel_path))
+            methods[method] = methods.get(method, 0) + 1
+        # the manifest modification time is used for LRU eviction
+        os.utime(manifest_path, None)
+        print("[DRIVECACHE] Restored", key, methods)
+        return manifest["metadata"]
+
+    def store(self, key, src_dir, names, metadata):
+        """Stores the files and directories names (relative to src_dir)
+        in the cache, with metadata (a JSON serializable dictionary)."""
+        entry_path = self.entry_path(key)
+        if os.path.exists(entry_path):
+            return
+        temp_path = "{0}.partial.{1}".format(entry_path, uuid4())
+        tree_path = os.path.join(temp_path, TREE_NAME)
+        manifest = {"dirs": [], "files": {}, "size": 0,
+                    "metadata": metadata}
+        try:
+            os.makedirs(tree_path)
+            for name in names:
+                self._store_tree(src_dir, name, tree_path, manifest)
+            with open(os.path.join(temp_path, MANIFEST_NAME), "w",
+                      encoding="UTF-8") as f:
+                json.dump(manifest, f)
+            os.rename(temp_path, entry_path)
+        except Exception:
+            traceback.print_exc()
+            print("[DRIVECACHE] Could not store", key)
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        print("[DRIVECACHE] Stored", key, manifest["size"], "bytes")
+        self.evict()
+
+    def _store_tree(self, src_dir, name, tree_path, manifest):
+        src_path = os.path.join(src_dir, name)
+        if os.path.isfile(src_path):
+            paths = [(src_dir, [], [name])]
+        else:
+            manifest["dirs"].append(name)
+            paths = os.walk(src_path)
+        for dir_path, dir_names, file_names in paths:
+            rel_dir = os.path.relpath(dir_path, src_dir)
+            for dir_name in dir_names:
+                manifest["dirs"].append(os.path.join(rel_dir, dir_name))
+                os.makedirs(os.path.join(tree_path, rel_dir, dir_name))
+            for file_name in file_names:
+                rel_path = os.path.normpath(os.path.join(rel_dir, file_name))
+                dst = os.path.join(tree_path, rel_path)
+                if not os.path.exists(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                clone_file(os.path.join(src_dir, rel_path), dst)
+                signature = file_signature(dst)
+                manifest["files"][rel_path] = signature
+                manifest["size"] += signature[0]
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def entries(self):
+        """Returns a list of (last used time, size, key) for all entries,
+        least recently used first."""
+        result = []
+        if not os.path.exists(self.path):
+            return result
+        for prefix in os.listdir(self.path):
+            if len(prefix) != 2:
+                continue
+            prefix_path = os.path.join(self.path, prefix)
+            for key in os.listdir(prefix_path):
+                manifest_path = os.path.join(
+                    prefix_path, key, MANIFEST_NAME)
+                try:
+                    last_used = os.path.getmtime(manifest_path)
+                    with open(manifest_path, "r", encoding="UTF-8") as f:
+                        size = json.load(f)["size"]
+                except (OSError, ValueError, KeyError):
+                    # partial or broken entry
+                    continue
+                result.append((last_used, size, key))
+        result.sort()
+        return result
+
+    def usage(self):
+        """Returns the total size of all cached trees, in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is not
+        larger than max_size, and stale temporary directories."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, key in entries:
+            if total <= self.max_size:
+                break
+            print("[DRIVECACHE] Evicting", key, size, "bytes")
+            self.remove(key)
+            total -= size
+        temp_dir = os.path.join(self.path, "Temp")
+        if os.path.exists(temp_dir):
+            t = time.time()
+            for name in os.listdir(temp_dir):
+                path = os.path.join(temp_dir, name)
+                try:
+                    if t - os.path.getmtime(path) > STALE_TEMP_DIR_AGE:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    pass
@@ -1,6 +1,120 @@
 import os
+import json
 import hashlib
+import threading
+import traceback
+from uuid import uuid4
 from fsgs.Archive import Archive
+from fsgs.FSGSDirectories import FSGSDirectories
+
+ENCRYPTED_HEADER = b"AMIROMTYPE1"
+
+# Known bad dumps / modified versions of kickstarts, and the changes needed
+# to turn them into the original ROMs: (size to truncate to or None,
+# [(offset, byte), ...], resulting SHA-1)
+ROM_PATCHES = {
+    "c39bd9094d4e5f4e28c1411f3086950406062e87": (
+        None, [(413, 0x08), (176029, 0xb9), (262121, 0x26)],
+        "891e9a547772fe0c6c19b610baf8bc4ea7fcb785"),
+    # from Kickstart v1.3 rev 34.5 (1987)(Commodore)
+    # (A500-A1000-A2000-CDTV)[o].rom
+    "90933936cce43ca9bc6bf375662c076b27e3c458": (
+        262144, [],
+        "891e9a547772fe0c6c19b610baf8bc4ea7fcb785"),
+    # from Kickstart v3.1 r40.68 (1993)(Commodore)(A4000)[h Cloanto]
+    # to Kickstart v3.1 r40.68 (1993)(Commodore)(A4000)
+    "c3c481160866e60d085e436a24db3617ff60b5f9": (
+        None, [(220, 0x74), (222, 0x7a), (326, 0x70), (434, 0x7c),
+               (524264, 0x45), (524266, 0x14)],
+        "5fe04842d04a489720f0f4bb0e46948199406f49"),
+}
+
+
+def xor_decrypt(data, key):
+    """Returns data XOR-ed with key (repeated as needed)."""
+    if not key:
+        return b""
+    size = len(data)
+    repeated_key = key * (size // len(key) + 1)
+    return (int.from_bytes(data, "little") ^ int.from_bytes(
+        repeated_key[:size], "little")).to_bytes(size, "little")
+
+
+def stat_signature(path):
+    """Returns [size, mtime_ns] for path, or for the archive containing
+    path, or None if it does not exist."""
+    try:
+        st = os.stat(Archive(path).path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class ROMChecksumCache(object):
+    """Persistent cache of decrypted (and patched) ROM checksums, keyed by
+    path and validated by the size and modification time of the ROM (and
+    rom.key file for encrypted ROMs)."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(os.path.join(
+                    FSGSDirectories.get_cache_dir(), "ROMChecksums.json"))
+            return cls._instance
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="UTF-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, path):
+        with self.lock:
+            entry = self._load().get(path)
+        if entry is None:
+            return None
+        signature, key_path, key_signature, sha1 = entry
+        if signature is None or stat_signature(path) != signature:
+            return None
+        if key_path and stat_signature(key_path) != key_signature:
+            return None
+        return sha1
+
+    def set(self, path, sha1, key_path=None):
+        signature = stat_signature(path)
+        if signature is None:
+            return
+        entry = [signature, key_path,
+                 stat_signature(key_path) if key_path else None, sha1]
+        with self.lock:
+            entries = self._load()
+            if entries.get(path) == entry:
+                return
+            entries[path] = entry
+            try:
+                self._save(entries)
+            except OSError:
+                traceback.print_exc()
+
+    def _save(self, entries):
+        temp_path = "{0}.{1}.partial".format(self.path, uuid4())
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(temp_path, "w", encoding="UTF-8") as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
 
 
 class ROMManager(object):
@@ -11,9 +125,8 @@ class ROMManager(object):
             log_function = print
         try:
             archive = Archive(path)
-            rom = ROMManager.decrypt_archive_rom(archive, path)
+            sha1 = ROMManager.decrypted_sha1(archive, path)
         except Exception:
-            import traceback
             traceback.print_exc()
             return
         try:
@@ -24,59 +137,45 @@ class ROMManager(object):
         size = st.st_size
         mtime = int(st.st_mtime)
         log_function("Adding ROM \"{0}\" to database (SHA-1: {1})".format(
-                     path, rom["sha1"]))
+                     path, sha1))
         database.delete_file(path=path)
-        database.add_file(path=path, sha1=rom["sha1"], mtime=mtime, size=size)
+        database.add_file(path=path, sha1=sha1, mtime=mtime, size=size)
+
+    @classmethod
+    def decrypted_sha1(cls, archive, path):
+        """Returns the SHA-1 of the decrypted (and patched) ROM at path,
+        from the ROM checksum cache if the file is unchanged."""
+        cache = ROMChecksumCache.instance()
+        sha1 = cache.get(path)
+        if sha1 is not None:
+            return sha1
+        rom = cls.decrypt_archive_rom(archive, path)
+        cache.set(path, rom["sha1"], rom.get("key_path"))
+        return rom["sha1"]
 
     @classmethod
     def decrypt_archive_rom(cls, archive, path, file=None):
         print("decrypt_archive_rom", path)
         result = {}
         f = archive.open(path)
-        data = f.read(len("AMIROMTYPE1"))
-        out_data = b""
-        sha1 = hashlib.sha1()
-        if data != b"AMIROMTYPE1":
+        data = f.read(len(ENCRYPTED_HEADER))
+        if data != ENCRYPTED_HEADER:
             # not encrypted, write raw data
-            sha1.update(data)
-            out_data += data
-            data = f.read()
-            sha1.update(data)
-            out_data += data
-            result["data"] = out_data
-            result["sha1"] = sha1.hexdigest()
-            cls.patch_rom(result)
-            if file is not None:
-                file.write(result["data"])
-            return result
-
-        key_path = archive.join(archive.dirname(path), "rom.key")
-        key_archive = Archive(key_path)
-        try:
-            f2 = key_archive.open(key_path)
-        except Exception:
-            raise Exception("did not find rom.key to decrypt ROM with")
-        print("using key file", key_path)
-        # if not os.path.exists(key_file):
-        #     raise Exception("did not find rom.key to decrypt ROM with")
-        key_data = f2.read()
-        f2.close()
-
-        while True:
-            data = f.read(len(key_data))
-            if not data:
-                break
-            dec = []
-            for i in range(len(data)):
-                dec.append(data[i] ^ key_data[i])
-            dec_data = bytes(dec)
-            # if file is not None:
-            #     file.write(dec_data)
-            out_data += dec_data
-            if sha1 is not None:
-                sha1.update(dec_data)
-        result["data"] = out_data
-        result["sha1"] = sha1.hexdigest()
+            data += f.read()
+        else:
+            key_path = archive.join(archive.dirname(path), "rom.key")
+            key_archive = Archive(key_path)
+            try:
+                f2 = key_archive.open(key_path)
+            except Exception:
+                raise Exception("did not find rom.key to decrypt ROM with")
+            print("using key file", key_path)
+            key_data = f2.read()
+            f2.close()
+            data = xor_decrypt(f.read(), key_data)
+            result["key_path"] = key_path
+        result["data"] = data
+        result["sha1"] = hashlib.sha1(data).hexdigest()
         cls.patch_rom(result)
         if file is not None:
             file.write(result["data"])
@@ -84,45 +183,15 @@ class ROMManager(object):
 
     @classmethod
     def patch_rom(cls, rom):
-        src_data = rom["data"]
-        dst_data = b""
-
-        if rom["sha1"] == "c39bd9094d4e5f4e28c1411f3086950406062e87":
-            dst_data += src_data[:413]
-            dst_data += b"\x08"
-            dst_data += src_data[414:176029]
-            dst_data += b"\xb9"
-            dst_data += src_data[176030:262121]
-            dst_data += b"\x26"
-            dst_data += src_data[262122:]
-            rom["sha1"] = "891e9a547772fe0c6c19b610baf8bc4ea7fcb785"
-
-        elif rom["sha1"] == "90933936cce43ca9bc6bf375662c076b27e3c458":
-            # from Kickstart v1.3 rev 34.5 (1987)(Commodore)
-            # (A500-A1000-A2000-CDTV)[o].rom
-            dst_data += src_data[:262144]
-            rom["sha1"] = "891e9a547772fe0c6c19b610baf8bc4ea7fcb785"
-
-        elif rom["sha1"] == "c3c481160866e60d085e436a24db3617ff60b5f9":
-            # from Kickstart v3.1 r40.68 (1993)(Commodore)(A4000)[h Cloanto]
-            # to Kickstart v3.1 r40.68 (1993)(Commodore)(A4000)
-            dst_data += src_data[:220]
-            dst_data += b"\x74"
-            dst_data += src_data[221:222]
-            dst_data += b"\x7a"
-            dst_data += src_data[223:326]
-            dst_data += b"\x70"
-            dst_data += src_data[327:434]
-            dst_data += b"\x7c"
-            dst_data += src_data[435:524264]
-            dst_data += b"\x45"
-            dst_data += src_data[524265:524266]
-            dst_data += b"\x14"
-            dst_data += src_data[524267:]
-            rom["sha1"] = "5fe04842d04a489720f0f4bb0e46948199406f49"
-
-        if dst_data:
-            rom["data"] = dst_data
-        sha1 = hashlib.sha1()
-        sha1.update(rom["data"])
-        assert sha1.hexdigest() == rom["sha1"]
+        try:
+            size, patches, sha1 = ROM_PATCHES[rom["sha1"]]
+        except KeyError:
+            return
+        data = bytearray(rom["data"])
+        if size is not None:
+            del data[size:]
+        for offset, value in patches:
+            data[offset] = value
+        assert hashlib.sha1(data).hexdigest() == sha1
+        rom["data"] = data
+        rom["sha1"] = sha1
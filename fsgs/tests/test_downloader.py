@@ -0,0 +1,161 @@
+import hashlib
+import http.client
+import importlib.util
+import os
+import shutil
+import tempfile
+import threading
+import nose.tools
+import fsgs.Downloader
+from fsgs.Downloader import Downloader, DownloadError
+
+
+def load_benchmark():
+    # the file server of the downloader benchmark is used as test server
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "..", "benchmarks", "downloader.py")
+    spec = importlib.util.spec_from_file_location("benchmark_downloader", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ServerFixture(object):
+
+    benchmark = None
+
+    def __init__(self, data):
+        if ServerFixture.benchmark is None:
+            ServerFixture.benchmark = load_benchmark()
+        self.temp_dir = tempfile.mkdtemp()
+        self.sha1 = hashlib.sha1(data).hexdigest()
+        self.server = self.benchmark.FileServer({self.sha1: data}, 0.0, 0.0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/s/sha1/{1}/file".format(
+            self.server.server_address[1], self.sha1)
+        self.path = os.path.join(self.temp_dir, "file")
+
+    def set_data(self, data):
+        self.server.files[self.sha1] = data
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        fsgs.Downloader.connection_pool.close()
+        shutil.rmtree(self.temp_dir)
+
+
+def interrupted_download(fixture):
+    fixture.server.drop_probability = 1.0
+    nose.tools.assert_raises(
+        http.client.IncompleteRead, Downloader._download_partial,
+        fixture.url, fixture.path + ".partial", None)
+    fixture.server.drop_probability = 0.0
+
+
+def test_download():
+    data = os.urandom(100000)
+    fixture = ServerFixture(data)
+    try:
+        Downloader.download_file(fixture.url, fixture.path, fixture.sha1)
+        nose.tools.assert_equals(fixture.read(), data)
+        nose.tools.assert_equals(
+            os.listdir(fixture.temp_dir), [os.path.basename(fixture.path)])
+    finally:
+        fixture.close()
+
+
+def test_resume():
+    data = os.urandom(100000)
+    fixture = ServerFixture(data)
+    try:
+        interrupted_download(fixture)
+        nose.tools.assert_equals(
+            os.path.getsize(fixture.path + ".partial"), len(data) // 2)
+        Downloader.download_file(fixture.url, fixture.path)
+        nose.tools.assert_equals(fixture.server.resumed, 1)
+        nose.tools.assert_equals(fixture.read(), data)
+    finally:
+        fixture.close()
+
+
+def test_resume_changed_file():
+    fixture = ServerFixture(os.urandom(100000))
+    try:
+        interrupted_download(fixture)
+        data = os.urandom(100000)
+        fixture.set_data(data)
+        # If-Range does not match, so the whole file is sent
+        Downloader.download_file(fixture.url, fixture.path)
+        nose.tools.assert_equals(fixture.server.resumed, 0)
+        nose.tools.assert_equals(fixture.read(), data)
+    finally:
+        fixture.close()
+
+
+def test_complete_partial_file():
+    data = os.urandom(100000)
+    fixture = ServerFixture(data)
+    try:
+        interrupted_download(fixture)
+        with open(fixture.path + ".partial", "wb") as f:
+            f.write(data)
+        Downloader.download_file(fixture.url, fixture.path, fixture.sha1)
+        nose.tools.assert_equals(fixture.server.requests, 2)
+        nose.tools.assert_equals(fixture.read(), data)
+    finally:
+        fixture.close()
+
+
+def test_complete_partial_file_without_sha1():
+    data = os.urandom(100000)
+    fixture = ServerFixture(data)
+    try:
+        interrupted_download(fixture)
+        with open(fixture.path + ".partial", "wb") as f:
+            f.write(os.urandom(len(data)))
+        # the range is not satisfiable, and without the SHA-1 the partial
+        # file cannot be trusted, so the download starts over
+        Downloader.download_file(fixture.url, fixture.path)
+        nose.tools.assert_equals(fixture.read(), data)
+    finally:
+        fixture.close()
+
+
+def test_redirect():
+    data = os.urandom(100000)
+    fixture = ServerFixture(data)
+    try:
+        url = fixture.url.replace("/s/", "/redirect/s/")
+        Downloader.download_file(url, fixture.path, fixture.sha1)
+        nose.tools.assert_equals(fixture.server.requests, 2)
+        nose.tools.assert_equals(fixture.read(), data)
+    finally:
+        fixture.close()
+
+
+def test_sha1_mismatch():
+    fixture = ServerFixture(os.urandom(100000))
+    try:
+        fixture.set_data(os.urandom(100000))
+        nose.tools.assert_raises(
+            Exception, Downloader.download_file, fixture.url, fixture.path,
+            fixture.sha1)
+        nose.tools.assert_equals(os.listdir(fixture.temp_dir), [])
+    finally:
+        fixture.close()
+
+
+def test_not_found():
+    fixture = ServerFixture(os.urandom(1000))
+    try:
+        fixture.set_data(None)
+        nose.tools.assert_raises(
+            DownloadError, Downloader.download_file, fixture.url,
+            fixture.path)
+    finally:
+        fixture.close()
@@ -0,0 +1,228 @@
+import os
+import shutil
+import tempfile
+import nose.tools
+from fsgs.GameStateStore import GameStateStore, BLOB, BLOB_HEADER, MAGIC, \
+    MANIFEST, RECORD
+
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read_tree(path):
+    result = {}
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            with open(file_path, "rb") as f:
+                result[os.path.relpath(file_path, path).replace(
+                    os.sep, "/")] = f.read()
+    return result
+
+
+def record_kinds(path):
+    kinds = []
+    with open(path, "rb") as f:
+        f.seek(len(MAGIC))
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            kind, length = RECORD.unpack(data)
+            kinds.append(kind)
+            f.seek(length, os.SEEK_CUR)
+    return kinds
+
+
+class StoreFixture(object):
+
+    def __init__(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, "source")
+        self.dest_dir = os.path.join(self.temp_dir, "dest")
+        os.makedirs(self.dest_dir)
+        self.store = GameStateStore(os.path.join(self.temp_dir, "state"))
+
+    def write(self, rel_path, data):
+        write_file(os.path.join(
+            self.source_dir, rel_path.replace("/", os.sep)), data)
+
+    def close(self):
+        shutil.rmtree(self.temp_dir)
+
+
+def test_save_restore():
+    fixture = StoreFixture()
+    try:
+        fixture.write("S/Startup-Sequence", b"echo hello\n")
+        fixture.write("Data/Game.sav", os.urandom(10000))
+        fixture.store.save(fixture.source_dir, [
+            os.path.join("S", "Startup-Sequence"),
+            os.path.join("Data", "Game.sav")], [])
+        nose.tools.assert_equals(fixture.store.restore(fixture.dest_dir), 2)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), read_tree(fixture.source_dir))
+    finally:
+        fixture.close()
+
+
+def test_dedup_across_save_points():
+    fixture = StoreFixture()
+    try:
+        data = os.urandom(10000)
+        fixture.write("a.dat", data)
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        fixture.write("b.dat", data)
+        fixture.store.save(fixture.source_dir, ["a.dat", "b.dat"], [])
+        index = fixture.store.read_index()
+        nose.tools.assert_equals(len(index.blobs), 1)
+        nose.tools.assert_equals(
+            record_kinds(fixture.store.path),
+            [BLOB, MANIFEST, MANIFEST])
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), {"a.dat": data, "b.dat": data})
+    finally:
+        fixture.close()
+
+
+def test_truncated_record_is_ignored():
+    fixture = StoreFixture()
+    try:
+        fixture.write("a.dat", b"first")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        size = os.path.getsize(fixture.store.path)
+        fixture.write("a.dat", os.urandom(10000))
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        # simulate a crash in the middle of the second save
+        with open(fixture.store.path, "r+b") as f:
+            f.truncate(size + RECORD.size + 100)
+        index = fixture.store.read_index()
+        nose.tools.assert_equals(index.end, size)
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), {"a.dat": b"first"})
+        # the next save overwrites the incomplete record
+        fixture.write("a.dat", b"second")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        nose.tools.assert_equals(
+            record_kinds(fixture.store.path),
+            [BLOB, MANIFEST, BLOB, MANIFEST])
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), {"a.dat": b"second"})
+    finally:
+        fixture.close()
+
+
+def test_compact_keeps_live_blobs():
+    fixture = StoreFixture()
+    try:
+        for i in range(3):
+            fixture.write("a.dat", os.urandom(10000))
+            fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        fixture.write("b.dat", b"unchanged")
+        fixture.store.save(fixture.source_dir, ["b.dat"], [])
+        size = os.path.getsize(fixture.store.path)
+        fixture.store.compact()
+        nose.tools.assert_true(os.path.getsize(fixture.store.path) < size)
+        index = fixture.store.read_index()
+        live = set(bytes.fromhex(digest) for digest, _ in
+                   index.manifest["files"].values())
+        nose.tools.assert_equals(set(index.blobs), live)
+        nose.tools.assert_equals(
+            record_kinds(fixture.store.path), [BLOB, BLOB, MANIFEST])
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), read_tree(fixture.source_dir))
+    finally:
+        fixture.close()
+
+
+def test_deleted_files():
+    fixture = StoreFixture()
+    try:
+        fixture.write("a.dat", b"a")
+        fixture.write("b.dat", b"b")
+        fixture.store.save(fixture.source_dir, ["a.dat", "b.dat"], [])
+        fixture.store.save(fixture.source_dir, [], ["a.dat", "c.dat"])
+        manifest = fixture.store.read_index().manifest
+        nose.tools.assert_equals(sorted(manifest["files"]), ["b.dat"])
+        nose.tools.assert_equals(manifest["deleted"], ["a.dat", "c.dat"])
+        write_file(os.path.join(fixture.dest_dir, "a.dat"), b"original")
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), {"b.dat": b"b"})
+        # a file deleted and later changed again is stored again
+        fixture.write("a.dat", b"again")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        manifest = fixture.store.read_index().manifest
+        nose.tools.assert_equals(
+            sorted(manifest["files"]), ["a.dat", "b.dat"])
+        nose.tools.assert_equals(manifest["deleted"], ["c.dat"])
+    finally:
+        fixture.close()
+
+
+def test_truncated_pack():
+    fixture = StoreFixture()
+    try:
+        os.makedirs(fixture.store.state_dir)
+        for data in [b"", MAGIC[:3]]:
+            # left behind by an interrupted first save
+            write_file(fixture.store.path, data)
+            nose.tools.assert_equals(fixture.store.read_index().end, 0)
+            nose.tools.assert_equals(
+                fixture.store.restore(fixture.dest_dir), 0)
+        fixture.write("a.dat", b"a")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(read_tree(fixture.dest_dir), {"a.dat": b"a"})
+        nose.tools.assert_equals(
+            os.listdir(fixture.store.state_dir), [os.path.basename(
+                fixture.store.path)])
+    finally:
+        fixture.close()
+
+
+def test_interrupted_blob_is_discarded():
+    fixture = StoreFixture()
+    try:
+        fixture.write("a.dat", b"first")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        size = os.path.getsize(fixture.store.path)
+        # the placeholder record written before the blob data
+        with open(fixture.store.path, "ab") as f:
+            f.write(RECORD.pack(BLOB, 0))
+            f.write(BLOB_HEADER.pack(b"\0" * 20, 0))
+            f.write(b"partial compressed data")
+        nose.tools.assert_equals(fixture.store.read_index().end, size)
+        fixture.write("a.dat", b"second")
+        fixture.store.save(fixture.source_dir, ["a.dat"], [])
+        nose.tools.assert_equals(
+            record_kinds(fixture.store.path),
+            [BLOB, MANIFEST, BLOB, MANIFEST])
+        fixture.store.restore(fixture.dest_dir)
+        nose.tools.assert_equals(
+            read_tree(fixture.dest_dir), {"a.dat": b"second"})
+    finally:
+        fixture.close()
+
+
+def test_not_a_pack_is_moved_aside():
+    fixture = StoreFixture()
+    try:
+        os.makedirs(fixture.store.state_dir)
+        write_file(fixture.store.path, b"something else entirely")
+        nose.tools.assert_equals(fixture.store.read_index().end, 0)
+        nose.tools.assert_false(fixture.store.exists())
+        names = os.listdir(fixture.store.state_dir)
+        nose.tools.assert_equals(len(names), 1)
+        with open(os.path.join(fixture.store.state_dir, names[0]), "rb") as f:
+            nose.tools.assert_equals(f.read(), b"something else entirely")
+    finally:
+        fixture.close()
@@ -3,12 +3,17 @@
 import os
 import sys
 import hashlib
+from array import array
 from io import BytesIO
-from typing import List, Dict, Undefined, Union, IO
+# noinspection PyUnresolvedReferences
+from typing import List, Dict, Optional
 
 
 B_SIZE = 512
+B_LONGS = B_SIZE // 4
 B_COUNT = 880 * 2
+B_COUNT_HD = B_COUNT * 2
+HT_SIZE = B_LONGS - 56
 T_HEADER = 2
 T_DATA = 8
 T_LIST = 16
@@ -16,9 +21,12 @@ ST_ROOT = 1
 ST_USERDIR = 2
 ST_FILE = 0xffffffff - 3 + 1
 
+# typecode for unsigned 32-bit array items
+LONG_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
 
 def char(block: bytes, pos: int) -> str:
-    return block[pos:pos + 1].decode("ISO-8859-1")
+    return bytes(block[pos:pos + 1]).decode("ISO-8859-1")
 
 
 def ubyte(block: bytes, pos: int) -> int:
@@ -33,24 +41,35 @@ def ulong(block: bytes, pos: int) -> int:
     return (a << 24) | (b << 16) | (c << 8) | d
 
 
+def ulongs(data: bytes) -> array:
+    """Returns the big-endian longs in data as an array (one copy of the
+    data, instead of one Python operation per long)."""
+    longs = array(LONG_TYPECODE)
+    longs.frombytes(data)
+    if sys.byteorder == "little":
+        longs.byteswap()
+    return longs
+
+
 def checksum_block(block: bytes) -> int:
+    longs = ulongs(block)
     # clear checksum field
-    data = block[:20] + b"\0\0\0\0" + block[24:]
-    sum = 0
-    for pos in range(0, B_SIZE, 4):
-        sum += ulong(data, pos)
-        sum &= 0xffffffff
-    sum = -sum
-    sum &= 0xffffffff
-    return sum
+    longs[5] = 0
+    return -sum(longs) & 0xffffffff
 
 
 def verify_block(data: bytes) -> bool:
-    sum = 0
-    for pos in range(0, B_SIZE, 4):
-        sum += ulong(data, pos)
-        sum &= 0xffffffff
-    return sum == 0
+    return sum(ulongs(data)) & 0xffffffff == 0
+
+
+def hash_name(name: str, intl: bool=False) -> int:
+    """Returns the hash table index for a file name, like AmigaDOS."""
+    result = len(name)
+    for c in name.encode("ISO-8859-1"):
+        if 97 <= c <= 122 or (intl and 224 <= c <= 254 and c != 247):
+            c -= 32
+        result = (result * 13 + c) & 0x7ff
+    return result % HT_SIZE
 
 
 class Block(object):
@@ -62,7 +81,7 @@ class Block(object):
         return char(self.data, pos)
 
     def string(self, pos: int, len: int) -> str:
-        return self.data[pos:pos + len].decode("ISO-8859-1")
+        return bytes(self.data[pos:pos + len]).decode("ISO-8859-1")
 
     def ubyte(self, pos: int) -> int:
         return ubyte(self.data, pos)
@@ -74,359 +93,426 @@ class Block(object):
 class FileInfo(object):
 
     def __init__(self) -> None:
-        self.block_list = List[int]()
+        self.block_list = []  # type: List[int]
         self.header_block = -1
         self.name = ""
         self.path = ""
-        self.comment = Undefined(str)
+        self.comment = ""
         self.time = ""
         self.mode = 0
         self.size = 0
 
 
 class ADFFile(object):
+    """Parser for Amiga floppy images, both DD (880 KB) and HD (1760 KB).
+
+    The image is kept as one memoryview, with the big-endian longs decoded
+    in bulk into one array. Only the boot block and the root block are
+    parsed up front. Files are looked up through the directory hash tables
+    on demand, and the whole directory tree (with block usage and
+    consistency warnings) is parsed the first time namelist, file_map,
+    block_usage or warnings is used.
+    """
 
     FFS_FLAG = 1
     INTL_ONLY_FLAG = 2
     DIRC_AND_INTL_FLAG = 4
 
-    def __init__(self, obj: Union[str, bytes, IO[bytes]]) -> None:
-        if isinstance(obj, str):
-            with open(obj, "rb") as f:
-                data = f.read()
-        elif isinstance(obj, bytes):
-            data = obj
+    def __init__(self, stream_or_data_or_file) -> None:
+        if hasattr(stream_or_data_or_file, "read"):
+            data = stream_or_data_or_file.read()
+        elif isinstance(stream_or_data_or_file, (bytes, bytearray,
+                                                 memoryview)):
+            data = stream_or_data_or_file
         else:
-            data = obj.read()
-        assert isinstance(data, bytes)
-        # print(len(data))
-        assert len(data) == B_SIZE * B_COUNT
-        self.blocks = List[Block]()
-        for i in range(0, B_SIZE * B_COUNT, B_SIZE):
-            self.blocks.append(Block(data[i:i + B_SIZE]))
-        assert len(self.blocks) == B_COUNT
-        self.block_usage = [List[str]() for _ in range(B_COUNT)]
+            with open(stream_or_data_or_file, "rb") as f:
+                data = f.read()
+        assert len(data) in (B_SIZE * B_COUNT, B_SIZE * B_COUNT_HD)
+        self.data = memoryview(data)
+        self.longs = ulongs(self.data)
+        self.block_count = len(data) // B_SIZE
         self.dos = False
         self.ofs = False
         self.ffs = False
-        self.warnings = List[str]()
-        self.file_map = Dict[str, FileInfo]()
-        self.root_block_number = 880
-        self.bitmap_pages = List[int]()
+        self.intl = False
+        self.volume_name = ""
+        self.root_block_number = self.block_count // 2
+        self.bitmap_pages = []  # type: List[int]
+        self._warnings = []  # type: List[str]
+        self._file_map = None  # type: Optional[Dict[str, FileInfo]]
+        self._block_usage = None  # type: Optional[List[List[str]]]
         self._parse()
 
+    @property
+    def warnings(self) -> List[str]:
+        self._parse_tree()
+        return self._warnings
+
+    @property
+    def file_map(self) -> Dict[str, FileInfo]:
+        self._parse_tree()
+        return self._file_map
+
+    @property
+    def block_usage(self) -> List[List[str]]:
+        self._parse_tree()
+        return self._block_usage
+
+    def block(self, block_number: int) -> Block:
+        return Block(self.data[block_number * B_SIZE:
+                               (block_number + 1) * B_SIZE])
+
     def root_block(self) -> Block:
-        return self.blocks[self.root_block_number]
+        return self.block(self.root_block_number)
+
+    def _ulong(self, block_number: int, pos: int) -> int:
+        return self.longs[block_number * B_LONGS + pos // 4]
+
+    def _ubyte(self, block_number: int, pos: int) -> int:
+        return self.data[block_number * B_SIZE + pos]
+
+    def _string(self, block_number: int, pos: int, length: int) -> str:
+        offset = block_number * B_SIZE + pos
+        return bytes(self.data[offset:offset + length]).decode("ISO-8859-1")
+
+    def _verify(self, block_number: int) -> bool:
+        offset = block_number * B_LONGS
+        return sum(self.longs[offset:offset + B_LONGS]) & 0xffffffff == 0
+
+    def _time(self, block_number: int, pos: int) -> str:
+        return "{0:05d}:{1:04d}:{2:03d}".format(
+            self._ulong(block_number, pos), self._ulong(block_number, pos + 4),
+            self._ulong(block_number, pos + 8))
+
+    def _name(self, block_number: int) -> str:
+        name_len = self._ubyte(block_number, B_SIZE - 80)
+        return self._string(block_number, B_SIZE - 79, name_len)
 
     def _parse(self) -> None:
-        b = self.blocks[0]
-        if b.char(0) == "D" and b.char(1) == "O" and b.char(2) == "S":
-            self.dos = True
-        else:
+        if bytes(self.data[0:3]) != b"DOS":
             return
-        flags = b.ubyte(3)
+        self.dos = True
+        flags = self._ubyte(0, 3)
         self.ffs = flags & self.FFS_FLAG != 0
         self.ofs = not self.ffs
-
-        self.root_block_number = b.ulong(8)
-        self.bitmap_pages = []
-        if self.root_block_number != 880:
-            self.warnings.append("Root block is at position {0}, "
-                                 "not 880".format(self.root_block_number))
-            self.root_block_number = 880
-            self.warnings.append("Trying 880 anyway...")
-
+        self.intl = flags & (self.INTL_ONLY_FLAG |
+                             self.DIRC_AND_INTL_FLAG) != 0
+
+        root_block_number = self._ulong(0, 8)
+        if root_block_number != self.root_block_number:
+            self._warnings.append("Root block is at position {0}, "
+                                  "not {1}".format(root_block_number,
+                                                   self.root_block_number))
+            self._warnings.append("Trying {0} anyway...".format(
+                self.root_block_number))
         self._parse_root_block()
-        self.block_usage[self.root_block_number].append("root block")
-
-        for i, usage in enumerate(self.block_usage):
-            if "used" in usage:
-                if len(usage) < 2:
-                    self.warnings.append(
-                        "block {0} marked as used but no actual usage".format(
-                            i))
-            if "free" in usage:
-                if len(usage) != 1:
-                    self.warnings.append(
-                        "block {0} marked as used but used for {1}".format(
-                            i, repr(usage)))
 
     def _parse_root_block(self) -> None:
-        b = self.root_block()
-        type = b.ulong(0)
-        secondary_type = b.ulong(B_SIZE - 4)
+        b = self.root_block_number
+        type = self._ulong(b, 0)
+        secondary_type = self._ulong(b, B_SIZE - 4)
         if type != T_HEADER:
-            self.warnings.append("root block does not have T_HEADER type")
+            self._warnings.append("root block does not have T_HEADER type")
         if secondary_type != ST_ROOT:
-            self.warnings.append("root block does not have ST_ROOT secondary "
-                                 "type")
-
-        days = b.ulong(B_SIZE - 92)
-        mins = b.ulong(B_SIZE - 88)
-        ticks = b.ulong(B_SIZE - 84)
-        self.root_mtime = "{0:05d}:{1:04d}:{2:03d}".format(days, mins, ticks)
+            self._warnings.append("root block does not have ST_ROOT "
+                                  "secondary type")
 
-        days = b.ulong(B_SIZE - 40)
-        mins = b.ulong(B_SIZE - 36)
-        ticks = b.ulong(B_SIZE - 32)
-        self.disk_mtime = "{0:05d}:{1:04d}:{2:03d}".format(days, mins, ticks)
+        self.root_mtime = self._time(b, B_SIZE - 92)
+        self.disk_mtime = self._time(b, B_SIZE - 40)
+        self.disk_ctime = self._time(b, B_SIZE - 28)
 
-        days = b.ulong(B_SIZE - 28)
-        mins = b.ulong(B_SIZE - 24)
-        ticks = b.ulong(B_SIZE - 20)
-        self.disk_ctime = "{0:05d}:{1:04d}:{2:03d}".format(days, mins, ticks)
-
-        bm_flag = b.ulong(B_SIZE - 200)
+        bm_flag = self._ulong(b, B_SIZE - 200)
         if bm_flag != 0xffffffff:
-            self.warnings.append("bm_flag != 0xffffffff ({0:8x})".format(
+            self._warnings.append("bm_flag != 0xffffffff ({0:8x})".format(
                 bm_flag))
             if bm_flag == 0:
-                self.warnings.append("bm_flag is ZERO")
+                self._warnings.append("bm_flag is ZERO")
         for i in range(25):
-            self.bitmap_pages.append(b.ulong(B_SIZE - 196 + 4 * i))
-        self._parse_used_blocks()
+            self.bitmap_pages.append(self._ulong(b, B_SIZE - 196 + 4 * i))
 
-        name_len = b.ubyte(B_SIZE - 80)
-        self.volume_name = b.string(B_SIZE - 79, name_len)
-        # self.volume_name = self.volume_name.decode("ISO-8859-1")
+        self.volume_name = self._name(b)
+        if not self._verify(b):
+            self._warnings.append("bad root checksum")
+
+    def _parse_tree(self) -> None:
+        if self._file_map is not None:
+            return
+        self._file_map = {}
+        self._block_usage = [[] for _ in range(self.block_count)]
+        if not self.dos:
+            return
+        self._parse_used_blocks()
         self._parse_directory_content("", self.root_block_number)
-        if not verify_block(b.data):
-            self.warnings.append("bad root checksum")
+        self._block_usage[self.root_block_number].append("root block")
+
+        for i, usage in enumerate(self._block_usage):
+            if "used" in usage:
+                if len(usage) < 2:
+                    self._warnings.append(
+                        "block {0} marked as used but no actual usage".format(
+                            i))
+            if "free" in usage:
+                if len(usage) != 1:
+                    self._warnings.append(
+                        "block {0} marked as used but used for {1}".format(
+                            i, repr(usage)))
 
     def _parse_used_blocks(self) -> None:
         for i in range(len(self.bitmap_pages)):
             block_number = self.bitmap_pages[i]
             if block_number:
-                if block_number >= B_COUNT:
-                    self.warnings.append(
+                if block_number >= self.block_count:
+                    self._warnings.append(
                         "invalid block number {0} in bitmap pages".format(
                             block_number))
                     continue
-                self.block_usage[block_number].append("bitmap block")
+                self._block_usage[block_number].append("bitmap block")
 
             if i == 0:
                 if not block_number:
-                    self.warnings.append("no bitmap block for disk")
+                    self._warnings.append("no bitmap block for disk")
                     continue
             else:
                 if block_number:
-                    self.warnings.append(
+                    self._warnings.append(
                         "unexpected additional bitmap block...")
                 continue
 
-            b = self.blocks[block_number]
-            if not verify_block(b.data):
-                self.warnings.append("bitmap block checksum is invalid ("
-                                     "ignoring this block)")
+            if not self._verify(block_number):
+                self._warnings.append("bitmap block checksum is invalid ("
+                                      "ignoring this block)")
                 continue
-            for bit_index in range(1758):
-                long_index = bit_index // 32
-                bit = bit_index % 32
-                ul = b.ulong(4 + long_index * 4)
-                free = ul & (1 << bit)
-                if free:
-                    self.block_usage[2 + bit_index].append("free")
-                else:
-                    self.block_usage[2 + bit_index].append("used")
+            # one bit for each block except the two boot blocks
+            bit_count = self.block_count - 2
+            for long_index in range((bit_count + 31) // 32):
+                ul = self._ulong(block_number, 4 + long_index * 4)
+                for bit in range(min(32, bit_count - long_index * 32)):
+                    usage = self._block_usage[2 + long_index * 32 + bit]
+                    if ul & (1 << bit):
+                        usage.append("free")
+                    else:
+                        usage.append("used")
 
     def _parse_directory_content(self, path: str, block_number: int) -> None:
-        d_b = self.blocks[block_number]
-        d_secondary_type = d_b.ulong(B_SIZE - 4)
+        d_secondary_type = self._ulong(block_number, B_SIZE - 4)
         if d_secondary_type == ST_ROOT:
-            ht_size = d_b.ulong(12)
-            assert ht_size == (B_SIZE // 4) - 56
+            ht_size = self._ulong(block_number, 12)
+            assert ht_size == HT_SIZE
 
-        for i in range((B_SIZE // 4) - 56):
-            entry = d_b.ulong(24 + i * 4)
+        for i in range(HT_SIZE):
+            entry = self._ulong(block_number, 24 + i * 4)
             while entry:
-                # print(entry)
-                if entry >= B_COUNT:
-                    self.warnings.append(
+                if entry >= self.block_count:
+                    self._warnings.append(
                         "directory entry refers to an invalid block "
                         "number {0}".format(entry))
                     entry = 0
                     continue
-                b = self.blocks[entry]
-                type = b.ulong(0)
-                secondary_type = b.ulong(B_SIZE - 4)
-                parent = b.ulong(B_SIZE - 12)
+                type = self._ulong(entry, 0)
+                secondary_type = self._ulong(entry, B_SIZE - 4)
+                parent = self._ulong(entry, B_SIZE - 12)
                 assert type == T_HEADER
                 assert secondary_type in [ST_USERDIR, ST_FILE]
                 assert parent == block_number
 
                 if secondary_type == ST_USERDIR:
-                    self._parse_directory(path, entry)
+                    file_info = self._parse_directory(
+                        path, entry, self._warnings, self._block_usage)
+                    file_key = file_info.path.lower()
+                    if file_key[:-1] in self._file_map:
+                        self._warnings.append(
+                            "Duplicate entries for file name "
+                            "{0}".format(file_key))
+                    self._file_map[file_key] = file_info
+                    self._parse_directory_content(file_info.path, entry)
                 elif secondary_type == ST_FILE:
-                    self._parse_file(path, entry)
+                    file_info = self._parse_file(
+                        path, entry, self._warnings, self._block_usage)
+                    file_key = file_info.path.lower()
+                    if file_key in self._file_map:
+                        self._warnings.append(
+                            "duplicate entries for file name "
+                            "{0}".format(file_key))
+                    self._file_map[file_key] = file_info
                 else:
                     raise Exception("neither ST_USERDIR or ST_FILE")
 
-                entry = b.ulong(B_SIZE - 16)
+                entry = self._ulong(entry, B_SIZE - 16)
 
-    def _parse_file(self, path: str, block_number: int) -> None:
-        b = self.blocks[block_number]
-        header_key = b.ulong(4)
+    def _parse_header(self, path: str, block_number: int,
+                      warnings: List[str],
+                      block_usage: Optional[List[List[str]]]) -> FileInfo:
+        header_key = self._ulong(block_number, 4)
         assert header_key == block_number
 
         file_info = FileInfo()
         file_info.header_block = block_number
-
-        name_len = b.ubyte(B_SIZE - 80)
-        file_info.name = b.string(B_SIZE - 79, name_len)
+        file_info.name = self._name(block_number)
         file_info.path = path + file_info.name
-        # print(file_info.path)
-        file_key = file_info.path.lower()
-        if file_key in self.file_map:
-            self.warnings.append("duplicate entries for file name "
-                                 "{0}".format(file_key))
-        self.file_map[file_key] = file_info
-
-        self.block_usage[block_number].append(
-            "header block for file " + file_info.path)
-        if not verify_block(b.data):
-            self.warnings.append("bad checksum for header for " +
-                                 file_info.path)
-
-        file_info.mode = b.ulong(B_SIZE - 192)
-        file_info.size = b.ulong(B_SIZE - 188)
-        comment_len = b.ubyte(B_SIZE - 184)
-        file_info.comment = b.string(B_SIZE - 183, comment_len)
-
-        days = b.ulong(B_SIZE - 92)
-        mins = b.ulong(B_SIZE - 88)
-        ticks = b.ulong(B_SIZE - 84)
-        file_info.time = "{0:05d}:{1:04d}:{2:03d}".format(days, mins, ticks)
-
-        first_data = b.ulong(16)
+        if self._ulong(block_number, B_SIZE - 4) == ST_USERDIR:
+            file_info.path += "/"
+
+        if block_usage is not None:
+            block_usage[block_number].append(
+                "header block for file " + file_info.path)
+        if not self._verify(block_number):
+            warnings.append("bad checksum for header for " + file_info.path)
+
+        file_info.mode = self._ulong(block_number, B_SIZE - 192)
+        comment_len = self._ubyte(block_number, B_SIZE - 184)
+        file_info.comment = self._string(
+            block_number, B_SIZE - 183, comment_len)
+        file_info.time = self._time(block_number, B_SIZE - 92)
+        return file_info
+
+    def _parse_directory(self, path: str, block_number: int,
+                         warnings: List[str],
+                         block_usage: Optional[List[List[str]]]) -> FileInfo:
+        file_info = self._parse_header(
+            path, block_number, warnings, block_usage)
+        file_info.size = 0
+        return file_info
+
+    def _parse_file(self, path: str, block_number: int, warnings: List[str],
+                    block_usage: Optional[List[List[str]]]) -> FileInfo:
+        file_info = self._parse_header(
+            path, block_number, warnings, block_usage)
+        file_info.size = self._ulong(block_number, B_SIZE - 188)
+
+        first_data = self._ulong(block_number, 16)
         next_data = first_data
-        file_blocks_1 = List[int]()
+        file_blocks_1 = []  # type: List[int]
         ofs_accum_size = 0
         k = 0
 
         while next_data and self.ofs:
             file_blocks_1.append(next_data)
-            data_b = self.blocks[next_data]
-            data_type = data_b.ulong(0)
+            data_type = self._ulong(next_data, 0)
             assert data_type == T_DATA
-            header_key = data_b.ulong(4)
+            header_key = self._ulong(next_data, 4)
             if header_key != block_number:
-                self.warnings.append("header_key != block_number")
+                warnings.append("header_key != block_number")
 
-            seq_num = data_b.ulong(8)
+            seq_num = self._ulong(next_data, 8)
             if seq_num != len(file_blocks_1):
-                self.warnings.append(
+                warnings.append(
                     "block {0:04d} expected seq_num {1} (found {2}) for "
                     "file {3}".format(next_data, len(file_blocks_1), seq_num,
                                       file_info.path))
-            data_size = data_b.ulong(12)
+            data_size = self._ulong(next_data, 12)
             ofs_accum_size += data_size
 
-            if not verify_block(data_b.data):
-                self.warnings.append(
+            if not self._verify(next_data):
+                warnings.append(
                     "block {1:04d} - bad checksum for data block #{0} for "
                     "file {2}".format(k + 1, next_data, file_info.path))
-            # self.block_usage[next_data].append(
-            #     "block {2:04d} - data block #{0} for file {1}".format(
-            #         k + 1, file_info.path, next_data))
 
-            next_data = data_b.ulong(16)
+            next_data = self._ulong(next_data, 16)
             k += 1
 
-        file_blocks_2 = List[int]()
+        file_blocks_2 = []  # type: List[int]
         extension = block_number
         k = 0
         while extension:
-            ext_b = self.blocks[extension]
-            ext_type = ext_b.ulong(0)
-            ext_secondary_type = ext_b.ulong(B_SIZE - 4)
+            ext_type = self._ulong(extension, 0)
+            ext_secondary_type = self._ulong(extension, B_SIZE - 4)
             if extension != block_number:
                 assert ext_type == T_LIST
             assert ext_secondary_type == ST_FILE
-            high_seq = ext_b.ulong(8)
-            for i in range(high_seq):
-                file_blocks_2.append(ext_b.ulong(B_SIZE - 204 - i * 4))
+            high_seq = self._ulong(extension, 8)
+            # the data block table is stored in reverse order
+            offset = extension * B_LONGS + B_LONGS - 51
+            file_blocks_2.extend(
+                reversed(self.longs[offset - high_seq + 1:offset + 1]))
 
-            parent = ext_b.ulong(B_SIZE - 12)
+            parent = self._ulong(extension, B_SIZE - 12)
             if k > 0 and parent != block_number:
-                self.warnings.append(
+                warnings.append(
                     "block {3:04d} - expected parent {0} (found {1} for OFS "
                     "extension block #{2} for file {4}".format(
                         block_number, parent, k, extension,
                         file_info.path))
 
-            if not verify_block(ext_b.data):
-                self.warnings.append(
+            if not self._verify(extension):
+                warnings.append(
                     "block {2:04d} - bad checksum for extension block #{0} "
                     "for file {1}".format(k, file_info.path, extension))
-            extension = ext_b.ulong(B_SIZE - 8)
-            if extension:
-                self.block_usage[extension].append(
+            extension = self._ulong(extension, B_SIZE - 8)
+            if extension and block_usage is not None:
+                block_usage[extension].append(
                     "file extension block #{0} for file {1}".format(
                         k, file_info.path))
             k += 1
 
         if self.ofs:
             if file_blocks_1 != file_blocks_2:
-                self.warnings.append(
+                warnings.append(
                     "block list mismatch (extension vs OFS headers) for "
                     "file {0}".format(file_info.path))
             if len(file_blocks_1) != len(file_blocks_2):
-                self.warnings.append(
+                warnings.append(
                     "block list length mismatch (extension {0} vs OFS "
                     "headers {1}) for file {2}".format(
                         len(file_blocks_2), len(file_blocks_1),
                         file_info.path))
             if ofs_accum_size != file_info.size:
-                self.warnings.append(
+                warnings.append(
                     "file size mismatch (file header {0} vs OFS data block "
                     "headers {1}) for file {2}".format(
                         file_info.size, ofs_accum_size, file_info.path))
 
         file_info.block_list = file_blocks_2
 
-        for i, bn in enumerate(file_blocks_2):
-            self.block_usage[bn].append(
-                "data block #{0} for file {1}".format(
-                    i + 1, file_info.path, bn))
-
-    def _parse_directory(self, path: str, block_number: int) -> None:
-        b = self.blocks[block_number]
-        header_key = b.ulong(4)
-        assert header_key == block_number
-
-        file_info = FileInfo()
-        file_info.header_block = block_number
-
-        name_len = b.ubyte(B_SIZE - 80)
-        file_info.name = b.string(B_SIZE - 79, name_len)
-        file_info.path = path + file_info.name + "/"
-        # print(file_info.path)
-        file_key = file_info.path.lower()
-        if file_key[:-1] in self.file_map:
-            self.warnings.append("Duplicate entries for file name "
-                                 "{0}".format(file_key))
-        self.file_map[file_key] = file_info
-
-        self.block_usage[block_number].append(
-            "header block for file " + file_info.path)
-        if not verify_block(b.data):
-            self.warnings.append("bad checksum for header for " +
-                                 file_info.path)
-
-        file_info.mode = b.ulong(B_SIZE - 192)
-        file_info.size = 0
-        comment_len = b.ubyte(B_SIZE - 184)
-        file_info.comment = b.string(B_SIZE - 183, comment_len)
-
-        days = b.ulong(B_SIZE - 92)
-        mins = b.ulong(B_SIZE - 88)
-        ticks = b.ulong(B_SIZE - 84)
-        file_info.time = "{0:05d}:{1:04d}:{2:03d}".format(days, mins, ticks)
-
-        self._parse_directory_content(file_info.path, block_number)
+        if block_usage is not None:
+            for i, bn in enumerate(file_blocks_2):
+                block_usage[bn].append(
+                    "data block #{0} for file {1}".format(
+                        i + 1, file_info.path))
+        return file_info
+
+    def _lookup(self, name: str) -> Optional[FileInfo]:
+        """Finds name by following the directory hash chains, without
+        parsing the whole directory tree. Returns None if the name is not
+        found this way."""
+        if not self.dos:
+            return None
+        is_dir = name.endswith("/")
+        parts = name.rstrip("/").split("/")
+        path = ""
+        block_number = self.root_block_number
+        for i, part in enumerate(parts):
+            try:
+                index = hash_name(part, self.intl)
+            except UnicodeEncodeError:
+                return None
+            entry = self._ulong(block_number, 24 + index * 4)
+            # guard against loops in corrupt hash chains
+            for _ in range(self.block_count):
+                if not entry or entry >= self.block_count:
+                    return None
+                if self._name(entry).lower() == part.lower():
+                    break
+                entry = self._ulong(entry, B_SIZE - 16)
+            else:
+                return None
+            if self._ulong(entry, 0) != T_HEADER:
+                return None
+            secondary_type = self._ulong(entry, B_SIZE - 4)
+            if i < len(parts) - 1 or is_dir:
+                if secondary_type != ST_USERDIR:
+                    return None
+                if i == len(parts) - 1:
+                    return self._parse_directory(path, entry, [], None)
+                path += self._name(entry) + "/"
+                block_number = entry
+            elif secondary_type == ST_FILE:
+                return self._parse_file(path, entry, [], None)
+            else:
+                return None
+        return None
 
     def namelist(self) -> List[str]:
-        names = List[str]()
+        names = []  # type: List[str]
         keys = sorted(self.file_map.keys())
         for key in keys:
             names.append(self.file_map[key].path)
@@ -434,30 +520,30 @@ class ADFFile(object):
 
     def getinfo(self, name: str) -> FileInfo:
         name = name.lower()
+        if self._file_map is None:
+            file_info = self._lookup(name)
+            if file_info is not None:
+                return file_info
         return self.file_map[name]
 
     def open(self, name: str, mode: str="r") -> BytesIO:
         assert mode == "r"
         return BytesIO(self.read(name))
 
-    def read(self, name: str)-> bytes:
-        name = name.lower()
-        print(repr(self.file_map))
-        print(repr(name))
-        file_info = self.file_map[name]
+    def read(self, name: str) -> bytes:
+        file_info = self.getinfo(name)
         bytes_left = file_info.size
-        data = List[bytes]()
+        if self.ffs:
+            start_index = 0
+        else:
+            start_index = 24
+        max_bsize = B_SIZE - start_index
+        data = []
         for block_number in file_info.block_list:
-            if self.ffs:
-                start_index = 0
-            else:
-                start_index = 24
-            max_bsize = B_SIZE - start_index
             read_size = min(bytes_left, max_bsize)
-            block_data = self.blocks[block_number].data[
-                start_index:start_index + read_size]
-            bytes_left -= len(block_data)
-            data.append(block_data)
+            offset = block_number * B_SIZE + start_index
+            data.append(self.data[offset:offset + read_size])
+            bytes_left -= read_size
         assert bytes_left == 0
         return b"".join(data)
 
@@ -39,5 +39,21 @@ def test_read_mainpart():
     assert_equal(data_sha1, "ef467af52c8a886a6bca6ceb7f263fb8cbee2d59")
 
 
+def test_getinfo_before_namelist():
+    adf = get_transplant_adf()
+    info = adf.getinfo("S/Startup-Sequence")
+    assert_equal(info.path, "s/startup-sequence")
+    assert_equal(info.size, len(b"loader\n"))
+    assert_raises(KeyError, adf.getinfo, "s/missing")
+
+
+def test_root_block_checksum():
+    adf = get_transplant_adf()
+    block = adf.root_block().data
+    assert_true(fstd.adffile.verify_block(block))
+    assert_equal(fstd.adffile.checksum_block(block),
+                 fstd.adffile.ulong(block, 20))
+
+
 def test_mypy():
     fstd.mypy.check_module(fstd.adffile.__name__)
@@ -18,6 +18,19 @@ class Model(QAbstractListModel):
         # return self.count
         return self.parent().get_item_count()
 
+    def canFetchMore(self, parent):
+        return self.parent().can_fetch_more()
+
+    def fetchMore(self, parent):
+        view = self.parent()
+        items = view.fetch_more()
+        if not items:
+            return
+        first = view.get_item_count()
+        self.beginInsertRows(parent, first, first + len(items) - 1)
+        view.append_fetched_items(items)
+        self.endInsertRows()
+
     def data(self, index, role):
         row = index.row()
         # print("data for", index, "role", role)
@@ -89,6 +102,19 @@ class VerticalItemView(QListView, WidgetMixin):
     def get_item_text_color(self, index):
         return None
 
+    def can_fetch_more(self):
+        """Returns True if the list has more items which have not been
+        loaded yet. They are loaded with fetch_more when the view needs
+        them (when scrolled to the end)."""
+        return False
+
+    def fetch_more(self):
+        """Returns the next items, to be added with append_fetched_items."""
+        return []
+
+    def append_fetched_items(self, items):
+        pass
+
     # def set_item_count(self, count):
     #     #self.model.rowCoun
     #     self.model.set_item_count(count)
@@ -137,3 +163,9 @@ class VerticalItemView(QListView, WidgetMixin):
         self.dataChanged(
             self.model.createIndex(0, 0),
             self.model.createIndex(count, 0))
+
+    def update_rows(self, first, last):
+        """Updates rows first to last (inclusive) only."""
+        self.dataChanged(
+            self.model.createIndex(first, 0),
+            self.model.createIndex(last, 0))
@@ -68,6 +68,8 @@ def main():
         from launcher.apps.list_plugins import app_main
     elif app == "list-dirs":
         from launcher.apps.list_dirs import app_main
+    elif app == "list-state-usage":
+        from launcher.apps.list_state_usage import app_main
     else:
         raise Exception("Unknown app specified")
     app_main()
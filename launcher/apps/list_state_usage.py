@@ -0,0 +1,29 @@
+"""
+Prints the disk usage of game state dirs (save states and preserved game
+changes), largest first.
+"""
+import os
+
+from fsbc.settings import Settings
+from fsgs.FSGSDirectories import FSGSDirectories
+from fsgs.GameStateStore import state_dirs_usage
+
+
+def app_main():
+    FSGSDirectories.initialize()
+    Settings.instance().load()
+    save_states_dir = FSGSDirectories.get_save_states_dir()
+    usage = state_dirs_usage(save_states_dir)
+    print("")
+    print("{0:>10} {1:>10} {2:>10}  {3}".format(
+        "Total KiB", "Pack KiB", "Unused KiB", "State dir"))
+    for path, total, pack_size, live_size in usage:
+        print("{0:10d} {1:10d} {2:10d}  {3}".format(
+            total // 1024, pack_size // 1024,
+            (pack_size - live_size) // 1024,
+            os.path.relpath(path, save_states_dir)))
+    print("")
+    print("{0} state dirs in {1}, {2:0.2f} MiB".format(
+        len(usage), save_states_dir,
+        sum(total for _, total, _, _ in usage) / (1024 * 1024)))
+    print("")
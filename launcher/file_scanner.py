@@ -1,7 +1,11 @@
 import os
+import time
+import queue
 import hashlib
+import threading
 import traceback
 
+import fsbc.settings
 from fsbc.paths import Paths
 
 from fsgs.FileDatabase import FileDatabase
@@ -14,11 +18,17 @@ from .i18n import gettext
 class FileScanner(object):
 
     def __init__(self, paths, purge_other_dirs,
-                 on_status=None, on_rom_found=None, stop_check=None):
+                 on_status=None, on_rom_found=None, stop_check=None,
+                 workers=None):
         self.paths = paths
 
         self.purge_other_dirs = purge_other_dirs
-        self.database_file_ids = []
+        self.database_file_ids = set()
+        self.file_index = {}
+        self.files_by_dir = {}
+        self.directory_index = {}
+        self.dirs_by_dir = {}
+        self.scanned_dirs = []
 
         self.on_status = on_status
         self.on_rom_found = on_rom_found
@@ -27,6 +37,18 @@ class FileScanner(object):
         self.files_added = 0
         self.bytes_added = 0
 
+        # Files are checksummed by a pool of hashing threads (hashlib and
+        # zlib release the GIL while working on large buffers), while all
+        # database access stays on the thread calling scan.
+        if workers is None:
+            workers = default_worker_count()
+        self.workers = max(1, workers)
+        self._hash_queue = None
+        self._result_queue = None
+        self._worker_threads = []
+        self._pending = 0
+        self._insert_batch = []
+
         self.extensions = set()
         self.extensions.add(".rom")
         self.extensions.add(".adf")
@@ -108,8 +130,7 @@ class FileScanner(object):
         self.set_status(gettext("Scanning files"),
                         gettext("Purging old entries..."))
         database = FileDatabase.get_instance()
-        for file_id in file_ids:
-            database.delete_file(id=file_id)
+        database.delete_files(file_ids)
 
     def scan(self):
         self.set_status(gettext("Scanning files"),
@@ -123,27 +144,34 @@ class FileScanner(object):
         else:
             all_database_file_ids = None
 
-        for dir in scan_dirs:
-            # this is important to make sure the database is portable across
-            # operating systems
-            dir = Paths.get_real_case(dir)
-
-            self.database_file_ids = database.get_file_hierarchy_ids(dir)
-            if self.purge_other_dirs:
-                all_database_file_ids.difference_update(
-                    self.database_file_ids)
-
-            self.scan_dir(database, dir)
-
-            # print("Remaining files:", self.database_file_ids)
-            self.purge_file_ids(self.database_file_ids)
-
-            self.set_status(gettext("Scanning files"),
-                            gettext("Committing data..."))
-            # update last_file_insert and last_file_delete
-            database.update_last_event_stamps()
-            print("FileScanner.scan - committing data")
-            database.commit()
+        self.start_workers()
+        try:
+            for dir in scan_dirs:
+                # this is important to make sure the database is portable
+                # across operating systems
+                dir = Paths.get_real_case(dir)
+
+                self.load_index(database, dir)
+                if self.purge_other_dirs:
+                    all_database_file_ids.difference_update(
+                        self.database_file_ids)
+
+                self.scan_dir(database, dir)
+                self.write_results(database, wait=True)
+                if not self.stop_check():
+                    database.set_directories(dir, self.scanned_dirs)
+
+                # print("Remaining files:", self.database_file_ids)
+                self.purge_file_ids(self.database_file_ids)
+
+                self.set_status(gettext("Scanning files"),
+                                gettext("Committing data..."))
+                # update last_file_insert and last_file_delete
+                database.update_last_event_stamps()
+                print("FileScanner.scan - committing data")
+                database.commit()
+        finally:
+            self.stop_workers()
 
         if self.purge_other_dirs:
             self.purge_file_ids(all_database_file_ids)
@@ -156,105 +184,242 @@ class FileScanner(object):
             print("FileScanner.scan - committing data")
             database.commit()
 
+    def start_workers(self):
+        # The job queue is bounded so the directory walk does not run too
+        # far ahead of the hashing threads.
+        self._hash_queue = queue.Queue(self.workers * 4)
+        self._result_queue = queue.Queue()
+        self._pending = 0
+        self._insert_batch = []
+        self._worker_threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.hash_worker,
+                name="FileScannerHashThread{0}".format(i + 1))
+            thread.daemon = True
+            thread.start()
+            self._worker_threads.append(thread)
+
+    def stop_workers(self):
+        for _ in self._worker_threads:
+            self._hash_queue.put(None)
+        for thread in self._worker_threads:
+            thread.join()
+        self._worker_threads = []
+
+    def hash_worker(self):
+        while True:
+            job = self._hash_queue.get()
+            if job is None:
+                return
+            path, size, mtime = job
+            try:
+                items = self.hash_file(path)
+            except Exception:
+                traceback.print_exc()
+                items = None
+            self._result_queue.put((path, size, mtime, items))
+
+    def queue_file(self, database, path, size, mtime):
+        self._hash_queue.put((path, size, mtime))
+        self._pending += 1
+        self.write_results(database)
+
+    def write_results(self, database, wait=False):
+        """Add checksummed files to the database. Must be called from the
+        thread owning the database connection."""
+        while self._pending:
+            try:
+                result = self._result_queue.get(block=wait)
+            except queue.Empty:
+                break
+            self._pending -= 1
+            path, size, mtime, items = result
+            if items is None or self.stop_check():
+                continue
+            self.scan_count += len(items)
+            item_path, name, sha1 = items[0]
+            if len(items) == 1:
+                self.add_scanned_file(
+                    database, item_path, name, sha1, size, mtime, batch=True)
+                continue
+            # The archive itself is inserted right away since the members
+            # need its id.
+            file_id = self.add_scanned_file(
+                database, item_path, name, sha1, size, mtime)
+            for item_path, name, sha1 in items[1:]:
+                self.add_scanned_file(
+                    database, item_path, name, sha1, size, mtime,
+                    parent=file_id, batch=True)
+        if wait or len(self._insert_batch) >= 1000:
+            database.add_files(self._insert_batch)
+            self._insert_batch = []
+
+    def load_index(self, database, dir):
+        """Load the file and directory index for dir into memory, so
+        unchanged files and directories can be checked without querying
+        the database for each of them."""
+        self.file_index = database.get_file_hierarchy(dir)
+        self.database_file_ids = set(
+            item[0] for item in self.file_index.values())
+        self.files_by_dir = {}
+        for path, item in self.file_index.items():
+            self.files_by_dir.setdefault(
+                path.rsplit("/", 1)[0], []).append(item[0])
+        self.directory_index = database.get_directories(dir)
+        self.dirs_by_dir = {}
+        for path in self.directory_index:
+            if "/" in path:
+                self.dirs_by_dir.setdefault(
+                    path.rsplit("/", 1)[0], []).append(path)
+        self.scanned_dirs = []
+
+    def is_dir_unchanged(self, key, st):
+        try:
+            mtime, count, all_files = self.directory_index[key]
+        except KeyError:
+            return False
+        if mtime != st.st_mtime_ns:
+            return False
+        # The count also covers files that were removed from the database
+        # (or could not be added) while the directory itself is unchanged.
+        return count == len(self.files_by_dir.get(key, [])) + \
+            len(self.dirs_by_dir.get(key, []))
+
+    def skip_dir(self, database, dir, key):
+        mtime, count, all_files = self.directory_index[key]
+        file_ids = self.files_by_dir.get(key, [])
+        self.database_file_ids.difference_update(file_ids)
+        self.scan_count += len(file_ids)
+        self.scanned_dirs.append((key, mtime, count, all_files))
+        # Subdirectories can have changed even if this directory has not,
+        # so they are still checked, but found via the index instead of
+        # by listing the directory.
+        for sub_key in self.dirs_by_dir.get(key, []):
+            if self.stop_check():
+                return
+            name = sub_key.rsplit("/", 1)[1]
+            self.scan_dir(database, os.path.join(dir, name), all_files)
+
+    def record_dir(self, key, st, count, all_files):
+        mtime = st.st_mtime_ns
+        if time.time() - st.st_mtime < 2.0:
+            # The directory may still be changing (and some file systems
+            # have a coarse mtime resolution), so make sure it is checked
+            # again on the next scan.
+            mtime = 0
+        self.scanned_dirs.append((key, mtime, count, all_files))
+
     def scan_dir(self, database, dir, all_files=False):
-        if not os.path.exists(dir):
+        try:
+            st = os.stat(dir)
+        except OSError:
+            return
+        key = database.encode_path(dir)
+        if self.is_dir_unchanged(key, st):
+            self.skip_dir(database, dir, key)
+            return
+        try:
+            dir_content = [entry for entry in os.scandir(dir)
+                           if check_valid_name(entry.name)]
+        except OSError:
             return
-        dir_content = os.listdir(dir)
         if not all_files:
-            for name in dir_content:
-                if not check_valid_name(name):
-                    continue
-                lname = name.lower()
+            for entry in dir_content:
+                lname = entry.name.lower()
                 if lname.endswith(".slave") or lname.endswith(".slave"):
                     all_files = True
                     break
 
-        for name in dir_content:
-            if not check_valid_name(name):
-                continue
+        count = 0
+        for entry in dir_content:
             if self.stop_check():
                 return
+            name = entry.name
             if name in [".git", "Cache", "Save States"]:
                 continue
 
             path = os.path.join(dir, name)
-            if os.path.isdir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                count += 1
                 self.scan_dir(database, path, all_files=all_files)
                 continue
             if not all_files:
-                dummy, ext = os.path.splitext(path)
+                dummy, ext = os.path.splitext(name)
                 ext = ext.lower()
                 if ext not in self.extensions:
                     continue
+            count += 1
             try:
-                self.scan_file(database, path)
+                self.scan_file(database, path, entry.stat())
             except Exception:
                 traceback.print_exc()
+        self.record_dir(key, st, count, all_files)
 
-    def scan_file(self, database, path):
+    def scan_file(self, database, path, st=None):
         name = os.path.basename(path)
         # path = os.path.normcase(os.path.normpath(path))
 
-        self.scan_count += 1
         self.set_status(
             gettext("Scanning files ({count} scanned)").format(
                 count=self.scan_count), name)
 
-        try:
-            st = os.stat(path)
-        except:
-            print("error stat-ing file", repr(path))
-            return
+        if st is None:
+            try:
+                st = os.stat(path)
+            except:
+                print("error stat-ing file", repr(path))
+                return
         size = st.st_size
         mtime = int(st.st_mtime)
 
-        result = database.find_file(path=path)
-        # print(result)
-        if result["path"]:
-            if size == result["size"] and mtime == result["mtime"]:
-
-                self.database_file_ids.remove(result["id"])
-                # self.database_file_ids.difference_update(
-                #         database.get_file_hierarchy_ids(path + "#"))
-                
-                # self.database_file_ids.difference_update(
-                #         database.get_child_ids(id=result["id"]))
+        result = self.file_index.get(database.encode_path(path))
+        if result is not None:
+            file_id, result_size, result_mtime = result
+            if size == result_size and mtime == result_mtime:
+                self.scan_count += 1
+                self.database_file_ids.remove(file_id)
                 return
 
+        self.queue_file(database, path, size, mtime)
+
+    def hash_file(self, path):
+        """Checksum a file and all its archive members. Runs on a hashing
+        thread and returns a list of (path, name, sha1) tuples, the file
+        itself first, or None if the scan was stopped."""
         archive = Archive(path)
         # if archive.is_archive():
 
-        file_id = self.scan_archive_stream(
-            database, archive, path, name, size, mtime)
-
-        for p in archive.list_files():
-            if p.endswith("/"):
-                # don't index archive directory entries
-                continue
-            # print(p)
+        name = os.path.basename(path)
+        items = [(path, name, self.hash_archive_stream(archive, path, name))]
+        # archive directory entries are not included
+        for p, _, _, stream in archive.iter_members():
             if self.stop_check():
-                return
-            # n = p.replace("\\", "/").replace("|", "/").split("/")[-1]
+                return None
             n = os.path.basename(p)
-            self.scan_count += 1
-            self.scan_archive_stream(
-                database, archive, p, n, size, mtime, parent=file_id)
+            items.append(
+                (p, n, self.hash_archive_stream(archive, p, n, stream)))
         if self.stop_check():
-            return
+            return None
+        return items
 
-    def scan_archive_stream(
-            self, database, archive, path, name, size, mtime, parent=None):
+    def hash_archive_stream(self, archive, path, name, f=None):
         self.set_status(
             gettext("Scanning files ({count} scanned)").format(
                 count=self.scan_count), name)
         base_name, ext = os.path.splitext(name)
         ext = ext.lower()
 
-        f = archive.open(path)
+        if f is None:
+            f = archive.open(path)
         s = hashlib.sha1()
         while True:
             if self.stop_check():
-                return
+                return None
             data = f.read(65536)
             if not data:
                 break
@@ -263,7 +428,7 @@ class FileScanner(object):
 
         if ext == ".rom":
             try:
-                sha1_dec = ROMManager.decrypt_archive_rom(archive, path)["sha1"]
+                sha1_dec = ROMManager.decrypted_sha1(archive, path)
             except Exception:
                 import traceback
                 traceback.print_exc()
@@ -283,11 +448,23 @@ class FileScanner(object):
                 # correctly added on later scans if rom.key is added to the
                 # directory.
                 return None
+        return sha1
+
+    def add_scanned_file(self, database, path, name, sha1, size, mtime,
+                         parent=None, batch=False):
+        if sha1 is None:
+            return None
+        base_name, ext = os.path.splitext(name)
+        ext = ext.lower()
 
         if parent:
             path = "#/" + path.rsplit("#/", 1)[1]
-        file_id = database.add_file(
-            path=path, sha1=sha1, mtime=mtime, size=size, parent=parent)
+        if batch:
+            self._insert_batch.append((path, sha1, mtime, size, parent))
+            file_id = None
+        else:
+            file_id = database.add_file(
+                path=path, sha1=sha1, mtime=mtime, size=size, parent=parent)
 
         self.files_added += 1
         self.bytes_added += size
@@ -298,6 +475,18 @@ class FileScanner(object):
         return file_id
 
 
+def default_worker_count():
+    try:
+        workers = int(fsbc.settings.get("scan_workers"))
+    except ValueError:
+        workers = 0
+    if workers > 0:
+        return workers
+    # Scanning is usually limited by disk or network I/O, so there is
+    # little to gain from more threads than this by default.
+    return min(4, os.cpu_count() or 1)
+
+
 def check_valid_name(name):
     # check that the file is actually unicode object (indirectly). listdir
     # will return str objects for file names on Linux with invalid encoding.
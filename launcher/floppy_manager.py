@@ -67,8 +67,8 @@ class FloppyManager(object):
                 paths.append(path)
 
         checksum_tool = ChecksumTool(parent)
-        for i, path in enumerate(paths):
-            sha1 = checksum_tool.checksum(path)
+        sha1s = checksum_tool.checksum_many(paths)
+        for i, (path, sha1) in enumerate(zip(paths, sha1s)):
             path = Paths.contract_path(
                 path, default_dir, force_real_case=False)
 
@@ -110,6 +110,17 @@ class GameScanner(object):
         #             return
         helper.finish()
 
+    @staticmethod
+    def iter_game_values(game_database, check_rows, batch_size=200):
+        """Yields check_rows items extended with the game values for the
+        game id in each row, looking up game values in batches."""
+        for i in range(0, len(check_rows), batch_size):
+            batch = check_rows[i:i + batch_size]
+            docs = game_database.get_game_values_many(
+                item[0][0] for item in batch)
+            for item in batch:
+                yield item + (docs[item[0][0]],)
+
     def scan_game_database(self, helper, database_name, game_database):
         """
         :type helper: ScanHelper
@@ -126,6 +137,10 @@ class GameScanner(object):
         # this list will contain game entries which are not variants
         game_rows = []
 
+        # entries which need to be checked, game values are then looked up
+        # in batches
+        check_rows = []
+
         game_database_cursor.execute(
             "SELECT id, uuid FROM game WHERE data != ''")
         for row in game_database_cursor:
@@ -161,14 +176,21 @@ class GameScanner(object):
                 # have been changed, or download status... (or other info
                 # needs to be corrected)
                 pass
+            check_rows.append((row, variant_uuid, existing_variant))
+
+        for row, variant_uuid, existing_variant, doc in \
+                self.iter_game_values(game_database, check_rows):
+            if self.stop_check():
+                return
+
+            variant_id = row[0]
+            update_stamp = variant_id
 
             self.scan_count += 1
             self.set_status(
                 gettext("Scanning game variants ({count} scanned)").format(
                     count=self.scan_count), variant_uuid)
 
-            doc = game_database.get_game_values(variant_id)
-
             file_list_json = doc.get("file_list", "")
             if not file_list_json:
                 # not a game variant... (parent game only probably)
@@ -232,6 +254,7 @@ class GameScanner(object):
 
             # ensure_updated_games.add(parent_uuid)
 
+        check_rows = []
         for row in game_rows:
             if self.stop_check():
                 return
@@ -248,13 +271,20 @@ class GameScanner(object):
                 # are left in existing_games
                 helper.game_seen(game_uuid)
                 continue
+            check_rows.append((row, game_uuid, existing_game))
+
+        for row, game_uuid, existing_game, doc in \
+                self.iter_game_values(game_database, check_rows):
+            if self.stop_check():
+                return
+
+            game_id = row[0]
+            update_stamp = game_id
 
             self.scan_count += 1
             self.set_status(gettext("Scanning games ({count} scanned)").format(
                 count=self.scan_count), game_uuid)
 
-            doc = game_database.get_game_values(game_id)
-
             entry_type = int(doc.get("_type", "0"))
             if (entry_type & GAME_ENTRY_TYPE_GAME) == 0:
                 continue
@@ -440,11 +470,11 @@ class ScanHelper(object):
             database_cursor.execute(
                 "DELETE FROM game_variant WHERE id = ?", (variant_id,))
 
-        # games left in this list must now be deleted
+        # games left in this list must now be deleted (delete_game also
+        # removes the search terms for the game)
         for row in self.existing_games.values():
             game_id = row[2]
-            database_cursor.execute(
-                "DELETE FROM game WHERE id = ?", (game_id,))
+            self.database.delete_game(id=game_id)
 
         database_cursor.execute(
             "SELECT count(*) FROM game WHERE uuid IS NOT NULL "
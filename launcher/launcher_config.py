@@ -3,11 +3,15 @@ import os
 import hashlib
 import traceback
 from configparser import ConfigParser, NoSectionError
+from contextlib import contextmanager
 
+from fsbc.application import call_after
 from fsbc.paths import Paths
+from fsbc.settings import Settings
 
 from fsgs.context import fsgs
-from fsgs.ChecksumTool import ChecksumTool
+from fsgs.ChecksumTool import ChecksumTask, ChecksumTool
+from fsgs.amiga.ROMManager import ROMChecksumCache
 from fsgs.amiga.Amiga import Amiga
 from fsgs.amiga.ValueConfigLoader import ValueConfigLoader
 from fsgs.FSGSDirectories import FSGSDirectories
@@ -152,6 +156,8 @@ for _i in range(Amiga.MAX_HARD_DRIVES):
 class LauncherConfig(object):
 
     config_keys = [x[0] for x in cfg]
+    # background checksumming of files in the loaded config
+    checksum_task = None
 
     default_config = {}
     for c in cfg:
@@ -220,6 +226,15 @@ class LauncherConfig(object):
     def set_multiple(cls, items):
         fsgs.config.set(items)
 
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """Groups config and settings changes, so listeners are notified
+        once, for the values which actually changed, when the outermost
+        batch ends."""
+        with fsgs.config.batch(), Settings.instance().batch():
+            yield
+
     @classmethod
     def update_from_config_dict(cls, config_dict):
         changes = []
@@ -314,15 +329,23 @@ class LauncherConfig(object):
     @classmethod
     def load_default_config(cls):
         print("load_default_config")
-        cls.load({})
-        # FIXME: remove use of config_base
-        LauncherSettings.set("config_base", "")
-        LauncherSettings.set("config_name", "Unnamed Configuration")
-        LauncherSettings.set("config_path", "")
-        LauncherSettings.set("config_xml_path", "")
+        with cls.batch():
+            cls.load({})
+            # FIXME: remove use of config_base
+            LauncherSettings.set("config_base", "")
+            LauncherSettings.set("config_name", "Unnamed Configuration")
+            LauncherSettings.set("config_path", "")
+            LauncherSettings.set("config_xml_path", "")
 
     @classmethod
     def load(cls, config):
+        with cls.batch():
+            cls._load(config)
+
+    @classmethod
+    def _load(cls, config):
+        # pending checksums are for the previous config
+        cls.stop_checksum_task()
         update_config = {}
         for key, value in cls.default_config.items():
             update_config[key] = value
@@ -339,9 +362,10 @@ class LauncherConfig(object):
                 update_config[key] = value
 
         cls.update_kickstart_in_config_dict(update_config)
-        cls.fix_loaded_config(update_config)
+        pending = cls.fix_loaded_config(update_config)
         # print("about to set", update_config)
         cls.set_multiple(update_config.items())
+        cls.start_checksum_task(pending)
         # Settings.set("config_changed", "0")
         cls.set("__changed", "0")
 
@@ -428,10 +452,11 @@ class LauncherConfig(object):
 
     @classmethod
     def fix_loaded_config(cls, config):
+        """Sets checksums for files in config from the checksum caches.
+        Returns a list of (sha1 key, key, value, path, is_rom) tuples for
+        files which must be checksummed (see start_checksum_task)."""
         # cls.fix_joystick_ports(config)
-
-        # FIXME: parent
-        checksum_tool = ChecksumTool(None)
+        pending = []
 
         def fix_file_checksum(sha1_key, key, base_dir, is_rom=False):
             path = config.get(key, "")
@@ -458,18 +483,19 @@ class LauncherConfig(object):
                 # could set a fake checksum here or something, to indicate
                 # that it isn't supposed to be set..
                 return
-            print("checksumming", repr(path))
+            if is_rom:
+                sha1 = ROMChecksumCache.instance().get(path)
+            else:
+                sha1 = ChecksumTool.cached_checksum(path)
+            if sha1:
+                config[sha1_key] = sha1
+                return
             size = os.path.getsize(path)
             if size > 64 * 1024 * 1024:
                 # not checksumming large files right now
                 print("not checksumming large file")
                 return
-
-            if is_rom:
-                sha1 = checksum_tool.checksum_rom(path)
-            else:
-                sha1 = checksum_tool.checksum(path)
-            config[sha1_key] = sha1
+            pending.append((sha1_key, key, config[key], path, is_rom))
 
         for i in range(Amiga.MAX_FLOPPY_DRIVES):
             fix_file_checksum(
@@ -504,11 +530,56 @@ class LauncherConfig(object):
         fix_file_checksum(
             "x_kickstart_ext_file_sha1", "x_kickstart_ext_file",
             FSGSDirectories.get_kickstarts_dir(), is_rom=True)
+        return pending
+
+    @classmethod
+    def start_checksum_task(cls, pending):
+        """Checksums files (as returned by fix_loaded_config) in the
+        background. The checksums are set in one batched config update
+        when done, unless another config has been loaded."""
+        cls.stop_checksum_task()
+        if not pending:
+            return
+        files = [((sha1_key, key, value), path, is_rom)
+                 for sha1_key, key, value, path, is_rom in pending]
+        task = ChecksumTask(files, cls.on_checksum_task_result)
+        cls.checksum_task = task
+        task.start()
+
+    @classmethod
+    def stop_checksum_task(cls):
+        if cls.checksum_task is not None:
+            cls.checksum_task.stop()
+            cls.checksum_task = None
+
+    @classmethod
+    def on_checksum_task_result(cls, task, results):
+        # called from the task thread, the config must only be changed
+        # from the main thread
+        call_after(cls.apply_checksum_task_result, task, results)
+
+    @classmethod
+    def apply_checksum_task_result(cls, task, results):
+        if task is not cls.checksum_task:
+            return
+        cls.checksum_task = None
+        items = []
+        for (sha1_key, key, value), sha1 in sorted(results.items()):
+            if fsgs.config.get(key) != value or fsgs.config.get(sha1_key):
+                # the option has been changed since
+                continue
+            items.append((sha1_key, sha1))
+        if not items:
+            return
+        # setting checksums does not make the config modified
+        items.append(("__changed", fsgs.config.get("__changed")))
+        cls.set_multiple(items)
 
     @classmethod
     def load_file(cls, path):
         try:
-            cls._load_file(path, "")
+            with cls.batch():
+                cls._load_file(path, "")
         except Exception:
             # FIXME: errors should be logged / displayed
             cls.load_default_config()
@@ -518,7 +589,8 @@ class LauncherConfig(object):
     def load_data(cls, data):
         print("Config.load_data")
         try:
-            cls._load_file("", data)
+            with cls.batch():
+                cls._load_file("", data)
         except Exception:
             # FIXME: errors should be logged / displayed
             cls.load_default_config()
@@ -610,6 +682,11 @@ class LauncherConfig(object):
 
     @classmethod
     def load_values(cls, values, uuid=""):
+        with cls.batch():
+            cls._load_values(values, uuid)
+
+    @classmethod
+    def _load_values(cls, values, uuid=""):
         print("loading config values", values)
         platform_id = values.get("platform", "").lower()
 
@@ -622,6 +699,7 @@ class LauncherConfig(object):
 
         else:
             print("Warning: Non-Amiga game loaded")
+            cls.stop_checksum_task()
             platform_handler = PlatformHandler.create(platform_id)
             loader = platform_handler.get_loader(fsgs)
             fsgs.config.load(loader.load_values(values))
@@ -21,18 +21,22 @@ class Option(object):
     DATABASE_ATARI = "database_atari"
     DATABASE_AUTH = "database_auth"
     DATABASE_C64 = "database_c64"
+    DATABASE_CACHE_SIZE = "database_cache_size"
     DATABASE_CPC = "database_cpc"
     DATABASE_DOS = "database_dos"
     DATABASE_EMAIL = "database_email"
     DATABASE_FEATURE = "database_feature"
     DATABASE_GBA = "database_gba"
+    DATABASE_JOURNAL_MODE = "database_journal_mode"
     DATABASE_LOCKER = "database_locker"
+    DATABASE_MMAP_SIZE = "database_mmap_size"
     DATABASE_NES = "database_nes"
     DATABASE_PASSWORD = "database_password"
     DATABASE_SERVER = "database_server"
     DATABASE_SHOW_ADULT = "database_show_adult"
     DATABASE_SHOW_GAMES = "database_show_games"
     DATABASE_SNES = "database_snes"
+    DATABASE_SYNCHRONOUS = "database_synchronous"
     DATABASE_USERNAME = "database_username"
     DEVICE_ID = "device_id"
     DONGLE_TYPE = "dongle_type"
@@ -71,8 +75,10 @@ class Option(object):
     MOUSE_SPEED = "mouse_speed"
     NETPLAY_FEATURE = "netplay_feature"
     NETPLAY_TAG = "netplay_tag"
+    PREPARED_DRIVE_CACHE_SIZE = "prepared_drive_cache_size"
     RELATIVE_PATHS = "relative_paths"
     RTG_SCANLINES = "rtg_scanlines"
+    SCAN_WORKERS = "scan_workers"
     SCANLINES = "scanlines"
     SOUND_CARD = "sound_card"
     STEREO_SEPARATION = "stereo_separation"
@@ -107,6 +113,7 @@ class Option(object):
     VIDEO_SYNC = "video_sync"
     VIDEO_SYNC_METHOD = "video_sync_method"
     VOLUME = "volume"
+    WATCH_GAME_CHANGES = "watch_game_changes"
     WHDLOAD_SPLASH_DELAY = "whdload_splash_delay"
     WINDOW_BORDER = "window_border"
     ZOOM = "zoom"
@@ -286,6 +293,14 @@ options = {
         "type": "boolean",
     },
 
+    "database_cache_size": {
+        "default": "16384",
+        "description": N_("Database page cache size in KiB"),
+        "type": "integer",
+        "min": 0,
+        "max": 1048576,
+    },
+
     "database_cpc": {
         "default": "",
         "description": N_(
@@ -318,12 +333,32 @@ options = {
         "type": "boolean",
     },
 
+    "database_journal_mode": {
+        "default": "wal",
+        "description": N_("Database journal mode"),
+        "type": "choice",
+        "values": [
+            ("wal", "WAL"),
+            ("delete", "Delete"),
+            ("truncate", "Truncate"),
+            ("persist", "Persist"),
+        ]
+    },
+
     "database_locker": {
         "default": "",
         "description": N_("Enable/disable use of OAGD.net locker"),
         "type": "boolean",
     },
 
+    "database_mmap_size": {
+        "default": "256",
+        "description": N_("Database memory-mapped I/O size in MiB"),
+        "type": "integer",
+        "min": 0,
+        "max": 65536,
+    },
+
     "database_nes": {
         "default": "",
         "description": N_("Enable/disable use of the Nintendo (NES) database"),
@@ -366,6 +401,17 @@ options = {
         "type": "boolean",
     },
 
+    "database_synchronous": {
+        "default": "normal",
+        "description": N_("Database synchronous mode"),
+        "type": "choice",
+        "values": [
+            ("normal", N_("Normal")),
+            ("full", N_("Full")),
+            ("off", N_("Off")),
+        ]
+    },
+
     "database_username": {
         "default": "",
         "description": N_("Game database user name"),
@@ -695,6 +741,14 @@ options = {
         "type": "string",
     },
 
+    "prepared_drive_cache_size": {
+        "default": "1024",
+        "description": N_("Prepared hard drive cache size in MiB"),
+        "type": "integer",
+        "min": 0,
+        "max": 1048576,
+    },
+
     "relative_paths": {
         "default": "",
         "description": N_("Relative paths"),
@@ -707,6 +761,14 @@ options = {
         "type": "boolean",
     },
 
+    "scan_workers": {
+        "default": "",
+        "description": N_("Number of threads used to checksum files"),
+        "type": "integer",
+        "min": 1,
+        "max": 64,
+    },
+
     "scanlines": {
         "default": "0",
         "description": N_("Render scan lines"),
@@ -1044,6 +1106,12 @@ options = {
         "max": 100,
     },
 
+    "watch_game_changes": {
+        "default": "0",
+        "description": N_("Watch for game file changes while running"),
+        "type": "boolean",
+    },
+
     "whdload_splash_delay": {
         "default": "200",
         "description": N_("WHDLoad splash delay"),
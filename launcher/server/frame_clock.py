@@ -0,0 +1,269 @@
+"""
+Frame scheduling for the netplay game server.
+
+FrameClock produces ticks at a fixed rate on the monotonic clock. Deadlines
+are computed in integer nanoseconds from the start time, so the schedule
+does not drift. On Linux, the clock waits on a periodic timerfd registered
+with the asyncio event loop, which wakes up within microseconds of the
+deadline. Elsewhere it falls back to event loop timers (about one
+millisecond of precision). Neither busy-waits.
+"""
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+PAL_FRAME_RATE = 50.0
+NTSC_FRAME_RATE = 60.0
+FRAME_RATES = {
+    "pal": PAL_FRAME_RATE,
+    "ntsc": NTSC_FRAME_RATE,
+}
+
+# upper bounds (in microseconds) for the jitter histogram buckets, the last
+# bucket counts everything above the last bound
+JITTER_BUCKETS_US = (50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000)
+
+TFD_TIMER_ABSTIME = 1
+TFD_NONBLOCK = os.O_NONBLOCK
+TFD_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+
+def parse_frame_rate(value):
+    """Returns the frame rate for "pal", "ntsc" or a number of frames per
+    second."""
+    try:
+        return FRAME_RATES[value.lower()]
+    except KeyError:
+        return float(value)
+
+
+class JitterHistogram:
+    """Histogram of how late frame ticks were, relative to their
+    deadlines."""
+
+    def __init__(self):
+        self.bounds_ns = [bound * 1000 for bound in JITTER_BUCKETS_US]
+        self.counts = [0 for _ in range(len(self.bounds_ns) + 1)]
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        # ticks which returned before their deadline
+        self.early = 0
+        self.max_early_ns = 0
+
+    def add(self, late_ns):
+        if late_ns < 0:
+            # kept out of the buckets, a tick before its deadline is a bug
+            # in the clock and not jitter
+            self.early += 1
+            if -late_ns > self.max_early_ns:
+                self.max_early_ns = -late_ns
+        else:
+            self.counts[bisect.bisect_left(self.bounds_ns, late_ns)] += 1
+        self.count += 1
+        self.total_ns += late_ns
+        if late_ns > self.max_ns:
+            self.max_ns = late_ns
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.early += other.early
+        self.max_early_ns = max(self.max_early_ns, other.max_early_ns)
+
+    def mean_us(self):
+        if not self.count:
+            return 0.0
+        return self.total_ns / self.count / 1000
+
+    def percentile_us(self, fraction):
+        """Returns the upper bound of the bucket containing the given
+        fraction of ticks (or the max value for the last bucket)."""
+        target = fraction * self.count
+        accumulated = self.early
+        if self.early and accumulated >= target:
+            return 0
+        for i, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= target and count:
+                if i < len(JITTER_BUCKETS_US):
+                    return JITTER_BUCKETS_US[i]
+                break
+        return self.max_ns / 1000
+
+    def summary(self):
+        text = "p50 <{0}us p99 <{1}us max {2:.0f}us mean {3:.0f}us".format(
+            self.percentile_us(0.5), self.percentile_us(0.99),
+            self.max_ns / 1000, self.mean_us())
+        if self.early:
+            text += " early {0} (max {1:.0f}us)".format(
+                self.early, self.max_early_ns / 1000)
+        return text
+
+    def format(self):
+        """Returns a multi-line text representation of the histogram."""
+        lines = []
+        labels = ["<{0}us".format(bound) for bound in JITTER_BUCKETS_US]
+        labels.append(">={0}us".format(JITTER_BUCKETS_US[-1]))
+        counts = list(self.counts)
+        if self.early:
+            labels.insert(0, "early")
+            counts.insert(0, self.early)
+        for label, count in zip(labels, counts):
+            fraction = count / self.count if self.count else 0.0
+            lines.append("{0:>9} {1:9d} {2:6.2f}% {3}".format(
+                label, count, 100 * fraction, "#" * int(fraction * 50)))
+        return "\n".join(lines)
+
+
+class _TimerFD:
+    """Minimal periodic CLOCK_MONOTONIC timerfd, using the os module when
+    it has timerfd support and libc through ctypes otherwise."""
+
+    class _TimeSpec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    class _ITimerSpec(ctypes.Structure):
+        pass
+
+    _ITimerSpec._fields_ = [("it_interval", _TimeSpec),
+                            ("it_value", _TimeSpec)]
+
+    _libc = None
+
+    def __init__(self):
+        if hasattr(os, "timerfd_create"):
+            self.fd = os.timerfd_create(
+                time.CLOCK_MONOTONIC, flags=TFD_NONBLOCK | TFD_CLOEXEC)
+            return
+        libc = self._load_libc()
+        self.fd = libc.timerfd_create(
+            time.CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "timerfd_create failed")
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            # raises AttributeError where timerfd is not available
+            libc.timerfd_create.restype = ctypes.c_int
+            libc.timerfd_settime.restype = ctypes.c_int
+            cls._libc = libc
+        return cls._libc
+
+    def set_absolute(self, deadline_ns, interval_ns):
+        if hasattr(os, "timerfd_settime_ns"):
+            os.timerfd_settime_ns(
+                self.fd, flags=TFD_TIMER_ABSTIME, initial=deadline_ns,
+                interval=interval_ns)
+            return
+        spec = self._ITimerSpec()
+        spec.it_value.tv_sec, spec.it_value.tv_nsec = divmod(
+            deadline_ns, 1000000000)
+        spec.it_interval.tv_sec, spec.it_interval.tv_nsec = divmod(
+            interval_ns, 1000000000)
+        result = self._libc.timerfd_settime(
+            self.fd, TFD_TIMER_ABSTIME, ctypes.byref(spec), None)
+        if result < 0:
+            raise OSError(ctypes.get_errno(), "timerfd_settime failed")
+
+    def read_expirations(self):
+        try:
+            return int.from_bytes(os.read(self.fd, 8), sys.byteorder)
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        os.close(self.fd)
+
+
+def monotonic_ns():
+    # the same clock as the timerfd uses
+    return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+
+class FrameClock:
+    """Fixed-rate frame scheduler for one game. Call start() and then await
+    tick() once per frame. When the game falls behind, tick() returns
+    immediately for each missed frame, so the frame count catches up with
+    the schedule."""
+
+    def __init__(self, frame_rate=PAL_FRAME_RATE, use_timerfd=True):
+        self.frame_rate = frame_rate
+        self.period_ns = int(round(1000000000 / frame_rate))
+        self.jitter = JitterHistogram()
+        self.next_deadline = 0
+        self._timer = None
+        self._waiter = None
+        self._loop = None
+        self._use_timerfd = use_timerfd and sys.platform.startswith("linux")
+
+    @property
+    def period(self):
+        """The frame period in seconds."""
+        return self.period_ns / 1000000000
+
+    @property
+    def uses_timerfd(self):
+        return self._timer is not None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        if self._use_timerfd and self._timer is None:
+            try:
+                self._timer = _TimerFD()
+            except (OSError, AttributeError, TypeError):
+                self._timer = None
+            else:
+                self._loop.add_reader(self._timer.fd, self._on_timer)
+        self._schedule(monotonic_ns() + self.period_ns)
+
+    def reset(self):
+        """Restarts the schedule with the next frame due now."""
+        self._schedule(monotonic_ns())
+
+    def _schedule(self, deadline_ns):
+        self.next_deadline = deadline_ns
+        if self._timer is not None:
+            self._timer.set_absolute(deadline_ns, self.period_ns)
+            # drop expirations of the previous schedule
+            self._timer.read_expirations()
+
+    def _on_timer(self):
+        # expirations are only wake-ups, tick() compares the clock with the
+        # deadline itself
+        self._timer.read_expirations()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def tick(self):
+        """Waits until the next frame deadline."""
+        deadline = self.next_deadline
+        while True:
+            delay = deadline - monotonic_ns()
+            if delay <= 0:
+                break
+            if self._timer is not None:
+                self._waiter = self._loop.create_future()
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+            else:
+                await asyncio.sleep(delay / 1000000000)
+        self.jitter.add(monotonic_ns() - deadline)
+        self.next_deadline = deadline + self.period_ns
+
+    def close(self):
+        if self._timer is not None:
+            self._loop.remove_reader(self._timer.fd)
+            self._timer.close()
+            self._timer = None
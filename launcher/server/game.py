@@ -18,13 +18,20 @@ Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
 """
 import sys
 import time
+import json
+import asyncio
+from array import array
 from collections import deque
 import socket
+import struct
 import traceback
-import threading
 import random
+import ipaddress
 from hashlib import sha1
 
+from launcher.server.frame_clock import FrameClock, JitterHistogram, \
+    JITTER_BUCKETS_US, PAL_FRAME_RATE, parse_frame_rate
+
 
 def int_to_bytes(number):
     return bytes([(number & 0xff000000) >> 24, (number & 0x00ff0000) >> 16,
@@ -51,11 +58,16 @@ SERVER_PROTOCOL_VERSION = 1
 MAX_PLAYERS = 6
 max_drift = 25
 num_clients = 2
+num_games = 1
+rooms = False
 port = 25100
 host = "0.0.0.0"
-game = None
 game_password = 0
 launch_timeout = 0
+frame_rate = PAL_FRAME_RATE
+# number of frames of memory and random checks kept for each client, must
+# be larger than max_drift
+check_history = 100
 server_protocol_version = byte(SERVER_PROTOCOL_VERSION)
 
 
@@ -120,14 +132,33 @@ def create_ext_message(ext, data):
     return 0x80000000 | ext << 24 | (data & 0xffffff)
 
 
-class Client:
-
-    def __init__(self, sock, address):
-        # self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket = sock
-        self.messages = []
-        self.lock = threading.Lock()
-        self.address = address
+CLOSE_TIMEOUT = 5.0
+OUT_BUFFER_SIZE = 4096
+MESSAGE_STRUCT = struct.Struct(">I")
+
+# size of the connection header sent by clients: "FSNP", protocol version,
+# password, emulator version, session key, player, tag and resume packet
+HANDSHAKE_SIZE = 4 + 1 + 4 + 8 + 3 + 1 + 3 + 4
+
+
+class Client(asyncio.Protocol):
+    """One connected client. Incoming data is buffered and split into
+    messages as it arrives, on the event loop shared by all games."""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.game = None
+        self.transport = None
+        self.address = None
+        self.buffer = bytearray()
+        self.initialized = False
+        self.closed = False
+        # outgoing messages are packed into out_buffer, and written to the
+        # transport once per frame
+        self.out_buffer = bytearray(OUT_BUFFER_SIZE)
+        self.out_size = 0
+        self.messages_sent = 0
+        self.writes = 0
         self.ready = 0
         self.tag = b"PLY"
         self.player = 0
@@ -136,8 +167,10 @@ class Client:
         self.frame_times = [0.0 for _ in range(100)]
         self.lag = 0.0
         self.out_seq = 0
-        self.memcheck = [(0, 0) for _ in range(100)]
-        self.rndcheck = [(0, 0) for _ in range(100)]
+        # ring buffers with (frame << 24 | check) for the last check_history
+        # frames
+        self.memcheck = array("Q", [0]) * check_history
+        self.rndcheck = array("Q", [0]) * check_history
         self.ping_sent_at = 0
         self.pings = deque([0 for _ in range(10)])
         self.pings_sum = 0
@@ -147,11 +180,56 @@ class Client:
         self.session_key = 0
         self.resume_from_packet = 0
 
-        self.temp_a = 0
-        self.temp_b = 0
-        self.temp_c = 0
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print("Client connected", self)
+
+    def is_local(self):
+        try:
+            address = ipaddress.ip_address(self.address[0])
+        except (TypeError, ValueError):
+            return False
+        if getattr(address, "ipv4_mapped", None) is not None:
+            address = address.ipv4_mapped
+        return address.is_loopback
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.game is not None:
+            self.game.on_client_disconnected(self)
 
-        threading.Thread(target=self.__thread_function).start()
+    def data_received(self, data):
+        if self.closed:
+            return
+        self.buffer += data
+        try:
+            if not self.initialized:
+                if not self.initialize_client():
+                    return
+            self.process_messages()
+        except Exception:
+            traceback.print_exc()
+            if self.game is not None:
+                self.game.stop_game()
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.transport.can_write_eof():
+            # Closing a socket with unread data resets the connection, and
+            # the client could miss the last (error) messages. Half-close
+            # it instead and give the client time to close its end.
+            self.transport.write_eof()
+            asyncio.get_running_loop().call_later(
+                CLOSE_TIMEOUT, self.transport.close)
+        else:
+            self.transport.close()
 
     def send_error_message(self, error_num):
         print(self, "error", error_num)
@@ -159,205 +237,181 @@ class Client:
         self.send_message(message)
 
     def send_message(self, message):
-        with self.lock:
-            # if message == 0x87000000:
-            #     #print("queueing %08x" % (message,))
-            #     #traceback.print_stack()
-            #     self.temp_c += 1
-            self.__send_data(int_to_bytes(message))
+        self.queue_message(message)
+        self.__send_queued_messages()
 
     def __send_data(self, data):
-        # if data[0] == '\x87':
-        #     #print("queueing ping")
-        #     #traceback.print_stack()
-        #     self.temp_c += 1
-        self.socket.sendall(data)
+        if not self.closed:
+            self.transport.write(data)
+            self.writes += 1
 
     def queue_message(self, message):
-        with self.lock:
-            # if message == 0x87000000:
-            #     #print("queueing %08x" % (message,))
-            #     #traceback.print_stack()
-            #     self.temp_c += 1
-            # print("queueing %08x" % (message,))
-            # if message & 0x20000000:
-            #     traceback.print_stack()
-            self.messages.append(int_to_bytes(message))
-            if len(self.messages) == 100:
-                self.__send_queued_messages()
+        if self.out_size + 4 > OUT_BUFFER_SIZE:
+            self.__send_queued_messages()
+        MESSAGE_STRUCT.pack_into(self.out_buffer, self.out_size, message)
+        self.out_size += 4
+        self.messages_sent += 1
 
     def queue_bytes(self, message):
-        with self.lock:
-            self.messages.append(message)
-            if len(self.messages) == 100:
-                self.__send_queued_messages()
+        size = len(message)
+        if self.out_size + size > OUT_BUFFER_SIZE:
+            self.__send_queued_messages()
+            if size > OUT_BUFFER_SIZE:
+                self.messages_sent += 1
+                self.__send_data(message)
+                return
+        self.out_buffer[self.out_size:self.out_size + size] = message
+        self.out_size += size
+        self.messages_sent += 1
 
     def send_queued_messages(self):
-        with self.lock:
-            self.__send_queued_messages()
+        self.__send_queued_messages()
 
     def __send_queued_messages(self):
-        data = b"".join(self.messages)
-        self.messages[:] = []
-        # print("sending", repr(data))
+        if self.out_size == 0:
+            return
+        # The transport keeps the data if it cannot be sent right away, so
+        # the buffer is copied (once) instead of passed as a view.
+        data = bytes(memoryview(self.out_buffer)[:self.out_size])
+        self.out_size = 0
         self.__send_data(data)
 
     def initialize_client(self):
-        print("initialize", self)
-
-        def read_bytes(num):
-            read_data = b""
-            for i in range(num):
-                read_data = read_data + self.socket.recv(1)
-            if not len(read_data) == num:
-                raise Exception("did not get {0} bytes".format(num))
-            return read_data
-
-        # check header message
-        data = read_bytes(4)
-        if data == b"PING":
+        """Handles the connection header. Returns True when the client has
+        joined a game, and False while more data is needed or when the
+        connection was refused."""
+        data = self.buffer
+        if len(data) < 4:
+            return False
+        if data[:4] == b"PING":
             # connection check only
             self.__send_data(b"PONG")
+            self.close()
+            return False
+        if data[:4] == b"STAT":
+            # instrumentation, reply with the server status as JSON (to
+            # local clients only)
+            if not self.is_local():
+                print("refusing status request from", self.address)
+                self.close()
+                return False
+            status = self.listener.registry.status()
+            self.__send_data(json.dumps(status).encode("UTF-8"))
+            self.close()
             return False
-        if data != b"FSNP":
-            print(data)
+        if data[:4] != b"FSNP":
+            print(bytes(data[:4]))
             raise Exception("did not get expected FSNP header")
+        if len(data) < 5:
+            return False
         # check protocol version
-        data = self.socket.recv(1)
-        # print(repr(data), repr(server_protocol_version))
-        if data != server_protocol_version:
+        if data[4:5] != server_protocol_version:
             print("protocol mismatch")
             self.send_error_message(ERROR_PROTOCOL_MISMATCH)
+            self.close()
             return False
-        # check net play password
-        password = bytes_to_int(read_bytes(4))
-        if password != game_password:
-            print("wrong password")
-            self.send_error_message(ERROR_WRONG_PASSWORD)
+        if len(data) < HANDSHAKE_SIZE:
             return False
+        print("initialize", self)
+        # net play password, also selects the game when the listener hosts
+        # password-keyed rooms
+        password = bytes_to_int(data[5:9])
         # read emulator version
-        self.emulator_version = read_bytes(8)
+        self.emulator_version = bytes(data[9:17])
         # read player number and session key, session key is checked to
         # make sure another client cannot hijack this player slot
-        self.session_key = bytes_to_int(b"\0" + read_bytes(3))
-        self.player = byte_ord(self.socket.recv(1))
-        self.tag = read_bytes(3)
+        self.session_key = bytes_to_int(b"\0" + data[17:20])
+        self.player = data[20]
+        self.tag = bytes(data[21:24])
         # get package sequence number
-        self.resume_from_packet = bytes_to_int(read_bytes(4))
+        self.resume_from_packet = bytes_to_int(data[24:28])
+        del data[:HANDSHAKE_SIZE]
 
+        game = self.listener.find_game(password)
+        if game is None:
+            print("wrong password")
+            self.send_error_message(ERROR_WRONG_PASSWORD)
+            self.close()
+            return False
         error = game.add_client(self)
         if error:
             print(repr(error))
             self.send_error_message(error)
+            self.close()
             return False
+        self.game = game
+        self.initialized = True
 
         message = create_ext_message(MESSAGE_SESSION_KEY, self.session_key)
         self.queue_message(message)
-        data = (self.player << 8) | num_clients
+        data = (self.player << 8) | game.num_clients
         message = create_ext_message(MESSAGE_PLAYERS, data)
         self.queue_message(message)
 
         game.send_player_tags(self)
         self.send_queued_messages()
         print("initialize done for", self)
+        game.start_if_ready()
         return True
 
-    def __thread_function(self):
-        try:
-            try:
-                if not self.initialize_client():
-                    # print("initialize failed for", self)
-                    return
-                self.receive_loop()
-            except Exception:
-                traceback.print_exc()
-                game.stop = True
-        finally:
-            try:
-                self.socket.close()
-            except Exception:
-                pass
-
-    def receive_loop(self):
-        data = b""
-        count = 0
-        while not game.stop:
-            new_data = self.socket.recv(4 - count)
-            if not new_data:
-                # FIXME
-                return
-            data = data + new_data
-            count = len(data)
-            if count == 4:
-                self.on_message(data)
-                count = 0
-                data = b""
+    def process_messages(self):
+        buffer = self.buffer
+        size = len(buffer)
+        offset = 0
+        while size - offset >= 4 and not self.closed:
+            message = MESSAGE_STRUCT.unpack_from(buffer, offset)[0]
+            if message & 0xff000000 == 0x80000000 | MESSAGE_TEXT << 24:
+                # text messages are followed by the text itself
+                length = message & 0x00ffffff
+                if size - offset < 4 + length:
+                    break
+                text = bytes(buffer[offset + 4:offset + 4 + length])
+                offset += 4 + length
+                print("received text command")
+                self.game.add_text_message(self, text)
+                continue
+            offset += 4
+            self.on_message(message)
+        del buffer[:offset]
 
     def send_ping(self):
-        with self.lock:
-            # print("ping?", self.ping_sent_at)
-            if self.ping_sent_at == 0:
-                self.temp_a += 1
-                self.ping_sent_at = time.time()
-                message = int_to_bytes(0x80000000 | (7 << 24))
-                self.__send_data(message)
-                assert self.ping_sent_at > 0
+        if self.ping_sent_at == 0:
+            self.ping_sent_at = time.monotonic()
+            self.queue_message(0x80000000 | MESSAGE_PING << 24)
 
     def on_ping(self):
-        # may not need lock here
-        with self.lock:
-            self.temp_b += 1
-            if self.temp_a != self.temp_b:
-                print(self.temp_a, self.temp_b, self.temp_c)
-            assert self.ping_sent_at > 0
-            t = time.time()
-            new = (t - self.ping_sent_at) / 1.0
-            # print(t, "-", self.ping_sent_at, "=", new)
-            old = self.pings.popleft()
-            self.pings.append(new)
-            # print(self.pings)
-            self.pings_sum = self.pings_sum - old + new
-            self.pings_avg = self.pings_sum / len(self.pings)
-            self.ping_sent_at = 0
-
-    def on_message(self, m):
-        message = bytes_to_int(m)
-        # with game.lock:
-        #     if not self.playing:
-        #         print(self, "is no longer playing/valid, ignoring message")
+        if self.ping_sent_at == 0:
+            print(self, "unexpected ping reply")
+            return
+        t = time.monotonic()
+        new = (t - self.ping_sent_at) / 1.0
+        old = self.pings.popleft()
+        self.pings.append(new)
+        self.pings_sum = self.pings_sum - old + new
+        self.pings_avg = self.pings_sum / len(self.pings)
+        self.ping_sent_at = 0
 
+    def on_message(self, message):
+        game = self.game
         if message & 0x80000000:
             # ext message
             command = (message & 0x7f000000) >> 24
             data = message & 0x00ffffff
             if command == MESSAGE_MEM_CHECK:
-                self.memcheck[self.frame % 100] = (data, self.frame)
+                self.memcheck[self.frame % len(self.memcheck)] = \
+                    self.frame << 24 | data
             elif command == MESSAGE_RND_CHECK:
-                self.rndcheck[self.frame % 100] = (data, self.frame)
+                self.rndcheck[self.frame % len(self.rndcheck)] = \
+                    self.frame << 24 | data
             elif command == MESSAGE_PING:
-                # print("{0:x}".format(message))
                 self.on_ping()
-            elif command == MESSAGE_TEXT:
-                print("received text command")
-                remaining = data
-                text = b""
-                while not game.stop:
-                    part = self.socket.recv(remaining)
-                    count = len(part)
-                    text += part
-                    remaining -= count
-                    if remaining == 0:
-                        game.add_text_message(self, text)
-                        break
 
         elif message & (1 << 30):
             frame = message & 0x3fffffff
-            # print("received frame", frame)
             if frame != self.frame + 1:
                 print("error, expected frame", self.frame + 1, "got", frame)
-            # print("received frame", frame)
             self.frame = frame
-            t = time.time()
+            t = time.monotonic()
             self.frame_times[self.frame % 100] = t
             game_t = game.frame_times[self.frame % 100]
             self.lag = t - game_t
@@ -373,142 +427,186 @@ class Client:
                                              self.address)
 
 
+def ring_slice(ring, first, last):
+    """Returns the values for frames first to last (inclusive) from a ring
+    buffer indexed by frame number."""
+    size = len(ring)
+    if last - first >= size:
+        raise ValueError("frames {0}-{1} are not in the history".format(
+            first, last))
+    start = first % size
+    end = last % size + 1
+    if start < end:
+        return ring[start:end]
+    return ring[start:] + ring[:end]
+
+
 def create_session_key():
     return random.randint(0, 2**24 - 1)
 
 
 class Game:
 
-    def __init__(self, num_clients):
+    def __init__(self, num_clients, name="", frame_rate=PAL_FRAME_RATE):
+        self.num_clients = num_clients
+        self.name = name
         self.started = False
         self.frame = 0
-        self.time = 0
+        self.clock = FrameClock(frame_rate)
         self.clients = []
-        self.num_clients = 0
         self.frame_times = [0.0 for _ in range(100)]
-        self.lock = threading.Lock()
         self.stop = False
+        self.stopped = False
         self.session_keys = [0 for _ in range(MAX_PLAYERS)]
         self.emulator_version = b""
         self.verified_frame = -1
-
-    def __start(self):
-        if len(self.clients) != num_clients:
-            print("error - cannot start until all players have connected")
+        # first frame where the clients' checks did not match
+        self.divergent_frame = -1
+        self.last_activity_time = time.monotonic()
+        self.task = None
+        # called with the game as argument when the game has stopped
+        self.on_stopped = None
+
+    def start_if_ready(self):
+        if self.started or self.stop:
+            return
+        if len(self.clients) != self.num_clients:
             return
-        print("{0} clients connected, starting game".format(num_clients))
+        print("{0} {1} clients connected, starting game".format(
+            self, self.num_clients))
         self.started = True
-        threading.Thread(target=self.__thread_function).start()
+        self.task = asyncio.get_running_loop().create_task(self.__run())
+
+    def stop_game(self):
+        if self.stop:
+            return
+        self.stop = True
+        if self.task is None:
+            # game loop is not running
+            self.__stopped()
+
+    def __stopped(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        for client in self.clients:
+            client.close()
+        if self.on_stopped is not None:
+            self.on_stopped(self)
 
     def add_client(self, client):
-        with self.lock:
-            if client.player == 0xff:
-                if client.resume_from_packet != 0:
-                    return ERROR_CLIENT_ERROR
-                if self.started:
-                    return ERROR_GAME_ALREADY_STARTED
-                client.player = len(self.clients)
-                if client.player == 0:
-                    self.emulator_version = client.emulator_version
-                else:
-                    if self.emulator_version != client.emulator_version:
-                        return ERROR_EMULATOR_MISMATCH
-                client.session_key = create_session_key()
-                self.session_keys[client.player] = client.session_key
-                self.clients.append(client)
-                client.playing = True
-                if not self.started:
-                    if len(self.clients) == num_clients:
-                        self.__start()
+        self.last_activity_time = time.monotonic()
+        if self.stop:
+            return ERROR_GAME_STOPPED
+        if client.player == 0xff:
+            if client.resume_from_packet != 0:
+                return ERROR_CLIENT_ERROR
+            if self.started or len(self.clients) == self.num_clients:
+                return ERROR_GAME_ALREADY_STARTED
+            client.player = len(self.clients)
+            if client.player == 0:
+                self.emulator_version = client.emulator_version
             else:
-                if client.player >= len(self.clients):
-                    return ERROR_PLAYER_NUMBER
-                if self.session_keys[client.player] != client.session_key:
-                    return ERROR_SESSION_KEY
+                if self.emulator_version != client.emulator_version:
+                    return ERROR_EMULATOR_MISMATCH
+            client.session_key = create_session_key()
+            self.session_keys[client.player] = client.session_key
+            self.clients.append(client)
+            client.playing = True
+        else:
+            if client.player >= len(self.clients):
+                return ERROR_PLAYER_NUMBER
+            if self.session_keys[client.player] != client.session_key:
+                return ERROR_SESSION_KEY
 
-                # FIXME: must transfer settings for resuming to work
-                # old_client = self.clients[client.player]
+            # FIXME: must transfer settings for resuming to work
+            # old_client = self.clients[client.player]
 
-                self.clients[client.player] = client
-                client.playing = True
+            self.clients[client.player] = client
+            client.playing = True
 
-                if client.resume_from_packet > 0:
-                    # cannot resume yet...
-                    print("cannot resume at packet", client.resume_from_packet)
-                    return ERROR_CANNOT_RESUME
+            if client.resume_from_packet > 0:
+                # cannot resume yet...
+                print("cannot resume at packet", client.resume_from_packet)
+                return ERROR_CANNOT_RESUME
         return 0
-        # FIXME: start the game..?
 
-    def __thread_function(self):
+    def on_client_disconnected(self, client):
+        if client not in self.clients:
+            return
+        for c in self.clients:
+            if not c.closed:
+                return
+        print(self, "all clients have disconnected")
+        self.stop_game()
+
+    async def __run(self):
         try:
-            self.__game_loop()
+            await self.__game_loop()
         except Exception:
             traceback.print_exc()
             self.stop = True
+        finally:
+            self.clock.close()
+        self.__stopped()
 
     def __send_player_tags(self, send_to_client):
-        for i, client in enumerate(game.clients):
+        for i, client in enumerate(self.clients):
             data = bytes_to_int(b"\0" + client.tag)
             message = create_ext_message(MESSAGE_PLAYER_TAG_0 + i, data)
             send_to_client.queue_message(message)
 
     def send_player_tags(self, client):
-        with game.lock:
-            self.__send_player_tags(client)
+        self.__send_player_tags(client)
 
-    def __game_loop(self):
-        with self.lock:
-            for client in self.clients:
-                self.__send_player_tags(client)
-        print("game loop running")
-        self.time = time.time()
+    async def __game_loop(self):
+        for client in self.clients:
+            self.__send_player_tags(client)
+        self.clock.start()
+        print(self, "game loop running at", self.clock.frame_rate,
+              "frames per second", "(timerfd)"
+              if self.clock.uses_timerfd else "(loop timers)")
         while True:
             if self.stop:
-                print("stopping game loop")
+                print(self, "stopping game loop")
                 # try to send error message to all players
-                with self.lock:
-                    for client in self.clients:
-                        try:
-                            client.send_error_message(ERROR_GAME_STOPPED)
-                        except Exception:
-                            traceback.print_exc()
-                return
-            self.__game_loop_iteration()
-
-    def __game_loop_iteration(self):
-        # FIXME: higher precision sleep?
-        target_time = self.time + 0.02
-        t2 = time.time()
-        diff = target_time - t2
-        sleep = diff - 0.001
-        if sleep > 0.0:
-            # print(sleep)
-            time.sleep(sleep)
-        self.time = target_time
-        while time.time() < target_time:
-            # busy-loop until target time
-            pass
-
-        with self.lock:
-            if self.frame % 100 == 0:
-                self.__send_status()
-            self.frame += 1
-            self.frame_times[self.frame % 100] = time.time()
-            message = (1 << 30) | self.frame
-            self.__send_to_clients(message, True)
-            if self.frame % 10 == 0:
                 for client in self.clients:
-                    client.send_ping()
-            if self.frame % 200 == 0:
-                self.__print_status()
+                    try:
+                        client.send_error_message(ERROR_GAME_STOPPED)
+                    except Exception:
+                        traceback.print_exc()
+                return
+            await self.__game_loop_iteration()
+
+    async def __game_loop_iteration(self):
+        await self.clock.tick()
+        if self.frame % 100 == 0:
+            self.__send_status()
+        self.frame += 1
+        self.frame_times[self.frame % 100] = time.monotonic()
+        message = (1 << 30) | self.frame
+        send_ping = self.frame % 10 == 0
+        for client in self.clients:
+            client.queue_message(message)
+            if send_ping:
+                client.send_ping()
+        # Input events and status messages have been queued since the last
+        # frame, so each client gets one write per frame.
+        for client in self.clients:
+            client.send_queued_messages()
+        if self.frame % 200 == 0:
+            self.__print_status()
 
-        self.__check_game()
+        await self.__check_game()
 
-    def __check_game(self):
+    async def __check_game(self):
         oldest_frame, frames = self.__check_frame_status()
-        while oldest_frame > self.verified_frame:
-            self.check_synchronization(self.verified_frame + 1)
-            self.verified_frame += 1
+        # the checks for a frame are sent after the frame is acknowledged,
+        # so frames are verified when all clients have acknowledged the
+        # next frame
+        if oldest_frame - 1 > self.verified_frame:
+            self.verify_frames(self.verified_frame + 1, oldest_frame - 1)
+            self.verified_frame = oldest_frame - 1
         diff = self.frame - oldest_frame
         if diff <= max_drift:
             # clients have not drifted too far
@@ -518,31 +616,32 @@ class Game:
         while diff > 0 and not self.stop:
             if first:
                 first = False
-                print("---", self.frame, "acked", frames)
+                print("---", self, self.frame, "acked", frames)
             elif count % 100 == 0:
-                print("   ", self.frame, "acked", frames)
-            time.sleep(0.02)
+                print("   ", self, self.frame, "acked", frames)
+            await asyncio.sleep(self.clock.period)
             oldest_frame, frames = self.__check_frame_status()
             diff = self.frame - oldest_frame
             count += 1
-        self.time = time.time() - 0.02
+        # continue with the next frame right away
+        self.clock.reset()
 
     def __check_frame_status(self):
         oldest_frame = self.frame
         frames = []
-        with self.lock:
-            for client in self.clients:
-                af = client.frame
-                if af < oldest_frame:
-                    oldest_frame = af
-                frames.append(af)
+        for client in self.clients:
+            af = client.frame
+            if af < oldest_frame:
+                oldest_frame = af
+            frames.append(af)
         return oldest_frame, frames
 
     def __print_status(self):
         for i, client in enumerate(self.clients):
-            print("{0} f {1:6d} p avg: {2:3d} {3:3d}".format(
-                i, client.frame, int(client.pings_avg * 1000),
+            print("{0} {1} f {2:6d} p avg: {3:3d} {4:3d}".format(
+                self, i, client.frame, int(client.pings_avg * 1000),
                 int(client.lag * 1000)))
+        print(self, "frame jitter", self.clock.jitter.summary())
 
     def __send_status(self):
         for i, client in enumerate(self.clients):
@@ -559,164 +658,279 @@ class Game:
             print("game not started, ignoring input event {0:08x}".format(
                 input_event))
             return
-        with self.lock:
-            if not client.playing:
-                print("client", client, "is no longer valid, dropping msg")
-                return
-            # for now, just broadcast out again to all clients
-            message = (1 << 29) | input_event
-            self.__send_to_clients(message)
+        if not client.playing:
+            print("client", client, "is no longer valid, dropping msg")
+            return
+        # for now, just broadcast out again to all clients
+        message = (1 << 29) | input_event
+        self.__send_to_clients(message)
 
     def add_text_message(self, from_client, text):
         print("add text message")
-        with self.lock:
-            for client in self.clients:
-                # if from_client == client:
-                #     continue
-                message = (0x80000000 | MESSAGE_TEXT << 24 |
-                           from_client.player << 16 | len(text))
-                message = int_to_bytes(message) + text
-                print("send", repr(message), "to", client)
-                client.queue_bytes(message)
+        for client in self.clients:
+            # if from_client == client:
+            #     continue
+            message = (0x80000000 | MESSAGE_TEXT << 24 |
+                       from_client.player << 16 | len(text))
+            message = int_to_bytes(message) + text
+            print("send", repr(message), "to", client)
+            client.queue_bytes(message)
 
     def send_to_clients(self, message, force_send=False):
-        # using a lock here to ensure that send_to_clients can
-        # be called from multiple threads, but all clients will
-        # still get messages in expected order
-        with self.lock:
-            self.__send_to_clients(message, force_send)
+        self.__send_to_clients(message, force_send)
 
     def __send_to_clients(self, message, force_send=False):
         for client in self.clients:
-            # print("send", message, "to", client)
             client.queue_message(message)
             if force_send:
                 client.send_queued_messages()
 
-    def check_synchronization(self, check_frame):
-        # FIXME: MOVE TO GAME CLASS
-        # FIXME: ONLY RUN ONCE PER FRAME, not once per frame * clients
-        # if self.frame == 0:
-        #     return
-        with game.lock:
-            # print("received memcheck", data)
-            # check_frame = self.frame - 1
-            if check_frame < 0:
-                return
-            index = check_frame % 100
-            mem_check_data = []
-            rnd_check_data = []
-            for client in game.clients:
-                if client.frame <= check_frame:
-                    # cannot check yet
-                    return
-                # print(client, client.frame, client.memcheck)
-                mem_check_data.append((client, client.memcheck[index]))
-                rnd_check_data.append((client, client.rndcheck[index]))
-            check = mem_check_data[0][1]
-            for client, data in mem_check_data:
-                if check != data:
-                    print("memcheck failed for frame", check_frame)
-                    for c, d in mem_check_data:
-                        print("* {0:08x}  f {1:05d} {2}".format(d[0], d[1], c))
-                    for c in game.clients:
-                        c.send_error_message(ERROR_MEMORY_DESYNC)
-                        c.send_queued_messages()
-                    raise Exception("mem check failed")
-            check = rnd_check_data[0][1]
-            for client, data in rnd_check_data:
-                if check != data:
-                    print("rndcheck failed for frame", check_frame)
-                    for c, d in rnd_check_data:
-                        print("* {0:08x}  f {1:05d} {2}".format(d[0], d[1], c))
-                    for c in game.clients:
-                        c.send_error_message(ERROR_RANDOM_DESYNC)
-                        c.send_queued_messages()
-                    raise Exception("rnd check failed")
-
-address_map = {
-
-}
-
-
-def accept_client(server_socket):
-    global last_keepalive_time
-
-    server_socket.settimeout(1)
-    client_socket, client_address = server_socket.accept()
-    # client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDLOWAT, 4)
-    client_socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-    client_socket.settimeout(None)
-    client = Client(client_socket, client_address)
-    # client.player = len(game.clients) + 1
-    print("Client connected", client)
-    last_keepalive_time = time.time()
-
-    # game.add_client(client)
-    # client.start()
-    # if game.can_start():
-    #     game.start()
-
-
-# stop_accepting = False
-
-
-def accept_thread(server_socket):
-    while not game.stop:
-        try:
-            accept_client(server_socket)
-        except socket.timeout:
-            pass
-        except Exception:
-            traceback.print_exc()
-            time.sleep(1.0)
-
+    def verify_frames(self, first, last):
+        """Compares the memory and random checks from all clients for the
+        frames first to last (inclusive). Sends desync errors to the clients
+        and raises an exception if the checks differ."""
+        if len(self.clients) < 2:
+            return
+        for name, error in [("memcheck", ERROR_MEMORY_DESYNC),
+                            ("rndcheck", ERROR_RANDOM_DESYNC)]:
+            frame = self.__find_divergent_frame(name, first, last)
+            if frame == -1:
+                continue
+            self.divergent_frame = frame
+            print(name, "failed for frame", frame)
+            for c in self.clients:
+                ring = getattr(c, name)
+                value = ring[frame % len(ring)]
+                print("* {0:08x}  f {1:05d} {2}".format(
+                    value & 0xffffff, value >> 24, c))
+            for c in self.clients:
+                c.send_error_message(error)
+                c.send_queued_messages()
+            raise Exception(name + " failed")
+
+    def __find_divergent_frame(self, name, first, last):
+        # the checks are compared as whole array slices, and only searched
+        # frame by frame when the slices differ
+        reference = ring_slice(getattr(self.clients[0], name), first, last)
+        result = -1
+        for client in self.clients[1:]:
+            values = ring_slice(getattr(client, name), first, last)
+            if values == reference:
+                continue
+            for i, value in enumerate(values):
+                if value != reference[i]:
+                    if result == -1 or first + i < result:
+                        result = first + i
+                    break
+        return result
+
+    def verification_status(self):
+        """Returns the verification progress for this game. Verification lag
+        is the number of frames sent but not verified yet."""
+        return {
+            "name": self.name,
+            "started": self.started,
+            "clients": len(self.clients),
+            "frame": self.frame,
+            "verified_frame": self.verified_frame,
+            "verification_lag": self.frame - self.verified_frame - 1,
+            "divergent_frame": self.divergent_frame,
+        }
 
-def _run_server():
-    global game
-    global last_keepalive_time
-    game = Game(num_clients)
-    address = (host, port)
-    server_socket = socket.socket()
-    server_socket.bind(address)
-    server_socket.listen(10)
+    def __str__(self):
+        return "<Game {0}>".format(self.name)
+
+
+class Listener:
+    """Accepts clients on one port. The listener either hosts a single game
+    protected by a password, or (with rooms enabled) one game per
+    password, created when the first client connects with it."""
+
+    def __init__(self, registry, port, num_clients, password=0,
+                 rooms=False):
+        self.registry = registry
+        self.port = port
+        self.num_clients = num_clients
+        self.password = password
+        self.rooms = rooms
+        self.server = None
+
+    def find_game(self, password):
+        if not self.rooms and password != self.password:
+            return None
+        return self.registry.get_game(self.port, password, self.num_clients)
+
+    def create_client(self):
+        return Client(self)
+
+
+class SessionRegistry:
+    """Keeps track of all games hosted by this process, keyed by port and
+    password. Games are removed when they have stopped, or when they have
+    not started within launch_timeout seconds since the last client
+    joined."""
+
+    def __init__(self, launch_timeout=0, frame_rate=PAL_FRAME_RATE):
+        self.launch_timeout = launch_timeout
+        self.frame_rate = frame_rate
+        self.games = {}
+        # sessions are named by port and a sequence number, since the
+        # password must not be revealed in the status
+        self.session_count = 0
+        self.listeners = []
+        self.games_started = 0
+        self.games_finished = 0
+        # frame jitter of games which have stopped
+        self.finished_jitter = JitterHistogram()
+        # verification status of recent games which stopped on a desync
+        self.desyncs = deque(maxlen=100)
+        # set when a started game has stopped
+        self.game_finished = asyncio.Event()
+
+    async def listen(self, host, port, num_clients, password=0, rooms=False):
+        if num_clients > MAX_PLAYERS:
+            print("ERROR: max clients are", MAX_PLAYERS)
+        listener = Listener(self, port, num_clients, password, rooms)
+        listener.server = await asyncio.get_running_loop().create_server(
+            listener.create_client, host, port, backlog=100)
+        self.listeners.append(listener)
+        if host != "0.0.0.0":
+            print("server listening on", host, "port", port)
+        else:
+            print("server listening on port", port)
+        return listener
+
+    def get_game(self, port, password, num_clients):
+        key = (port, password)
+        game = self.games.get(key)
+        if game is None:
+            self.session_count += 1
+            game = Game(num_clients, name="{0}:{1}".format(
+                port, self.session_count), frame_rate=self.frame_rate)
+            game.on_stopped = self.__on_game_stopped
+            self.games[key] = game
+        return game
+
+    def __on_game_stopped(self, game):
+        for key, value in list(self.games.items()):
+            if value is game:
+                del self.games[key]
+        if game.started:
+            self.games_finished += 1
+            self.finished_jitter.merge(game.clock.jitter)
+            if game.divergent_frame != -1:
+                self.desyncs.append(game.verification_status())
+            self.game_finished.set()
+
+    def expire_games(self):
+        """Stops games which have not started in time. Returns the number
+        of stopped games."""
+        if not self.launch_timeout:
+            return 0
+        count = 0
+        t = time.monotonic()
+        for game in list(self.games.values()):
+            if game.started:
+                continue
+            if t - game.last_activity_time > self.launch_timeout:
+                print(game, "not started yet, aborting (timeout)")
+                game.stop_game()
+                count += 1
+        return count
+
+    def stats(self):
+        """Returns a dictionary with the number of hosted games and
+        connected clients, and a frame jitter histogram for all games."""
+        games = list(self.games.values())
+        jitter = JitterHistogram()
+        jitter.merge(self.finished_jitter)
+        for game in games:
+            jitter.merge(game.clock.jitter)
+        clients = [client for game in games for client in game.clients]
+        return {
+            "games": len(games),
+            "running": sum(1 for game in games if game.started),
+            "clients": len(clients),
+            "finished": self.games_finished,
+            "jitter": jitter,
+            # sent to the clients of the current games
+            "client_frames": sum(
+                game.frame * len(game.clients) for game in games),
+            "messages_sent": sum(client.messages_sent for client in clients),
+            "writes": sum(client.writes for client in clients),
+        }
+
+    def status(self):
+        """Returns stats() and the verification status of each game, in a
+        form which can be serialized as JSON."""
+        status = self.stats()
+        jitter = status["jitter"]
+        status["jitter"] = {
+            "buckets_us": list(JITTER_BUCKETS_US),
+            "counts": jitter.counts,
+            "max_us": jitter.max_ns / 1000,
+            "mean_us": jitter.mean_us(),
+            "early": jitter.early,
+            "max_early_us": jitter.max_early_ns / 1000,
+        }
+        status["sessions"] = [
+            game.verification_status() for game in self.games.values()]
+        status["desyncs"] = list(self.desyncs)
+        return status
+
+    def close(self):
+        for listener in self.listeners:
+            listener.server.close()
+        for game in list(self.games.values()):
+            game.stop_game()
+
+
+async def _run_server():
+    registry = SessionRegistry(launch_timeout, frame_rate)
+    for i in range(num_games):
+        await registry.listen(host, port + i, num_clients, game_password,
+                              rooms=rooms)
     print("listening")
     sys.stdout.flush()
-    if address[0] != "0.0.0.0":
-        print("server listening on", address[0], "port", address[1])
-    else:
-        print("server listening on port", address[1])
     print("want", num_clients, "client(s)")
-    if num_clients > MAX_PLAYERS:
-        print("ERROR: max clients are", MAX_PLAYERS)
-    threading.Thread(target=accept_thread, args=(server_socket,)).start()
-    last_keepalive_time = time.time()
-    while not game.started:
-        time.sleep(0.1)
-        if launch_timeout:
-            t2 = time.time()
-            if t2 - last_keepalive_time > launch_timeout:
-                print("game not started yet, aborting (timeout)")
-                game.stop = True
-                return
-                # sys.exit()
-    print("game started")
-    while not game.stop:
-        time.sleep(0.1)
+    single_game = num_games == 1 and not rooms
+    if single_game:
+        registry.get_game(port, game_password, num_clients)
+    try:
+        while True:
+            if single_game and registry.game_finished.is_set():
+                # the game hosted by this process has ended
+                break
+            if registry.expire_games() and single_game:
+                break
+            if single_game:
+                # replace the game if all players left before it started
+                registry.get_game(port, game_password, num_clients)
+            try:
+                await asyncio.wait_for(
+                    registry.game_finished.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        registry.close()
+        jitter = registry.stats()["jitter"]
+        if jitter.count:
+            print("frame jitter", jitter.summary())
+            print(jitter.format())
 
 
 def run_server():
     try:
-        _run_server()
+        asyncio.run(_run_server())
     except Exception:
         traceback.print_exc()
     except KeyboardInterrupt:
         traceback.print_exc()
-    game.stop = True
 
 
 def main():
     global port, num_clients, game_password, launch_timeout
+    global num_games, rooms, frame_rate, check_history
     for arg in sys.argv:
         if arg.startswith("--"):
             parts = arg[2:].split("=", 1)
@@ -733,6 +947,18 @@ def main():
                     # print("game password (numeric) is", game_password)
                 elif key == "launch-timeout":
                     launch_timeout = int(value)
+                elif key == "games":
+                    # host one game per port, starting at --port
+                    num_games = int(value)
+                elif key == "rooms":
+                    # host one game per password on each port
+                    rooms = value == "1"
+                elif key == "frame-rate":
+                    # pal, ntsc or frames per second
+                    frame_rate = parse_frame_rate(value)
+                elif key == "check-history":
+                    # frames of checks kept for desync verification
+                    check_history = max(int(value), max_drift + 2)
     run_server()
 
 
@@ -1,5 +1,9 @@
 import hashlib
+import json
 import os
+import time
+import traceback
+from uuid import uuid4
 
 import fsbc.user
 from fsbc.paths import Paths
@@ -8,10 +12,95 @@ from fsgs.Database import Database
 from fsgs.FSGSDirectories import FSGSDirectories
 from fsgs.FileDatabase import FileDatabase
 from fsgs.amiga.Amiga import Amiga
-from fsgs.amiga.ROMManager import ROMManager
+from fsgs.amiga.ROMManager import ROMChecksumCache, ROMManager
 from fsgs.context import fsgs
 from .configuration_scanner import ConfigurationScanner
-from .launcher_settings import LauncherSettings
+
+
+class ScanState(object):
+    """Directory listings from the previous startup scans, stored in the
+    cache dir. Each scanned tree has a section with the root path, a
+    version (scans are redone from scratch when it changes) and a mapping
+    from directory path to [mtime_ns, file names, subdirectory names]."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(self.path, "r", encoding="UTF-8") as f:
+                self.sections = json.load(f)
+        except (OSError, ValueError):
+            self.sections = {}
+
+    def get_dirs(self, name, root, version):
+        section = self.sections.get(name)
+        if not isinstance(section, dict):
+            return {}
+        if section.get("root") != root or section.get("version") != version:
+            return {}
+        return section.get("dirs", {})
+
+    def set_dirs(self, name, root, version, dirs):
+        self.sections[name] = {"root": root, "version": version, "dirs": dirs}
+        temp_path = "{0}.{1}.partial".format(self.path, uuid4())
+        try:
+            with open(temp_path, "w", encoding="UTF-8") as f:
+                json.dump(self.sections, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            traceback.print_exc()
+
+
+def scan_tree(root, old_dirs, accept):
+    """Walks root, only listing directories which have changed since
+    old_dirs was recorded (the listings of other directories are reused).
+    Returns (dirs, changed_dirs, paths) where dirs is the new directory
+    state, changed_dirs is the set of directories which were listed, and
+    paths are the accepted files in those directories."""
+    dirs = {}
+    changed_dirs = set()
+    paths = []
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            st = os.stat(dir_path)
+        except OSError:
+            continue
+        old = old_dirs.get(dir_path)
+        if old is not None and old[0] == st.st_mtime_ns:
+            dirs[dir_path] = old
+            sub_names = old[2]
+        else:
+            file_names = []
+            sub_names = []
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                # like os.walk, symlinked directories are
+                                # not followed
+                                if not entry.is_symlink():
+                                    sub_names.append(entry.name)
+                                continue
+                        except OSError:
+                            continue
+                        if accept(entry.name):
+                            file_names.append(entry.name)
+            except OSError:
+                continue
+            mtime = st.st_mtime_ns
+            if time.time() - st.st_mtime < 2.0:
+                # The directory may still be changing, so make sure it is
+                # listed again on the next scan.
+                mtime = 0
+            file_names.sort()
+            sub_names.sort()
+            dirs[dir_path] = [mtime, file_names, sub_names]
+            changed_dirs.add(dir_path)
+            paths.extend(Paths.join(dir_path, name) for name in file_names)
+        stack.extend(Paths.join(dir_path, name) for name in sub_names)
+    return dirs, changed_dirs, paths
 
 
 class StartupScan:
@@ -19,6 +108,11 @@ class StartupScan:
     _config_scanned = False
     _kickstart_scanned = False
 
+    @staticmethod
+    def get_scan_state():
+        return ScanState(os.path.join(
+            FSGSDirectories.get_cache_dir(), "StartupScan.json"))
+
     @classmethod
     def config_startup_scan(cls):
         if cls._config_scanned:
@@ -27,56 +121,66 @@ class StartupScan:
 
         configs_dir = FSGSDirectories.get_configurations_dir()
         print("config_startup_scan", configs_dir)
-        print(LauncherSettings.settings)
-
-        settings_mtime = LauncherSettings.get("configurations_dir_mtime")
-        dir_mtime = cls.get_dir_mtime_str(configs_dir)
-        if settings_mtime == dir_mtime + "+" + str(Database.VERSION):
-            print("... mtime not changed", settings_mtime, dir_mtime)
+        root = configs_dir.replace("\\", "/")
+        # config files are registered in both databases
+        version = "{0}+{1}".format(
+            Database.VERSION, FileDatabase.get_version())
+        state = cls.get_scan_state()
+        old_dirs = state.get_dirs("configurations", root, version)
+        dirs, changed_dirs, paths = scan_tree(
+            root, old_dirs, lambda name: name.endswith(".fs-uae"))
+        if not changed_dirs and dirs.keys() == old_dirs.keys():
+            print("... no directories changed")
             return
+        print("...", len(changed_dirs), "changed directories")
 
         database = Database.get_instance()
         file_database = FileDatabase.get_instance()
-
-        print("... database.find_local_configurations")
-        local_configs = Database.get_instance().find_local_configurations()
-        print("... walk configs_dir")
-        for dir_path, dir_names, file_names in os.walk(configs_dir):
-            for file_name in file_names:
-                if not file_name.endswith(".fs-uae"):
-                    continue
-                path = Paths.join(dir_path, file_name)
-                if path in local_configs:
-                    local_configs[path] = None
-                    # already exists in database
-                    continue
-                name, ext = os.path.splitext(file_name)
-                # search = ConfigurationScanner.create_configuration_search(
-                # name)
-                scanner = ConfigurationScanner()
-                print("[startup] adding config", path)
-                file_database.delete_file(path=path)
+        local_configs = database.find_local_configurations()
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            game_id = local_configs.pop(path, None)
+            if game_id is not None and file_database.get_checksum(
+                    path, st.st_size, st.st_mtime_ns) is not None:
+                # already exists in database, and is unchanged
+                continue
+            try:
                 with open(path, "rb") as f:
                     sha1 = hashlib.sha1(f.read()).hexdigest()
-                file_database.add_file(path=path, sha1=sha1)
-
-                game_id = database.add_game(
-                        path=path, name=scanner.create_configuration_name(name))
-                database.update_game_search_terms(
-                        game_id, scanner.create_search_terms(name))
-
-        for path, id in local_configs.items():
-            if id is not None:
-                print("[startup] removing configuration", path)
-                database.delete_game(id=id)
-                file_database.delete_file(path=path)
+            except OSError:
+                traceback.print_exc()
+                continue
+            file_database.set_checksum(
+                path, st.st_size, st.st_mtime_ns, sha1)
+            file_database.delete_file(path=path)
+            file_database.add_file(path=path, sha1=sha1,
+                                   mtime=int(st.st_mtime), size=st.st_size)
+            if game_id is not None:
+                print("[startup] updating config", path)
+                continue
+            name, ext = os.path.splitext(os.path.basename(path))
+            scanner = ConfigurationScanner()
+            print("[startup] adding config", path)
+            game_id = database.add_game(
+                    path=path, name=scanner.create_configuration_name(name))
+            database.update_game_search_terms(
+                    game_id, scanner.create_search_terms(name))
+
+        unchanged_dirs = dirs.keys() - changed_dirs
+        for path, game_id in local_configs.items():
+            if path.rsplit("/", 1)[0] in unchanged_dirs:
+                # in a directory which has not changed
+                continue
+            print("[startup] removing configuration", path)
+            database.delete_game(id=game_id)
+            file_database.delete_file(path=path)
         print("... commit")
         database.commit()
-
-        LauncherSettings.set(
-                "configurations_dir_mtime",
-                cls.get_dir_mtime_str(configs_dir) + "+" + str(
-                    Database.VERSION))
+        file_database.commit()
+        state.set_dirs("configurations", root, version, dirs)
 
     @classmethod
     def kickstart_startup_scan(cls):
@@ -86,36 +190,38 @@ class StartupScan:
 
         print("kickstart_startup_scan")
         kickstarts_dir = FSGSDirectories.get_kickstarts_dir()
-        if LauncherSettings.get("kickstarts_dir_mtime") == \
-                cls.get_dir_mtime_str(kickstarts_dir):
-            print("... mtime not changed")
+        root = kickstarts_dir.replace("\\", "/")
+        state = cls.get_scan_state()
+        old_dirs = state.get_dirs(
+            "kickstarts", root, FileDatabase.get_version())
+        dirs, changed_dirs, paths = scan_tree(
+            root, old_dirs, lambda name: name.lower().endswith(
+                (".rom", ".bin")))
+        if not changed_dirs and dirs.keys() == old_dirs.keys():
+            print("... no directories changed")
         else:
+            print("...", len(changed_dirs), "changed directories")
             file_database = FileDatabase.get_instance()
-            print("... database.find_local_roms")
             local_roms = file_database.find_local_roms()
-            print("... walk kickstarts_dir")
-            for dir_path, dir_names, file_names in os.walk(kickstarts_dir):
-                for file_name in file_names:
-                    if not file_name.lower().endswith(".rom") and not \
-                            file_name.lower().endswith(".bin"):
-                        continue
-                    path = Paths.join(dir_path, file_name)
-                    if path in local_roms:
-                        local_roms[path] = None
-                        # already exists in database
-                        continue
-                    print("[startup] adding kickstart", path)
-                    ROMManager.add_rom_to_database(path, file_database)
-            print(local_roms)
-            for path, id in local_roms.items():
-                if id is not None:
-                    print("[startup] removing kickstart", path)
-                    file_database.delete_file(id=id)
+            rom_cache = ROMChecksumCache.instance()
+            for path in paths:
+                if local_roms.pop(path, None) is not None and \
+                        rom_cache.get(path) is not None:
+                    # already exists in database, and is unchanged
+                    continue
+                print("[startup] adding kickstart", path)
+                ROMManager.add_rom_to_database(path, file_database)
+            unchanged_dirs = dirs.keys() - changed_dirs
+            for path, file_id in local_roms.items():
+                if path.rsplit("/", 1)[0] in unchanged_dirs:
+                    # in a directory which has not changed
+                    continue
+                print("[startup] removing kickstart", path)
+                file_database.delete_file(id=file_id)
             print("... commit")
             file_database.commit()
-            LauncherSettings.set(
-                    "kickstarts_dir_mtime",
-                    cls.get_dir_mtime_str(kickstarts_dir))
+            state.set_dirs(
+                "kickstarts", root, FileDatabase.get_version(), dirs)
 
         amiga = Amiga.get_model_config("A500")
         for sha1 in amiga["kickstarts"]:
@@ -149,10 +255,3 @@ class StartupScan:
                     continue
                 print("[startup] adding kickstart", path)
                 ROMManager.add_rom_to_database(path, file_database)
-
-    @staticmethod
-    def get_dir_mtime_str(path):
-        try:
-            return str(int(os.path.getmtime(path)))
-        except Exception:
-            return "0"
@@ -1,4 +1,4 @@
-from fsgs.Database import Database
+from fsgs.Database import Database, GAME_PAGE_SIZE
 from fsgs.platform import PlatformHandler
 from fsgs.util.gamenameutil import GameNameUtil
 import fsui as fsui
@@ -11,6 +11,10 @@ class ConfigurationsBrowser(fsui.VerticalItemView):
     def __init__(self, parent):
         fsui.VerticalItemView.__init__(self, parent)
         self.items = []
+        # arguments for find_games_new for the current search, the
+        # results are loaded one page at a time
+        self.search_args = {}
+        self.more_items = False
         self.game_icon = fsui.Image("launcher:res/16/controller.png")
         self.config_icon = fsui.Image(
             "launcher:res/fsuae_config_16.png")
@@ -159,12 +163,27 @@ class ConfigurationsBrowser(fsui.VerticalItemView):
         except ValueError:
             # default is show all downloadable and locally available games
             have = 1
+        self.search_args = {
+            "search": " ".join(terms), "have": have,
+            "list_uuid": LauncherSettings.get("game_list_uuid"),
+        }
         items = database.find_games_new(
-            " ".join(terms), have=have,
-            list_uuid=LauncherSettings.get("game_list_uuid"))
-
+            limit=GAME_PAGE_SIZE, **self.search_args)
+        self.more_items = len(items) == GAME_PAGE_SIZE
         self.set_items(items)
 
+    def can_fetch_more(self):
+        return self.more_items
+
+    def fetch_more(self):
+        items = Database.get_instance().find_games_new(
+            limit=GAME_PAGE_SIZE, offset=len(self.items), **self.search_args)
+        self.more_items = len(items) == GAME_PAGE_SIZE
+        return items
+
+    def append_fetched_items(self, items):
+        self.items.extend(items)
+
     def load_configuration(self, item):
         if item[str("uuid")]:
             LauncherSettings.set("parent_uuid", item[str("uuid")])
@@ -283,8 +283,9 @@ class VariantsBrowser(fsui.ItemChoice):
         database_name = item["database"]
         personal_rating = item["personal_rating"]
         have = item["have"]
-        self._load_variant_2(
-                variant_uuid, database_name, personal_rating, have)
+        with LauncherConfig.batch():
+            self._load_variant_2(
+                    variant_uuid, database_name, personal_rating, have)
 
     def _load_variant_2(
             self, variant_uuid, database_name, personal_rating, have):
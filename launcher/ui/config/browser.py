@@ -1,7 +1,5 @@
-from launcher.ui.config.expand import expand_config, \
-    AbstractExpandFunctions
-from launcher.ui.config.model import ImplicitConfig, normalize, \
-    create_model
+from launcher.ui.config.expand import AbstractExpandFunctions
+from launcher.ui.config.model import ReactiveModel, normalize
 from launcher.launcher_config import LauncherConfig
 from launcher.launcher_settings import LauncherSettings
 from fsbc.util import unused
@@ -30,22 +28,32 @@ class ConfigBrowser(fsui.VerticalItemView):
         self.missing_color = fsui.Color(0xa8, 0xa8, 0xa8)
 
         self.platform_icons = {}
-        self._need_update = True
+        self.reactive_model = None
+        # keys changed since the last update
+        self._changed_keys = set()
+        self._need_update = False
         self.update_items()
 
     def update_items(self):
-        # FIXME: replace with a timer-scheduled function so this function does
-        # not run needlessly often
+        if self._need_update:
+            # already scheduled
+            return
         self._need_update = True
         fsui.call_after(self.do_update_items)
 
     def do_update_items(self):
         if not self._need_update:
             return
-        print("do_update_items")
-        implicit = ImplicitConfig(ConfigProxy(), SettingsProxy())
-        expand_config(implicit, ExpandFunctions())
-        model = create_model(implicit, show_all=False)
+        self._need_update = False
+        changed_keys = self._changed_keys
+        self._changed_keys = set()
+        if self.reactive_model is None:
+            print("do_update_items")
+            self.reactive_model = ReactiveModel(
+                ConfigProxy(), SettingsProxy(), ExpandFunctions(),
+                show_all=False)
+        elif not self.reactive_model.update(changed_keys):
+            return
         # print_model(model)
         items = []
 
@@ -60,10 +68,8 @@ class ConfigBrowser(fsui.VerticalItemView):
                 if model_item.children:
                     flatten(model_item.children, level + 1)
 
-        flatten(model.items, 0)
-        print(items)
+        flatten(self.reactive_model.model.items, 0)
         self.set_items(items)
-        self._need_update = False
 
     def on_destroy(self):
         LauncherConfig.remove_listener(self)
@@ -78,18 +84,25 @@ class ConfigBrowser(fsui.VerticalItemView):
         pass
 
     def on_config(self, key, value):
-        unused(key)
         unused(value)
+        self._changed_keys.add(key)
         self.update_items()
 
     def on_setting(self, key, value):
-        unused(key)
         unused(value)
+        self._changed_keys.add(key)
         self.update_items()
 
     def set_items(self, items):
+        old_items = self.items
         self.items = items
-        self.update()
+        if len(items) != len(old_items):
+            self.update()
+            return
+        changed = [i for i, item in enumerate(items)
+                   if item != old_items[i]]
+        if changed:
+            self.update_rows(changed[0], changed[-1])
 
     def get_item_count(self):
         return len(self.items)
@@ -1,6 +1,10 @@
+import heapq
 import os
 import weakref
 
+from launcher.ui.config import expand
+from launcher.ui.config.expand import expand_config
+
 
 class StrWithExplicit(str):
 
@@ -19,11 +23,23 @@ class ImplicitConfig:
         self._values = {}
         self._config = config
         self._settings = settings
+        # results of get by key, so repeated gets do not allocate new
+        # strings. Must be invalidated when the config or settings change.
+        self._cache = {}
 
         # self.__setattr__ = self.__setattr__function
 
     def get(self, key, default=""):
-        value = self._values.get(key, default)
+        if default:
+            return self._create(key, self._values.get(key, default))
+        try:
+            return self._cache[key]
+        except KeyError:
+            result = self._create(key, self._values.get(key, ""))
+            self._cache[key] = result
+            return result
+
+    def _create(self, key, value):
         explicit = self._config[key]
         # print(explicit)
         if not explicit:
@@ -35,6 +51,10 @@ class ImplicitConfig:
         result.explicit = explicit
         return result
 
+    def invalidate(self, key):
+        """Must be called when the explicit value for key changes."""
+        self._cache.pop(key, None)
+
     def __getitem__(self, item):
         result = self.get(item)
         # print("get", item, repr(result))
@@ -47,6 +67,7 @@ class ImplicitConfig:
         else:
             value = str(value)
         self._values[key] = value
+        self._cache.pop(key, None)
 
     def __getattr__(self, item):
         result = self.get(item)
@@ -64,6 +85,158 @@ class ImplicitConfig:
             self[key] = value
 
 
+class TrackingImplicitConfig(ImplicitConfig):
+    """Implicit config which records the keys read, for ReactiveModel.
+    Values for keys which are computed at or after the current position in
+    the expansion order are returned as not computed yet (only explicit),
+    like they would be during expand_config."""
+
+    def __init__(self, config, settings, positions):
+        ImplicitConfig.__init__(self, config, settings)
+        self._positions = positions
+        self._position = len(positions)
+        self._reads = None
+        self._explicit_cache = {}
+
+    def get(self, key, default=""):
+        if self._reads is not None:
+            self._reads.add(key)
+        if self._positions.get(key, -1) < self._position:
+            if default:
+                return ImplicitConfig.get(self, key, default)
+            cache = self._cache
+        else:
+            if default:
+                return self._create(key, default)
+            cache = self._explicit_cache
+        try:
+            return cache[key]
+        except KeyError:
+            if cache is self._cache:
+                result = self._create(key, self._values.get(key, ""))
+            else:
+                result = self._create(key, "")
+            cache[key] = result
+            return result
+
+    # the expand functions and create_model use attribute access
+    __getattr__ = get
+
+    def invalidate(self, key):
+        self._cache.pop(key, None)
+        self._explicit_cache.pop(key, None)
+
+    def remove(self, key):
+        self._values.pop(key, None)
+        self._cache.pop(key, None)
+
+
+def expand_nodes():
+    """Returns a list of (key, function) for the functions called by
+    expand_config, in the order they are called. Each function computes
+    the implicit value for key."""
+    nodes = []
+    # expand_config calls each function once, so the names are listed
+    # in call order
+    for name in expand_config.__code__.co_names:
+        function = getattr(expand, name, None)
+        if name.startswith("_") and callable(function):
+            nodes.append((name[1:], function))
+    return nodes
+
+
+class ReactiveModel:
+    """Keeps an expanded implicit config and the corresponding model up to
+    date. The keys read by each expand function (and by create_model) are
+    recorded, so when input keys change, only the functions which read
+    them, directly or through changed implicit values, are run again. The
+    model is only recreated when a value it has read has changed."""
+
+    def __init__(self, config, settings, functions, show_all=False):
+        self.nodes = expand_nodes()
+        positions = {key: i for i, (key, _) in enumerate(self.nodes)}
+        self.implicit = TrackingImplicitConfig(config, settings, positions)
+        self.functions = functions
+        self.show_all = show_all
+        self.model = None
+        self._node_reads = [set() for _ in self.nodes]
+        # key -> indices of the nodes which read key
+        self._readers = {}
+        self._model_reads = set()
+        self.recompute_all()
+
+    def recompute_all(self):
+        for key, _ in self.nodes:
+            self.implicit.remove(key)
+        self.implicit._cache.clear()
+        self.implicit._explicit_cache.clear()
+        for i in range(len(self.nodes)):
+            self._run_node(i)
+        self._run_model()
+
+    def update(self, changed_keys):
+        """Updates implicit values and the model after the explicit values
+        for changed_keys have changed. Returns True if the model was
+        recreated."""
+        c = self.implicit
+        queue = []
+        for key in changed_keys:
+            c.invalidate(key)
+            queue.extend(self._readers.get(key, ()))
+        model_changed = not self._model_reads.isdisjoint(changed_keys)
+        # a node only uses values computed by nodes before it, so running
+        # the nodes in order runs each node at most once
+        heapq.heapify(queue)
+        last = -1
+        while queue:
+            i = heapq.heappop(queue)
+            if i == last:
+                continue
+            last = i
+            key = self.nodes[i][0]
+            old_value = c._values.get(key)
+            self._run_node(i)
+            if c._values.get(key) == old_value:
+                continue
+            if key in self._model_reads:
+                model_changed = True
+            for j in self._readers.get(key, ()):
+                if j > i:
+                    heapq.heappush(queue, j)
+        if model_changed:
+            self._run_model()
+        return model_changed
+
+    def _run_node(self, i):
+        key, function = self.nodes[i]
+        c = self.implicit
+        for read_key in self._node_reads[i]:
+            self._readers[read_key].discard(i)
+        # run from scratch, like in expand_config, in case the function
+        # does not always set a value
+        c.remove(key)
+        c._position = i
+        c._reads = set()
+        try:
+            function(c, self.functions)
+        finally:
+            reads = c._reads
+            c._reads = None
+            c._position = len(self.nodes)
+        self._node_reads[i] = reads
+        for read_key in reads:
+            self._readers.setdefault(read_key, set()).add(i)
+
+    def _run_model(self):
+        c = self.implicit
+        c._reads = set()
+        try:
+            self.model = create_model(c, show_all=self.show_all)
+        finally:
+            self._model_reads = c._reads
+            c._reads = None
+
+
 class NoParent:
 
     def __call__(self):
@@ -127,7 +300,8 @@ class Model:
     def add(self, item):
         # if item.active or self.show_all:
         if True:
-            if item.parent:
+            # top-level items (without parent) are simply appended
+            if item.parent():
                 for i in range(len(self.items) - 1, -1, -1):
                     if self.items[0].parent == item.parent or \
                             self.items[0] == item.parent:
@@ -1,9 +1,14 @@
+import os
+
 import fsui
 from launcher.i18n import gettext
 from launcher.ui.settings.settings_page import SettingsPage
 from fsbc.task import Task
 from fsgs.Database import Database
 from fsgs.FileDatabase import FileDatabase
+from fsgs.FSGSDirectories import FSGSDirectories
+from fsgs.GameStateStore import GameStateStore, StateStoreError, \
+    game_state_dirs, state_dirs_usage
 from fsgs.LockerDatabase import LockerDatabase
 from fsgs.context import fsgs
 from fsgs.ogd.client import OGDClient
@@ -30,9 +35,53 @@ class MaintenanceSettingsPage(SettingsPage):
         button.activated.connect(self.on_defragment_button)
         self.layout.add(button, margin_top=20)
 
+        label = fsui.MultiLineLabel(self, gettext(
+            "Compacting save states removes old versions of files changed "
+            "by games, which are no longer used."), 640)
+        self.layout.add(label, fill=True, margin_top=20)
+        self.state_usage_label = fsui.Label(self, "")
+        self.layout.add(self.state_usage_label, fill=True, margin_top=10)
+        self.state_usage_task = None
+        self.update_state_usage()
+
+        button = fsui.Button(self, gettext("Compact Save States"))
+        button.activated.connect(self.on_compact_button)
+        self.layout.add(button, margin_top=20)
+
     def on_defragment_button(self):
         TaskDialog(self.get_window(), DefragmentDatabasesTask()).show()
 
+    def on_compact_button(self):
+        task = CompactSaveStatesTask()
+        task.finished.connect(self.update_state_usage)
+        TaskDialog(self.get_window(), task).show()
+
+    def on_destroy(self):
+        if self.state_usage_task is not None:
+            self.state_usage_task.stop()
+
+    def update_state_usage(self):
+        # walking all state dirs can take a while, so it is done in a task
+        if self.state_usage_task is not None:
+            self.state_usage_task.stop()
+        self.state_usage_label.set_text(gettext(
+            "Calculating save state disk usage..."))
+        self.state_usage_task = StateUsageTask()
+        self.state_usage_task.succeeded.connect(self.on_state_usage)
+        self.state_usage_task.start()
+
+    def on_state_usage(self):
+        usage = self.state_usage_task.usage
+        if usage is None:
+            # from a task which was replaced by a newer one
+            return
+        self.state_usage_label.set_text(gettext(
+            "Save states use {size:0.1f} MiB in {count} directories "
+            "({unused:0.1f} MiB can be reclaimed)").format(
+            size=sum(x[1] for x in usage) / (1024 * 1024),
+            count=len(usage),
+            unused=sum(x[2] - x[3] for x in usage) / (1024 * 1024)))
+
 
 class DefragmentDatabasesTask(Task):
 
@@ -53,3 +102,33 @@ class DefragmentDatabasesTask(Task):
         with database:
             cursor = database.cursor()
             cursor.execute("VACUUM")
+
+
+class StateUsageTask(Task):
+
+    def __init__(self):
+        Task.__init__(self, gettext("Save State Disk Usage"))
+        self.usage = None
+
+    def run(self):
+        self.usage = state_dirs_usage(
+            FSGSDirectories.get_save_states_dir(), self.stop_check)
+
+
+class CompactSaveStatesTask(Task):
+
+    def __init__(self):
+        Task.__init__(self, gettext("Compact Save States"))
+
+    def run(self):
+        for path in game_state_dirs(FSGSDirectories.get_save_states_dir()):
+            self.stop_check()
+            store = GameStateStore(path)
+            if not store.exists():
+                continue
+            self.set_progress(gettext("Compacting {name}").format(
+                name=os.path.basename(path)))
+            try:
+                store.compact()
+            except (OSError, StateStoreError) as e:
+                print("could not compact", path, repr(e))